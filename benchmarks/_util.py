@@ -0,0 +1,26 @@
+"""What the benchmarks share: importing it puts the repository on the
+module path, ahead of any installed zdcode, and best_of times a function.
+"""
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), "..")
+
+sys.path.insert(0, ROOT_DIR)
+
+
+def best_of(repeats, func):
+    """Calls func repeats times, and returns the shortest time it took, in
+    seconds."""
+    best = None
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        took = time.perf_counter() - start
+
+        if best is None or took < best:
+            best = took
+
+    return best
@@ -0,0 +1,90 @@
+"""Times comment stripping on a large generated source.
+
+Usage: python benchmarks/bench_comments.py [-n REPEATS] [-s MEGABYTES]
+
+Generates about MEGABYTES (default 5) of code with large block comments,
+line comments and string literals that look like comments, and times
+zdlexer.strip_comments and the whole preprocessor on it. For reference,
+also times the regex substitutions the preprocessor used before.
+"""
+import argparse
+import re
+
+from _util import best_of
+
+from zdcode import zdlexer
+
+CHUNK = "\n".join(
+    [
+        "/*",
+        " * A long block comment, of the kind that documents a whole actor.",
+    ]
+    + [
+        " * Line {} of it, with a // that is not a line comment.".format(n)
+        for n in range(200)
+    ]
+    + [
+        " */",
+        "class Commented{} {",
+        '    set Obituary to "%o was hit by http://example.com/*";',
+        "    label Spawn {",
+        "        TNT1 A 1; // a line comment",
+        "        TNT1 A 1 A_Log('a // string, not a comment');",
+        "        stop;",
+        "    };",
+        "}",
+        "",
+    ]
+)
+
+
+def generated_source(megabytes):
+    chunks = []
+    size = 0
+    n = 0
+
+    while size < megabytes * 1024 * 1024:
+        chunk = CHUNK.replace("{}", str(n), 1)
+        chunks.append(chunk)
+        size += len(chunk) + 1
+        n += 1
+
+    return "\n".join(chunks)
+
+
+def old_strip_comments(code):
+    code = re.sub(r"\/\/[^\r\n]+", lambda x: re.sub(r"[^\n]", " ", x.group(0)), code)
+    code = re.sub(
+        r"\/\*(\n|.)+?\*\/", lambda x: re.sub(r"[^\n]", " ", x.group(0)), code
+    )
+    return re.sub(r"\\\n", "", code)
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument("-s", "--size", type=float, default=5.0)
+    args = aparser.parse_args()
+
+    code = generated_source(args.size)
+    megabytes = len(code) / (1024 * 1024)
+
+    print(
+        "{:.1f} MB, {} lines, {} block comments".format(
+            megabytes, code.count("\n") + 1, code.count("/*\n")
+        )
+    )
+
+    for name, func in (
+        ("strip_comments", lambda: zdlexer.strip_comments(code)),
+        ("old regexes", lambda: old_strip_comments(code)),
+        ("preprocess_code", lambda: zdlexer.preprocess_code(code)),
+    ):
+        took = best_of(args.repeats, func)
+        print(
+            "{:<16} {:9.2f} ms {:9.1f} MB/s".format(name, took * 1000, megabytes / took)
+        )
+
+
+if __name__ == "__main__":
+    main()
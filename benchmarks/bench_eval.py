@@ -0,0 +1,47 @@
+"""Times parsing of sources dominated by compile-time e{...} evaluations.
+
+Usage: python benchmarks/bench_eval.py [-n REPEATS] [-p PROPERTIES] [-t TERMS]
+"""
+import argparse
+
+from _util import best_of
+
+from zdcode import zdlexer
+
+
+def make_source(properties, terms):
+    lines = ["class EvalHeavy {"]
+
+    for i in range(properties):
+        # fully parenthesized, so that older grammars can parse it too
+        expr = "(xa * 2)"
+
+        for j in range(1, terms):
+            expr = "((x{} - {}) + {})".format(chr(97 + j % 26), j % 10, expr)
+
+        lines.append("    set User_Prop{} to e{{ {} }};".format(i, expr))
+
+    lines.append("}")
+
+    return "\n".join(lines)
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=5)
+    aparser.add_argument("-p", "--properties", type=int, default=50)
+    aparser.add_argument("-t", "--terms", type=int, default=4)
+    args = aparser.parse_args()
+
+    postcode = zdlexer.preprocess_code(make_source(args.properties, args.terms))
+    best = best_of(args.repeats, lambda: zdlexer.parse_postcode(postcode))
+
+    print(
+        "{} evaluations of {} terms: parse {:.2f} ms".format(
+            args.properties, args.terms, best * 1000
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
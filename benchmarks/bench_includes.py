@@ -0,0 +1,108 @@
+"""Times preprocessing many compilation units that include shared headers.
+
+Usage: python benchmarks/bench_includes.py [-n REPEATS] [-u UNITS] [-t TARGETS]
+
+Writes a generated header library to a temporary directory, then
+preprocesses UNITS units that all include it, once for each of TARGETS
+sets of definitions (as a Zake build with that many targets would), both
+with a new zdlexer.IncludeCache for every unit, and with a single one
+shared by all of them. Exits with status 1 if the outputs ever differ.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+from _util import best_of
+
+from zdcode import zdlexer
+
+HEADER = "\n".join(
+    [
+        "#ifdef DEBUG",
+        "#defmacro LOG_N(msg) A_Log(msg)",
+        "#else",
+        "#defmacro LOG_N(msg) A_Jump(0, 1)",
+        "#endif",
+        "#define HEADER_N",
+    ]
+    + [
+        "class Header_N_{} {{ label Spawn {{ TNT1 A 1 LOG_N('x'); stop; }}; }}".format(
+            n
+        )
+        for n in range(40)
+    ]
+)
+
+
+def write_library(directory, headers):
+    for n in range(headers):
+        with open(os.path.join(directory, "h{}.zc2".format(n)), "w") as fp:
+            fp.write(HEADER.replace("_N", "_{}".format(n)))
+
+    with open(os.path.join(directory, "all.zc2"), "w") as fp:
+        fp.write("\n".join("#include h{}.zc2".format(n) for n in range(headers)))
+
+
+def build(directory, units, targets, shared):
+    outputs = []
+    include_cache = zdlexer.IncludeCache()
+
+    for target in range(targets):
+        defs = {"TARGET": str(target)}
+
+        if target % 2:
+            defs["DEBUG"] = None
+
+        for unit in range(units):
+            if not shared:
+                include_cache = zdlexer.IncludeCache()
+
+            postcode = zdlexer.preprocess_code(
+                "#include all.zc2\nclass Unit{} {{}}".format(unit),
+                defs=dict(defs),
+                this_fname="unit{}.zc2".format(unit),
+                rel_dir=directory,
+                include_cache=include_cache,
+            )
+            outputs.append(postcode.text)
+
+    return outputs, include_cache
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument("-u", "--units", type=int, default=40)
+    aparser.add_argument("-t", "--targets", type=int, default=4)
+    aparser.add_argument("--headers", type=int, default=20)
+    args = aparser.parse_args()
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_library(directory, args.headers)
+
+        for name, shared in (("cache per unit", False), ("shared cache", True)):
+            built = []
+            best = best_of(
+                args.repeats,
+                lambda: built.append(
+                    build(directory, args.units, args.targets, shared)
+                ),
+            )
+            outputs, include_cache = built[-1]
+            results.append(outputs)
+            print(
+                "{:<16} {:9.2f} ms  ({} hits, {} misses)".format(
+                    name, best * 1000, include_cache.hits, include_cache.misses
+                )
+            )
+
+    if results[0] != results[1]:
+        print("Preprocessed code differs with a shared cache!")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Times reparsing ZDCode sources after an edit to a single declaration.
+
+Usage: python benchmarks/bench_incremental.py [-n REPEATS] [FILES...]
+
+For every file, one top-level declaration is edited, and the edited source
+is parsed both from scratch and with a DeclarationCache that has already
+seen the original source. Exits with status 1 if both parses ever differ.
+
+Defaults to the example actors and the test sources.
+"""
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+
+from _util import best_of
+
+from zdcode import zdlexer
+from zdcode.cache import ASTPickler
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), "..")
+DEFAULT_FILES = sorted(
+    glob.glob(os.path.join(ROOT_DIR, "example", "assets", "actors", "*.zc2"))
+) + sorted(glob.glob(os.path.join(ROOT_DIR, "tests", "*.zc2")))
+
+
+def dump(ast):
+    # The AST holds closures, which only compare equal once pickled.
+    data = io.BytesIO()
+    ASTPickler(data).dump(ast)
+    return data.getvalue()
+
+
+def edit_source(code):
+    """Doubles the first whitespace in the middle declaration, which changes
+    its text (and so its cache key) but not its meaning."""
+    spans = zdlexer.split_declarations(code)
+
+    if not spans:
+        return None, 0
+
+    start, end = spans[len(spans) // 2]
+    pos = start + len(code[start:end].split(None, 1)[0])
+    return code[:pos] + " " + code[pos:], len(spans)
+
+
+def bench_file(fname, repeats):
+    with open(fname) as fp:
+        source = fp.read()
+
+    code = zdlexer.preprocess_code(source, rel_dir=os.path.dirname(fname)).text
+    edited, num_decls = edit_source(code)
+
+    if edited is None:
+        print("{}: no declarations".format(os.path.basename(fname)))
+        return True
+
+    try:
+        full = zdlexer.parse_source(edited)
+
+    except Exception as err:
+        print("{}: does not parse ({})".format(os.path.basename(fname), err))
+        return True
+
+    def incremental():
+        cache = zdlexer.DeclarationCache()
+        cache.parse(code)
+        cache.reused = cache.parsed = 0
+
+        start = time.perf_counter()
+        result = cache.parse(edited)
+        took = time.perf_counter() - start
+
+        return result, took, cache
+
+    result, _, cache = incremental()
+    same = dump(result) == dump(full)
+
+    full_time = best_of(repeats, lambda: zdlexer.parse_source(edited))
+    warm_time = min(incremental()[1] for _ in range(repeats))
+
+    print(
+        "{:<24} {:4} decls  full {:8.2f} ms  incremental {:8.2f} ms"
+        "  ({} reused, {} parsed){}".format(
+            os.path.basename(fname),
+            num_decls,
+            full_time * 1000,
+            warm_time * 1000,
+            cache.reused,
+            cache.parsed,
+            "" if same else "  MISMATCH",
+        )
+    )
+
+    return same
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=5)
+    aparser.add_argument("files", nargs="*", default=DEFAULT_FILES)
+    args = aparser.parse_args()
+
+    ok = True
+
+    for fname in args.files:
+        ok = bench_file(fname, args.repeats) and ok
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Times lowering a label that injects macros many times.
+
+Usage: python benchmarks/bench_inject.py [-n REPEATS] [-m MACROS] [-i INJECTS]
+
+Generates MACROS macros, half of them in a class and the other half in
+another class inheriting from it, so that they are in different scopes,
+and a label of the latter which injects them INJECTS times in turn, each
+with an argument, inside a repeat statement. Times parsing it, and parsing and lowering it.
+"""
+import argparse
+import sys
+
+from _util import best_of
+
+import zdcode
+
+
+def inject_source(macros, injects):
+    outer = " ".join(
+        "macro Outer{}(v) {{ TNT1 A 1 A_SetUserVar(user_a, v); }}".format(n)
+        for n in range(macros // 2)
+    )
+    inner = " ".join(
+        "macro Inner{}(v) {{ TNT1 B 1 A_SetUserVar(user_b, v); }}".format(n)
+        for n in range(macros - macros // 2)
+    )
+    names = ["Outer{}".format(n) for n in range(macros // 2)] + [
+        "Inner{}".format(n) for n in range(macros - macros // 2)
+    ]
+    body = " ".join(
+        "inject {}({});".format(names[n % len(names)], n) for n in range(injects)
+    )
+
+    return (
+        "class Macros {{\n"
+        "    {}\n"
+        "}}\n"
+        "class Injects inherits Macros {{\n"
+        "    {}\n"
+        "    label Spawn {{ x 1 {{ {} }}; stop; }};\n"
+        "}}\n"
+    ).format(outer, inner, body)
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument("-m", "--macros", type=int, default=200)
+    aparser.add_argument("-i", "--injects", type=int, default=10000)
+    args = aparser.parse_args()
+
+    source = inject_source(args.macros, args.injects)
+
+    def lower():
+        code = zdcode.ZDCode()
+
+        if not code.add(source):
+            sys.exit(1)
+
+    parse_took = best_of(args.repeats, lambda: zdcode.zdlexer.parse_code(source))
+    took = best_of(args.repeats, lower)
+    print(
+        "{} macros, {} injects: parse {:9.2f} ms  parse and lower {:9.2f} ms".format(
+            args.macros, args.injects, parse_took * 1000, took * 1000
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Times compiling many ZDCode sources with different numbers of jobs.
+
+Usage: python benchmarks/bench_jobs.py [-n REPEATS] [-j JOBS...] [FILES...]
+
+Every run adds all the given files to one ZDCode (see ZDCode.add_all) and
+outputs DECORATE, which must come out the same for every number of jobs;
+exits with status 1 otherwise. Defaults to the example actors that compile.
+"""
+import argparse
+import glob
+import os
+import random
+import sys
+
+from _util import best_of
+
+import zdcode
+from zdcode import zdlexer
+
+EXAMPLE_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "example", "assets", "actors"
+)
+
+
+def compile_all(sources, jobs):
+    code = zdcode.ZDCode()
+
+    if not code.add_all(sources, jobs=jobs):
+        return None
+
+    random.seed(1234)
+    return code.decorate()
+
+
+def compiles(source):
+    try:
+        return compile_all([source], None) is not None
+
+    except (Exception, zdlexer.PreprocessingError, zdlexer.ZDParseError):
+        return False
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument(
+        "-j", "--jobs", type=int, nargs="+", default=[1, 2, os.cpu_count()]
+    )
+    aparser.add_argument("files", nargs="*")
+    args = aparser.parse_args()
+
+    sources = []
+
+    for fname in args.files or sorted(glob.glob(os.path.join(EXAMPLE_DIR, "*.zc2"))):
+        with open(fname) as fp:
+            sources.append((fp.read(), os.path.basename(fname), os.path.dirname(fname)))
+
+    if not args.files:
+        sources = [source for source in sources if compiles(source)]
+
+    print("{} files".format(len(sources)))
+
+    outputs = set()
+
+    for jobs in args.jobs:
+        best = best_of(args.repeats, lambda: outputs.add(compile_all(sources, jobs)))
+        print("jobs {:<4} {:9.2f} ms".format(jobs, best * 1000))
+
+    if len(outputs) != 1:
+        print("DECORATE output differs between job counts!")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Compiles generated code with deeply nested statements.
+
+Usage: python benchmarks/bench_nesting.py [-n REPEATS] [-d DEPTHS]
+
+For every depth, generates a macro whose body nests if, while, repeat,
+sometimes and apply blocks DEPTH levels deep, injects it in a while loop,
+and times parsing (with every parser backend), lowering and DECORATE
+output, at the interpreter's default recursion limit. Stages that still
+recurse once per nesting level report the limit being exceeded instead.
+"""
+import argparse
+import random
+import sys
+
+from _util import best_of
+
+import zdcode
+from zdcode import zdlexer
+
+NESTINGS = [
+    "if (user_a > {0}) {{ {1} }} else {{ TNT1 A 1; }};",
+    "while (user_a < {0}) {{ {1} break; }};",
+    "x 1 {{ {1} }};",
+    "sometimes 50 {{ {1} }};",
+    "apply Bright {{ {1} }};",
+]
+
+
+def nested_source(depth):
+    body = "TNT1 A 1; continue;"
+
+    for i in range(depth):
+        body = NESTINGS[i % len(NESTINGS)].format(i, body) + " TNT1 B 1;"
+
+    return (
+        "class Nested {{\n"
+        "    mod Bright {{ (sprite(TNT1)) {{ +flag Bright; }}; }}\n"
+        "    macro Deep {{ {} }}\n"
+        "    label Spawn {{ while (1) {{ inject Deep; }}; stop; }}\n"
+        "}}\n"
+    ).format(body)
+
+
+def timed(repeats, func):
+    try:
+        return "{:9.2f} ms".format(best_of(repeats, func) * 1000)
+
+    except (RecursionError, zdlexer.ZDNestingError):
+        return "{:>12}".format("too deep")
+
+
+def bench_depth(depth, repeats):
+    source = nested_source(depth)
+    postcode = zdlexer.preprocess_code(source)
+    timings = []
+
+    for backend in zdlexer.parser_backends:
+        timings.append(
+            "parse/{} {}".format(
+                backend,
+                timed(
+                    repeats, lambda: zdlexer.parse_postcode(postcode, backend=backend)
+                ),
+            )
+        )
+
+    def lower():
+        code = zdcode.ZDCode()
+        code.add(source)
+        return code
+
+    timings.append("lower {}".format(timed(repeats, lower)))
+
+    try:
+        code = lower()
+
+    except (RecursionError, zdlexer.ZDNestingError):
+        timings.append("decorate {:>12}".format("-"))
+
+    else:
+        random.seed(1234)
+        timings.append("decorate {}".format(timed(repeats, code.decorate)))
+
+    print("depth {:<5} {}".format(depth, "  ".join(timings)))
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument(
+        "-d", "--depths", type=int, nargs="+", default=[50, 100, 200, 300]
+    )
+    args = aparser.parse_args()
+
+    print("recursion limit: {}".format(sys.getrecursionlimit()))
+
+    for depth in args.depths:
+        bench_depth(depth, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Times rendering a large DECORATE output.
+
+Usage: python benchmarks/bench_output.py [-n REPEATS] [-a ACTORS]
+
+Compiles ACTORS generated actors, each with a few labels of nested if,
+while and sometimes blocks, then times rendering their DECORATE into a
+string with ZDCode.decorate, and writing it to a file with
+ZDCode.write_decorate. Exits with status 1 if both differ.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+from _util import best_of
+
+import zdcode
+
+ACTOR = """
+class Generated_N {
+    set Radius to 20;
+    set Height to 56;
+    is SHOOTABLE;
+
+    label Spawn {
+        TNT1 A 1;
+        Goto See;
+    };
+
+    label See {
+        POSS AABBCCDD 4 A_Chase;
+        if (health > 50) {
+            POSS E 10 A_FaceTarget;
+            sometimes 30 {
+                POSS F 8 A_PosAttack;
+                while (user_shots < 3) {
+                    POSS F 4 A_PosAttack;
+                    if (random(0, 1)) { POSS E 2; break; };
+                };
+            };
+        } else {
+            POSS G 3 A_Pain;
+        };
+        loop;
+    };
+
+    label Death {
+        POSS H 5;
+        POSS I 5 A_Scream;
+        POSS J 5 A_NoBlocking;
+        POSS K 5;
+        POSS L -1;
+        stop;
+    };
+}
+"""
+
+
+def generated_source(actors):
+    return "\n".join(ACTOR.replace("_N", "_{}".format(n)) for n in range(actors))
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument("-a", "--actors", type=int, default=2000)
+    args = aparser.parse_args()
+
+    random.seed(1234)
+    code = zdcode.ZDCode()
+
+    if not code.add(generated_source(args.actors)):
+        sys.exit(1)
+
+    text = code.decorate()
+    print(
+        "{} actors, {:.1f} MB of DECORATE".format(
+            args.actors, len(text) / (1024 * 1024)
+        )
+    )
+
+    took = best_of(args.repeats, code.decorate)
+    print("{:<16} {:9.2f} ms".format("decorate", took * 1000))
+
+    with tempfile.TemporaryDirectory() as directory:
+        fname = os.path.join(directory, "DECORATE")
+
+        def write():
+            with open(fname, "w") as fp:
+                code.write_decorate(fp)
+
+        took = best_of(args.repeats, write)
+        print("{:<16} {:9.2f} ms".format("write_decorate", took * 1000))
+
+        with open(fname) as fp:
+            if fp.read() != text:
+                print("The written DECORATE differs!")
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
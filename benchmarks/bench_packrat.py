@@ -0,0 +1,76 @@
+"""Times parsing with and without the packrat cache (zdlexer.PackratMemo).
+
+Usage: python benchmarks/bench_packrat.py [-n REPEATS] [-d DEPTHS] [FILES...]
+
+Besides the given files, generates a modifier whose selector nests
+left-leaning '^^' operations DEPTH levels deep. Every parenthesis level
+tries the '&&' and '||' forms before '^^', re-parsing the whole left
+operand each time, which the cache turns from exponential into linear
+time. The per-rule cache hits are printed for every input.
+"""
+import argparse
+import os
+
+from _util import best_of
+
+from zdcode import zdlexer
+
+
+def nested_selector_source(depth):
+    selector = "flag(F0)"
+
+    for i in range(1, depth + 1):
+        selector = "({} ^^ flag(F{}))".format(selector, i)
+
+    return "class NestedSelector {{\n    mod Pick {{ {} +flag Bright; }}\n}}\n".format(
+        selector
+    )
+
+
+def bench_source(name, postcode, repeats):
+    def plain():
+        zdlexer.parse_postcode(postcode, backend="parsy")
+
+    def cached():
+        zdlexer.parse_postcode(postcode, backend="parsy", memo=zdlexer.PackratMemo())
+
+    t_plain = best_of(repeats, plain)
+    t_cached = best_of(repeats, cached)
+
+    memo = zdlexer.PackratMemo()
+    zdlexer.parse_postcode(postcode, backend="parsy", memo=memo)
+
+    print(
+        "{:<24} plain {:9.2f} ms  packrat {:9.2f} ms".format(
+            name, t_plain * 1000, t_cached * 1000
+        )
+    )
+
+    for line in memo.summary().splitlines():
+        print("    " + line)
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument("-d", "--depths", type=int, nargs="+", default=[2, 4, 6, 8])
+    aparser.add_argument("files", nargs="*", default=[])
+    args = aparser.parse_args()
+
+    for fname in args.files:
+        with open(fname) as fp:
+            postcode = zdlexer.preprocess_code(
+                fp.read(),
+                this_fname=os.path.basename(fname),
+                rel_dir=os.path.dirname(fname),
+            )
+
+        bench_source(os.path.basename(fname), postcode, args.repeats)
+
+    for depth in args.depths:
+        postcode = zdlexer.preprocess_code(nested_selector_source(depth))
+        bench_source("selector depth {}".format(depth), postcode, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Times the preprocessing and parsing stages of ZDCode sources.
+
+Usage: python benchmarks/bench_parse.py [-n REPEATS] [FILES...]
+
+Defaults to the two largest example actors. Files that currently stop at
+a parse error are still timed up to the point of failure.
+"""
+import argparse
+import os
+
+from _util import best_of
+
+from zdcode import zdlexer
+
+EXAMPLE_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "example", "assets", "actors"
+)
+DEFAULT_FILES = [
+    os.path.join(EXAMPLE_DIR, "Foe.zc2"),
+    os.path.join(EXAMPLE_DIR, "DoomFox.zc2"),
+]
+
+
+def bench_file(fname, repeats):
+    with open(fname) as fp:
+        code = fp.read()
+
+    dirname = os.path.dirname(fname)
+    basename = os.path.basename(fname)
+
+    def preprocess():
+        return zdlexer.preprocess_code(code, this_fname=basename, rel_dir=dirname)
+
+    postcode = preprocess()
+    status = "ok"
+
+    def parse():
+        nonlocal status
+
+        try:
+            zdlexer.parse_postcode(postcode)
+
+        except zdlexer.ZDParseError:
+            status = "stops at parse error"
+
+    t_pre = best_of(repeats, preprocess)
+    t_parse = best_of(repeats, parse)
+
+    print(
+        "{:<20} {:>6} lines  preprocess {:8.2f} ms  parse {:8.2f} ms  ({})".format(
+            basename, len(code.splitlines()), t_pre * 1000, t_parse * 1000, status
+        )
+    )
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=5)
+    aparser.add_argument("files", nargs="*", default=DEFAULT_FILES)
+    args = aparser.parse_args()
+
+    for fname in args.files:
+        bench_file(fname, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Measures preprocessor throughput, in source lines per second.
+
+Usage: python benchmarks/bench_preprocess.py [-n REPEATS] [-l LINES] [FILES...]
+
+Preprocesses the example actors (or the given files), and generated
+sources of about LINES lines: plain code without any directive, code with
+a conditional block every few lines, code that is mostly inside inactive
+conditional blocks, and code calling parametrized aliases on every line.
+
+Also times preprocessing each again, warm: from the LineProgram of the
+source, as for another build target.
+"""
+import argparse
+import glob
+import os
+
+from _util import best_of
+
+from zdcode import zdlexer
+
+EXAMPLE_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "example", "assets", "actors"
+)
+
+STATE_LINE = "    TNT1 A 1 A_Jump(128, 2); // idle a bit"
+
+
+def plain_source(lines):
+    return "\n".join(STATE_LINE for _ in range(lines))
+
+
+def conditional_source(lines):
+    chunk = [
+        "#ifdef DEBUG",
+        STATE_LINE,
+        "#else",
+        STATE_LINE,
+        "#endif",
+        "#define LAST_CHUNK",
+        STATE_LINE,
+        STATE_LINE,
+    ]
+    return "\n".join(chunk * (lines // len(chunk)))
+
+
+def inactive_source(lines):
+    chunk = ["#ifdef DEBUG"] + [STATE_LINE] * 98 + ["#endif"]
+    return "\n".join(chunk * (lines // len(chunk)))
+
+
+def macro_source(lines):
+    aliases = [
+        "#defmacro FRAME{0}(s,d) TNT1 (s) (d) A_SetUserVar(user_frame, {0})".format(n)
+        for n in range(20)
+    ]
+    calls = ["    FRAME{}(A, {}); // frame".format(n % 20, n % 7) for n in range(lines)]
+    return "\n".join(aliases + calls)
+
+
+def bench_source(name, code, repeats, rel_dir="."):
+    num_lines = code.count("\n") + 1
+
+    def preprocess():
+        zdlexer.preprocess_code(code, this_fname=name, rel_dir=rel_dir)
+
+    def cold():
+        zdlexer.line_program.cache_clear()
+        preprocess()
+
+    cold_took = best_of(repeats, cold)
+    warm_took = best_of(repeats, preprocess)
+
+    print(
+        "{:<24} {:8} lines {:9.2f} ms {:12.0f} lines/s  warm {:9.2f} ms".format(
+            name, num_lines, cold_took * 1000, num_lines / cold_took, warm_took * 1000
+        )
+    )
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument("-l", "--lines", type=int, default=20000)
+    aparser.add_argument("files", nargs="*")
+    args = aparser.parse_args()
+
+    for fname in args.files or sorted(glob.glob(os.path.join(EXAMPLE_DIR, "*.zc2"))):
+        with open(fname) as fp:
+            bench_source(
+                os.path.basename(fname),
+                fp.read(),
+                args.repeats,
+                os.path.dirname(fname),
+            )
+
+    bench_source("generated/plain", plain_source(args.lines), args.repeats)
+    bench_source("generated/conditional", conditional_source(args.lines), args.repeats)
+    bench_source("generated/inactive", inactive_source(args.lines), args.repeats)
+    bench_source("generated/macros", macro_source(args.lines), args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Times rendering the DECORATE of code that counts its states a lot.
+
+Usage: python benchmarks/bench_render.py [-n REPEATS] [-r RETURNS] [-i INJECTS]
+
+Generates a macro with RETURNS early returns, each inside an if statement,
+injects it INJECTS times in a label, and times lowering it and rendering
+its DECORATE. Every return jumps to the end of its macro, by the number
+of states left in it; rendering asks for that count once per return, and
+for the number of states in every block at every nesting level.
+"""
+import argparse
+import random
+
+from _util import best_of
+
+import zdcode
+
+
+def returns_source(returns, injects):
+    body = " ".join(
+        "if (user_a > {}) {{ TNT1 A 1; return; }}; TNT1 B 1;".format(n)
+        for n in range(returns)
+    )
+
+    return (
+        "class Returns {{\n"
+        "    macro Early {{ {} }}\n"
+        "    label Spawn {{ {} stop; }}\n"
+        "}}\n"
+    ).format(body, "inject Early; " * injects)
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument("-r", "--returns", type=int, default=200)
+    aparser.add_argument("-i", "--injects", type=int, default=20)
+    args = aparser.parse_args()
+
+    source = returns_source(args.returns, args.injects)
+
+    def lower():
+        code = zdcode.ZDCode()
+        code.add(source)
+        return code
+
+    lower_took = best_of(args.repeats, lower)
+
+    random.seed(1234)
+    code = lower()
+    decorate_took = best_of(args.repeats, code.decorate)
+
+    print(
+        "{} returns, {} injects: lower {:9.2f} ms  decorate {:9.2f} ms".format(
+            args.returns, args.injects, lower_took * 1000, decorate_took * 1000
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
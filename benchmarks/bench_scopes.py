@@ -0,0 +1,64 @@
+"""Times lowering code that looks names up in deeply nested scopes.
+
+Usage: python benchmarks/bench_scopes.py [-n REPEATS] [-s STATES] [DEPTHS...]
+
+For every depth (by default 50, 100 and 200), generates that many macros,
+each of which injects the one before inside a repeat statement, so that
+every level nests two scopes more. The innermost macro repeats a state
+STATES times, which looks up its macro argument, and the user variable
+it sets, through all of them.
+"""
+import argparse
+import sys
+
+from _util import best_of
+
+import zdcode
+
+
+def nested_source(depth, states):
+    macros = [
+        "macro Level0(v) {{ x {} {{ TNT1 A 1 A_SetUserVar(user_a, v); }}; }}".format(
+            states
+        )
+    ]
+
+    for level in range(1, depth + 1):
+        macros.append(
+            "macro Level{}(v) {{ x 1 index i{} {{ inject Level{}(v); }}; }}".format(
+                level, level, level - 1
+            )
+        )
+
+    return (
+        "class Nested {{\n"
+        "    {}\n"
+        "    label Spawn {{ inject Level{}(7); stop; }};\n"
+        "}}\n"
+    ).format("\n    ".join(macros), depth)
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument("-s", "--states", type=int, default=2000)
+    aparser.add_argument("depths", type=int, nargs="*")
+    args = aparser.parse_args()
+
+    for depth in args.depths or (50, 100, 200):
+        source = nested_source(depth, args.states)
+
+        def lower():
+            code = zdcode.ZDCode()
+
+            if not code.add(source):
+                sys.exit(1)
+
+        took = best_of(args.repeats, lower)
+        print(
+            "depth {:5}, {} states: {:9.2f} ms".format(depth, args.states, took * 1000)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Times preprocessing and parsing the same sources for several targets.
+
+Usage: python benchmarks/bench_targets.py [-n REPEATS] [FILES...]
+
+Parses all the given files once for every target of the example Zake.ini
+(which only differ in their preprocessor definitions), like a Zake build
+does: once from scratch for every target, and once sharing the line
+programs, included files and parsed declarations between the targets.
+Exits with status 1 if the AST of any file differs between both. Files
+that do not parse for every target are left out; defaults to the example
+actors.
+"""
+import argparse
+import glob
+import io
+import os
+import sys
+
+from _util import best_of
+
+from zdcode import zdlexer
+from zdcode.cache import ASTPickler
+
+EXAMPLE_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "example", "assets", "actors"
+)
+
+TARGETS = {
+    "debug": {"DEBUG": ""},
+    "release": {},
+    "release-foes": {"FOE_REPLACEMENTS": "", "MONSPAWN_LASERGUYS": ""},
+}
+
+
+def forget():
+    zdlexer.line_program.cache_clear()
+    zdlexer.default_include_cache = zdlexer.IncludeCache()
+
+
+def dump(ast):
+    # The AST holds closures, which only compare equal once pickled.
+    data = io.BytesIO()
+    ASTPickler(data).dump(ast)
+    return data.getvalue()
+
+
+def parse_target(sources, defs, declarations):
+    defs = dict(defs)
+    imports = {}
+
+    return [
+        zdlexer.parse_code(
+            code,
+            filename=fname,
+            dirname=dirname,
+            preproc_defs=defs,
+            imports=imports,
+            declarations=declarations,
+        )
+        for code, fname, dirname in sources
+    ]
+
+
+def build(sources, shared):
+    forget()
+    declarations = zdlexer.DeclarationCache()
+    asts = []
+
+    for defs in TARGETS.values():
+        if not shared:
+            forget()
+            declarations = zdlexer.DeclarationCache()
+
+        asts.append(parse_target(sources, defs, declarations))
+
+    return asts, declarations
+
+
+def parses(source):
+    try:
+        for defs in TARGETS.values():
+            parse_target([source], defs, None)
+
+    except (Exception, zdlexer.PreprocessingError, zdlexer.ZDParseError):
+        return False
+
+    return True
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument("files", nargs="*")
+    args = aparser.parse_args()
+
+    sources = []
+
+    for fname in args.files or sorted(glob.glob(os.path.join(EXAMPLE_DIR, "*.zc2"))):
+        with open(fname) as fp:
+            sources.append((fp.read(), os.path.basename(fname), os.path.dirname(fname)))
+
+    sources = [source for source in sources if parses(source)]
+
+    print("{} files, {} targets".format(len(sources), len(TARGETS)))
+
+    results = []
+
+    for name, shared in (("every target", False), ("shared", True)):
+        built = []
+        best = best_of(args.repeats, lambda: built.append(build(sources, shared)))
+        asts, declarations = built[-1]
+        results.append([[dump(ast) for ast in target] for target in asts])
+        print(
+            "{:<14} {:9.2f} ms  ({} declarations reused, {} parsed)".format(
+                name, best * 1000, declarations.reused, declarations.parsed
+            )
+        )
+
+    if results[0] != results[1]:
+        print("The ASTs differ when sharing between targets!")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Times deriving the same templates from many compilation units.
+
+Usage: python benchmarks/bench_templates.py [-n REPEATS] [-f FILES] [-d DERIVATIONS]
+
+The first generated file declares a template; each of FILES more files
+declares a class which derives it DERIVATIONS times, with one of a few
+parameter values. Only the first derivation with every value is lowered;
+the rest reuse its class, even from another unit. Times adding all the
+files, and prints how many derivations were reused.
+"""
+import argparse
+import sys
+
+from _util import best_of
+
+import zdcode
+
+TEMPLATE = """
+class<Health, Speed> Foe {
+    set Health to Health;
+    set Speed to Speed;
+    is SHOOTABLE;
+
+    label Spawn {
+        POSS A 1;
+        Goto See;
+    };
+
+    label See {
+        POSS AABBCCDD 4 A_Chase;
+        if (health > 50) {
+            POSS E 10 A_FaceTarget;
+            sometimes 30 { POSS F 8 A_PosAttack; };
+        };
+        loop;
+    };
+
+    label Death {
+        POSS H 5;
+        POSS I 5 A_Scream;
+        POSS L -1;
+        stop;
+    };
+}
+"""
+
+
+def user_source(n, derivations):
+    spawns = " ".join(
+        "TNT1 A 1 A_SpawnItem(Foe::({}, 8));".format(20 * (1 + d % 5))
+        for d in range(derivations)
+    )
+
+    return "class Spawner_{} {{ label Spawn {{ {} stop; }}; }}".format(n, spawns)
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument("-f", "--files", type=int, default=100)
+    aparser.add_argument("-d", "--derivations", type=int, default=20)
+    args = aparser.parse_args()
+
+    sources = [(TEMPLATE, "foe.zc2", ".")] + [
+        (user_source(n, args.derivations), "spawner{}.zc2".format(n), ".")
+        for n in range(args.files)
+    ]
+    codes = []
+
+    def add():
+        code = zdcode.ZDCode()
+
+        if not code.add_all(sources):
+            sys.exit(1)
+
+        codes.append(code)
+
+    took = best_of(args.repeats, add)
+
+    print(
+        "{} files, {} derivations each: {:9.2f} ms".format(
+            args.files, args.derivations, took * 1000
+        )
+    )
+    print(codes[-1].derivation_summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Checks that both parser backends agree, and times them.
+
+Usage: python benchmarks/compare_backends.py [-n REPEATS] [FILES...]
+
+Defaults to every .zc2 file under example/ and tests/. Each file is preprocessed once,
+then parsed with every backend in zdlexer.parser_backends. The resulting
+ASTs must be identical; for sources that do not parse, the error position
+and the expected tokens must be identical instead. Exits with status 1 if
+any file differs, so that CI can run it; -n 0 skips the timings there.
+"""
+import argparse
+import functools
+import glob
+import os
+import sys
+
+import parsy
+from _util import best_of
+
+from zdcode import zdlexer
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(__file__), "..", "example")
+TESTS_DIR = os.path.join(os.path.dirname(__file__), "..", "tests")
+
+PARSE_FAILURES = ("parse error", "nested too deeply")
+
+
+def normalize(node):
+    """Makes an AST comparable, including the closures built by the parser."""
+    if isinstance(node, (list, tuple)):
+        return (type(node).__name__, tuple(normalize(n) for n in node))
+
+    if isinstance(node, dict):
+        return ("dict", tuple((k, normalize(v)) for k, v in node.items()))
+
+    if isinstance(node, functools.partial):
+        return ("partial", normalize(node.func), normalize(node.args))
+
+    if callable(node) and hasattr(node, "__code__"):
+        cells = tuple(normalize(cell.cell_contents) for cell in node.__closure__ or ())
+        return ("function", node.__qualname__, cells)
+
+    return node
+
+
+def parse_with(code, backend):
+    try:
+        return normalize(zdlexer.parse_source(code, backend))
+
+    except parsy.ParseError as err:
+        return (PARSE_FAILURES[0], err.index, tuple(sorted(err.expected)))
+
+    except RecursionError:
+        return (PARSE_FAILURES[1],)
+
+
+def compare_file(fname, repeats):
+    with open(fname) as fp:
+        postcode = zdlexer.preprocess_code(
+            fp.read(),
+            this_fname=os.path.basename(fname),
+            rel_dir=os.path.dirname(fname),
+        )
+
+    code = postcode.text
+    results = {}
+    timings = []
+
+    for backend in zdlexer.parser_backends:
+        results[backend] = parse_with(code, backend)
+
+        if repeats > 0:
+            took = best_of(repeats, lambda: parse_with(code, backend))
+            timings.append("{} {:8.2f} ms".format(backend, took * 1000))
+
+    reference = results[zdlexer.parser_backends[0]]
+    same = all(res == reference for res in results.values())
+
+    print(
+        "{:<24} {:<5} {:<12} {}".format(
+            os.path.basename(fname),
+            "same" if same else "DIFF",
+            reference[0] if reference[0] in PARSE_FAILURES else "",
+            "  ".join(timings),
+        )
+    )
+
+    return same
+
+
+def main():
+    aparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    aparser.add_argument("-n", "--repeats", type=int, default=3)
+    aparser.add_argument(
+        "files",
+        nargs="*",
+        default=sorted(
+            glob.glob(os.path.join(EXAMPLE_DIR, "**", "*.zc2"), recursive=True)
+        )
+        + sorted(glob.glob(os.path.join(TESTS_DIR, "*.zc2"))),
+    )
+    args = aparser.parse_args()
+
+    differing = [f for f in args.files if not compare_file(f, args.repeats)]
+
+    if differing:
+        print("{} file(s) parse differently.".format(len(differing)))
+        return 1
+
+    print("All {} file(s) parse identically.".format(len(args.files)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
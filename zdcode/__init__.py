@@ -1,8 +1,10 @@
 __VERSION__ = "2.13.3"
 
 import collections
+import collections.abc
 import functools
 import hashlib
+import io
 import itertools
 import queue
 import random
@@ -63,10 +65,38 @@ class TextNode:
         self.lines.append(line)
 
     def __str__(self):
-        return "\n".join(
-            "\n".join("\t" * self.indent + x for x in str(l).split("\n"))
-            for l in self.lines
-        )
+        return "\n".join(self._flat_lines("\t" * self.indent))
+
+    def _flat_lines(self, prefix):
+        # Flattens nested nodes on an explicit stack, rather than by
+        # recursion, since they nest as deep as the states they come from.
+        stack = [(iter(self.lines), prefix)]
+
+        while stack:
+            lines, prefix = stack[-1]
+
+            for l in lines:
+                if not isinstance(l, TextNode):
+                    for x in str(l).split("\n"):
+                        yield prefix + x
+
+                    continue
+
+                sub = l.lines
+
+                if not sub:
+                    yield prefix
+
+                elif len(sub) == 1 and type(sub[0]) is str and "\n" not in sub[0]:
+                    # a single line, like that of most states
+                    yield prefix + "\t" * l.indent + sub[0]
+
+                else:
+                    stack.append((iter(sub), prefix + "\t" * l.indent))
+                    break
+
+            else:
+                stack.pop()
 
     def __len__(self):
         return len(str(self))
@@ -75,10 +105,145 @@ class TextNode:
         return self.lines[ind]
 
     def to_string(self, tab_size=4):
-        return "\n".join(str(l) for l in self.lines).replace("\t", " " * tab_size)
+        out = io.StringIO()
+        self.write(out, tab_size)
+        return out.getvalue()
+
+    def write(self, stream, tab_size=4):
+        """Writes the same text as to_string to the text stream, a batch of
+        lines at a time, instead of building all of it first."""
+        lines = self._flat_lines("")
+        tab = " " * tab_size
+        sep = ""
+
+        while True:
+            batch = list(itertools.islice(lines, 4096))
+
+            if not batch:
+                break
+
+            stream.write(sep + "\n".join(batch).replace("\t", tab))
+            sep = "\n"
+
+
+class LazyTextNode(TextNode):
+    """A TextNode whose lines are only made when it is rendered, from
+    make_lines, and let go of once they are written, so that rendering a
+    large output never holds all of its nodes at once."""
+
+    def __init__(self, make_lines, indent=1):
+        self.make_lines = make_lines
+        self.indent = indent
+
+    @property
+    def lines(self):
+        return list(self.make_lines())
+
+    def add_line(self, line):
+        raise TypeError("LazyTextNode lines cannot be added to")
 
 
 # ZDCode Classes
+class StateList(list):
+    """A list of states.
+
+    The number of states in a block is memoized (see StateContainer), since
+    rendering asks for it at every level of nesting. Every change to a
+    StateList bumps StateList.generation, which invalidates all of those
+    counts at once; they are only reused while nothing changes, like when
+    the DECORATE is being rendered.
+    """
+
+    generation = 0
+
+    @classmethod
+    def changed(cls):
+        cls.generation += 1
+
+    def append(self, item):
+        super().append(item)
+        StateList.changed()
+
+    def extend(self, items):
+        super().extend(items)
+        StateList.changed()
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        StateList.changed()
+
+    def pop(self, index=-1):
+        StateList.changed()
+        return super().pop(index)
+
+    def remove(self, item):
+        super().remove(item)
+        StateList.changed()
+
+    def clear(self):
+        super().clear()
+        StateList.changed()
+
+    def __setitem__(self, index, item):
+        super().__setitem__(index, item)
+        StateList.changed()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        StateList.changed()
+
+    def __iadd__(self, items):
+        StateList.changed()
+        return super().__iadd__(items)
+
+    def __imul__(self, times):
+        StateList.changed()
+        return super().__imul__(times)
+
+
+class StateContainer:
+    """Memoizes the number of states in its block, self.states."""
+
+    _block_count = (-1, 0)
+
+    def num_block_states(self):
+        if self._block_count[0] != StateList.generation:
+            # Counts the blocks nested in this one first, innermost out, on
+            # an explicit stack, so that counting each block only looks one
+            # level down, however deeply the code nests.
+            stack = [(self, False)]
+
+            while stack:
+                container, nested_counted = stack.pop()
+
+                if container._block_count[0] == StateList.generation:
+                    continue
+
+                if nested_counted:
+                    container._block_count = (
+                        StateList.generation,
+                        sum(x.num_states() for x in container.states),
+                    )
+
+                else:
+                    stack.append((container, True))
+                    stack.extend(
+                        (nested, False) for nested in container.nested_blocks()
+                    )
+
+        return self._block_count[1]
+
+    def nested_blocks(self):
+        for state in self.states:
+            if isinstance(state, StateContainer):
+                yield state
+
+                else_block = getattr(state, "else_block", None)
+
+                if else_block is not None:
+                    yield else_block
+
+
 class ZDObject(Protocol):
     def to_decorate(self) -> str:
         ...
@@ -257,7 +422,7 @@ class ZDLabel(object):
         if self.name.startswith("F_"):
             self.name = "_" + self.name
 
-        r = TextNode()
+        r = TextNode(indent=0)
         r.add_line("{}:".format(self.name))
 
         for s in self.states:
@@ -293,7 +458,7 @@ class ZDBaseActor(object):
         self.inherit = inherit
         self.replace = replace
         self.num = doomednum
-        self.id = _id or make_id(30)
+        self.id = _id or code.make_id(30)
 
 
 class ZDActor(ZDBaseActor):
@@ -386,13 +551,19 @@ class ZDActor(ZDBaseActor):
         for rd in self.raw:
             r.add_line(rd)
 
-        for f in self.flags:
+        flags, antiflags = self.flags, self.antiflags
+
+        # sets iterate in a different order on every run
+        if self.code.id_hash is not None:
+            flags, antiflags = sorted(flags), sorted(antiflags)
+
+        for f in flags:
             r.add_line("+{}".format(f))
 
-        for a in self.antiflags:
+        for a in antiflags:
             r.add_line("-{}".format(a))
 
-        if len(r) == 1 and r[0].strip() == "":
+        if len(r.lines) == 1 and r[0].strip() == "":
             return "    "
 
         return r
@@ -404,7 +575,7 @@ class ZDActor(ZDBaseActor):
             r.add_line(decorate(f[1]))
 
         for l in self.labels:
-            r.add_line(decorate(l))
+            r.add_line(l.to_decorate())
 
         return r
 
@@ -471,63 +642,6 @@ class ZDClassTemplate(ZDBaseActor):
         self.parse_data = parse_data
         self.existing = {}
 
-    def duplicate(
-        self,
-        parameter_values,
-        provided_label_names,
-        provided_macro_names,
-        provided_array_names,
-    ):
-        if (
-            self.abstract_macro_names
-            or self.abstract_label_names
-            or self.abstract_array_names
-        ):
-            return False
-
-        return (
-            self.parameter_hash(
-                parameter_values,
-                provided_label_names,
-                provided_macro_names,
-                provided_array_names,
-            )
-            in self.existing
-        )
-
-    def which_duplicate(
-        self,
-        parameter_values,
-        provided_label_names,
-        provided_macro_names,
-        provided_array_names,
-    ):
-        return self.existing[
-            self.parameter_hash(
-                parameter_values,
-                provided_label_names,
-                provided_macro_names,
-                provided_array_names,
-            )
-        ]
-
-    def register(
-        self,
-        parameter_values,
-        provided_label_names,
-        provided_macro_names,
-        provided_array_names,
-        result,
-    ):
-        self.existing[
-            self.parameter_hash(
-                parameter_values,
-                provided_label_names,
-                provided_macro_names,
-                provided_array_names,
-            )
-        ] = result
-
     def parameter_hash(
         self,
         parameter_values,
@@ -548,7 +662,7 @@ class ZDClassTemplate(ZDBaseActor):
             or self.abstract_label_names
             or self.abstract_array_names
         ):
-            hash.update(make_id(80).encode("utf-8"))
+            hash.update(self.code.make_id(80).encode("utf-8"))
 
         else:
             for parm in parameter_values:
@@ -557,7 +671,9 @@ class ZDClassTemplate(ZDBaseActor):
 
             hash.update(b"|")
 
-            for name in itertools.chain(provided_label_names, provided_array_names):
+            for name in itertools.chain(
+                sorted(provided_label_names), sorted(provided_array_names)
+            ):
                 hash.update(name.encode("utf-8"))
                 hash.update(b"-")
 
@@ -570,20 +686,8 @@ class ZDClassTemplate(ZDBaseActor):
 
         return hash.hexdigest()
 
-    def generated_class_name(
-        self,
-        parameter_values,
-        provided_label_names,
-        provided_macro_names,
-        provided_array_names,
-    ):
-        hash = self.parameter_hash(
-            parameter_values,
-            provided_label_names,
-            provided_macro_names,
-            provided_array_names,
-        )
-        return "{}__deriv_{}".format(self.name, hash)
+    def generated_class_name(self, param_hash):
+        return "{}__deriv_{}".format(self.name, param_hash)
 
     def assert_group_exists(
         self, groupname: str, ctx_str: str, context: "ZDCodeParseContext"
@@ -609,30 +713,22 @@ class ZDClassTemplate(ZDBaseActor):
         provided_label_names = set(provided_label_names)
         provided_macro_names = dict(provided_macro_names)
 
-        if self.duplicate(
+        param_hash = self.parameter_hash(
             parameter_values,
             provided_label_names,
             provided_macro_names,
             provided_array_names,
-        ):
-            return False, self.which_duplicate(
-                parameter_values,
-                provided_label_names,
-                provided_macro_names,
-                provided_array_names,
-            )
-
-        new_name = (
-            name
-            if name is not None
-            else self.generated_class_name(
-                parameter_values,
-                provided_label_names,
-                provided_macro_names,
-                provided_array_names,
-            )
         )
 
+        # abstract templates hash a new ID every time instead, so their
+        # derivations are never reused
+        if param_hash in self.existing:
+            self.code.derivations_reused += 1
+            return False, self.existing[param_hash]
+
+        self.code.derivations_lowered += 1
+        new_name = name if name is not None else self.generated_class_name(param_hash)
+
         ctx_str = (
             f"in {name and 'derivation ' + name or 'anonymous derivation'} of {self.name}",
         )
@@ -645,7 +741,9 @@ class ZDClassTemplate(ZDBaseActor):
             self.assert_group_exists(group, ctx_str, context)
             self.code.groups[group].append(stringify(new_name))
 
-        context_new = context.derive("derivation of template {}".format(self.name))
+        context_new = context.derive(
+            "derivation of template {}", desc_args=(self.name,)
+        )
 
         context_new.replacements.update(self.get_init_replacements(parameter_values))
 
@@ -710,13 +808,7 @@ class ZDClassTemplate(ZDBaseActor):
                     )
                 )
 
-        self.register(
-            parameter_values,
-            provided_label_names,
-            provided_macro_names,
-            provided_array_names,
-            res,
-        )
+        self.existing[param_hash] = res
 
         self.code.actor_names[res.name.upper()] = res
         context.add_actor(res)
@@ -729,10 +821,10 @@ class ZDClassTemplate(ZDBaseActor):
         )
 
 
-class ZDBlock:
+class ZDBlock(StateContainer):
     def __init__(self, actor, states=None):
         self._actor = actor
-        self.states: list[ZDStateObject] = states or []
+        self.states: list[ZDStateObject] = StateList(states or ())
 
     def spawn_safe(self):
         return self.states[0].spawn_safe()
@@ -740,8 +832,7 @@ class ZDBlock:
     def clone(self):
         return ZDBlock(self._actor, (s.clone() for s in self.states))
 
-    def num_states(self):
-        return sum(x.num_states() for x in self.states)
+    num_states = StateContainer.num_block_states
 
     def state_containers(self):
         yield self.states
@@ -750,11 +841,11 @@ class ZDBlock:
         return TextNode(x.to_decorate() for x in self.states)
 
 
-class ZDIfStatement(object):
+class ZDIfStatement(StateContainer):
     def __init__(self, actor, condition, states=()):
         self._actor = actor
         self.true_condition = condition
-        self.states: list[ZDStateObject] = list(states)
+        self.states: list[ZDStateObject] = StateList(states)
         self.else_block = None
 
     def spawn_safe(self):
@@ -776,9 +867,7 @@ class ZDIfStatement(object):
 
     def set_else(self, else_block):
         self.else_block = else_block
-
-    def num_block_states(self):
-        return sum(x.num_states() for x in self.states)
+        StateList.changed()
 
     def num_else_states(self):
         return self.else_block.num_states()
@@ -816,11 +905,11 @@ class ZDIfStatement(object):
             )
 
 
-class ZDIfJumpStatement(object):
+class ZDIfJumpStatement(StateContainer):
     def __init__(self, actor, condition_gen, states=()):
         self._actor = actor
         self.true_condition = condition_gen
-        self.states: list[ZDStateObject] = list(states)
+        self.states: list[ZDStateObject] = StateList(states)
         self.else_block = None
 
     def spawn_safe(self):
@@ -840,9 +929,6 @@ class ZDIfJumpStatement(object):
         if self.else_block:
             yield from self.else_block.state_containers()
 
-    def set_else(self, else_block):
-        self.else_block = else_block
-
     @classmethod
     def generate(cls, actor, states=()):
         def _decorator(condition_gen):
@@ -850,8 +936,9 @@ class ZDIfJumpStatement(object):
 
         return _decorator
 
-    def num_block_states(self):
-        return sum(x.num_states() for x in self.states)
+    def set_else(self, else_block):
+        self.else_block = else_block
+        StateList.changed()
 
     def num_else_states(self):
         return self.else_block.num_states()
@@ -890,17 +977,17 @@ class ZDIfJumpStatement(object):
             )
 
 
-class ZDSometimes(object):
+class ZDSometimes(StateContainer):
     def __init__(self, actor, chance, states):
         self._actor = actor
         self.chance = chance
-        self.states: list[ZDStateObject] = states
+        self.states: list[ZDStateObject] = StateList(states)
 
     def clone(self):
         return ZDSometimes(self._actor, self.chance, (s.clone() for s in self.states))
 
     def num_states(self):
-        return sum(x.num_states() for x in self.states) + 2
+        return self.num_block_states() + 2
 
     def state_containers(self):
         yield self.states
@@ -909,7 +996,7 @@ class ZDSometimes(object):
         return False
 
     def to_decorate(self):
-        num_st = sum(x.num_states() for x in self.states)
+        num_st = self.num_block_states()
 
         res = TextNode()
         res.add_line(f"{zerotic} A_Jump(256-(256*({self.chance})/100), {num_st + 1})")
@@ -925,18 +1012,28 @@ class ZDSometimes(object):
 num_whiles = 0
 
 
-class ZDWhileStatement(object):
+def next_while_id(code):
+    # Loops are numbered across every compilation, unless the IDs of code
+    # are deterministic (see ZDCode.make_id), so that they don't depend on
+    # what was compiled before it.
+    global num_whiles
+
+    if code.id_hash is not None:
+        code.num_whiles += 1
+        return code.num_whiles - 1
+
+    num_whiles += 1
+    return num_whiles - 1
+
+
+class ZDWhileStatement(StateContainer):
     def __init__(self, actor, condition, states=()):
         self._actor = actor
         self.true_condition = condition
-        self.states: list[ZDStateObject] = list(states)
+        self.states: list[ZDStateObject] = StateList(states)
         self.else_block = None
 
-        global num_whiles
-
-        self._while_id = num_whiles
-        num_whiles += 1
-
+        self._while_id = next_while_id(actor.code)
         self._loop_id = "_loop_while_" + str(self._while_id)
 
     def clone(self):
@@ -955,9 +1052,7 @@ class ZDWhileStatement(object):
 
     def set_else(self, else_block):
         self.else_block = else_block
-
-    def num_block_states(self):
-        return sum(x.num_states() for x in self.states)
+        StateList.changed()
 
     def num_else_states(self):
         return self.else_block.num_states()
@@ -1002,18 +1097,14 @@ class ZDWhileStatement(object):
             )
 
 
-class ZDWhileJumpStatement(object):
+class ZDWhileJumpStatement(StateContainer):
     def __init__(self, actor, condition_gen, states=()):
         self._actor = actor
         self.true_condition = condition_gen
-        self.states: list[ZDStateObject] = list(states)
+        self.states: list[ZDStateObject] = StateList(states)
         self.else_block = None
 
-        global num_whiles
-
-        self._while_id = num_whiles
-        num_whiles += 1
-
+        self._while_id = next_while_id(actor.code)
         self._loop_id = "_loop_while_" + str(self._while_id)
 
     def clone(self):
@@ -1030,9 +1121,6 @@ class ZDWhileJumpStatement(object):
         if self.else_block:
             yield from self.else_block.state_containers()
 
-    def set_else(self, else_block):
-        self.else_block = else_block
-
     @classmethod
     def generate(cls, actor, states=()):
         def _decorator(condition_gen):
@@ -1040,8 +1128,9 @@ class ZDWhileJumpStatement(object):
 
         return _decorator
 
-    def num_block_states(self):
-        return sum(x.num_states() for x in self.states)
+    def set_else(self, else_block):
+        self.else_block = else_block
+        StateList.changed()
 
     def num_else_states(self):
         return self.else_block.num_states()
@@ -1130,6 +1219,211 @@ class CompilerError(Exception):
     pass
 
 
+class ScopeMap(collections.abc.MutableMapping):
+    """The names visible in a scope: replacements, macros, templates or mods.
+
+    Like a collections.ChainMap, a ScopeMap looks names up in its own layer
+    of names, then in those of the scopes it is nested in (see new_child),
+    and sees their changes. Scopes can nest thousands deep, so lookups are
+    memoized in every scope, instead of walking all of them every time.
+    Only changes to scopes that others look through (shared ones) bump
+    ScopeMap.generation, which invalidates all of those lookups at once;
+    new scopes, like loop bodies, set their own names freely.
+    """
+
+    generation = 0
+
+    def __init__(self, layer=None, parent=None):
+        self.layer = {} if layer is None else layer
+        self.parent = parent
+        self.foreign = () if parent is None else parent.foreign
+        self.shared = False
+        self._memo = {}
+        self._memo_generation = ScopeMap.generation
+
+        if parent is not None:
+            parent.shared = True
+
+    @classmethod
+    def changed(cls):
+        cls.generation += 1
+
+    def new_child(self):
+        return ScopeMap(parent=self)
+
+    def insert(self, other: "ScopeMap"):
+        """Also looks names up in other, after the scopes this one is
+        nested in, but before the outermost one; like inserting other
+        right before the last map of a ChainMap.
+        """
+        other.shared = True
+        self.foreign += (other,)
+        self._changed(None)
+
+    def _changed(self, key):
+        if self.shared:
+            ScopeMap.changed()
+
+        elif key is None:
+            self._memo.clear()
+
+        elif self.parent is None:
+            # the only scope which memoizes its own names
+            self._memo.pop(key, None)
+
+    def __setitem__(self, key, value):
+        self.layer[key] = value
+        self._changed(key)
+
+    def __delitem__(self, key):
+        del self.layer[key]
+        self._changed(key)
+
+    def __getitem__(self, key):
+        if self.parent is not None:
+            layer = self.layer
+
+            if key in layer:
+                return layer[key]
+
+        value = self._lookup(key)
+
+        if value is _MISSING:
+            raise KeyError(key)
+
+        return value
+
+    def get(self, key, default=None):
+        if self.parent is not None:
+            layer = self.layer
+
+            if key in layer:
+                return layer[key]
+
+        value = self._lookup(key)
+
+        return default if value is _MISSING else value
+
+    def __contains__(self, key):
+        if self.parent is not None and key in self.layer:
+            return True
+
+        return self._lookup(key) is not _MISSING
+
+    def _lookup(self, key):
+        # Walks out until a scope that memoized the key, or has it; then
+        # memoizes it in every scope on the way. A scope with foreign
+        # scopes of its own looks up differently from its parent.
+        generation = ScopeMap.generation
+        scope = self
+        path = []
+
+        while True:
+            if scope._memo_generation != generation:
+                scope._memo.clear()
+                scope._memo_generation = generation
+
+            memo = scope._memo
+
+            if key in memo:
+                value = memo[key]
+                break
+
+            path.append(scope)
+            parent = scope.parent
+
+            if parent is None or parent.foreign is not scope.foreign:
+                value = scope._walk(key)
+                break
+
+            if parent.parent is not None and key in parent.layer:
+                value = parent.layer[key]
+                break
+
+            scope = parent
+
+        for scope in path:
+            scope._memo[key] = value
+
+        return value
+
+    def _walk(self, key):
+        scope = self
+
+        while scope.parent is not None:
+            if key in scope.layer:
+                return scope.layer[key]
+
+            scope = scope.parent
+
+        for other in self.foreign:
+            value = other.get(key, _MISSING)
+
+            if value is not _MISSING:
+                return value
+
+        return scope.layer.get(key, _MISSING)
+
+    def maps(self):
+        """The layers and foreign scopes, in lookup order."""
+        res = []
+        scope = self
+
+        while scope.parent is not None:
+            res.append(scope.layer)
+            scope = scope.parent
+
+        res.extend(self.foreign)
+        res.append(scope.layer)
+
+        return res
+
+    def __iter__(self):
+        names = {}
+
+        for mapping in reversed(self.maps()):
+            names.update(dict.fromkeys(mapping))
+
+        return iter(names)
+
+    def __len__(self):
+        return len(set().union(*self.maps()))
+
+    def __repr__(self):
+        return "ScopeMap({})".format(dict(self))
+
+
+_MISSING = object()
+
+
+class ZDCtxDescription:
+    """A description of a ZDCodeParseContext, like "label 'Spawn'", on top
+    of those of the contexts it was derived from.
+
+    Descriptions are only read for error messages, so they are formatted
+    (from desc and args, like str.format) only then; and derived contexts
+    share those of their parent instead of copying them.
+    """
+
+    __slots__ = ("parent", "desc", "args")
+
+    def __init__(self, parent, desc, args=()):
+        self.parent = parent
+        self.desc = desc
+        self.args = args
+
+    def __str__(self):
+        return self.desc.format(*self.args) if self.args else self.desc
+
+    def __iter__(self):
+        # from the innermost description outwards
+        node = self
+
+        while node is not None:
+            yield str(node)
+            node = node.parent
+
+
 class ZDCodeParseContext(object):
     def __init__(
         self,
@@ -1145,26 +1439,21 @@ class ZDCodeParseContext(object):
         loop_ctx=None,
     ):
         self.replacements = (
-            replacements.new_child()
-            if replacements is not None
-            else collections.ChainMap({})
-        )
-        self.macros = (
-            macros.new_child() if macros is not None else collections.ChainMap({})
-        )
-        self.templates = (
-            templates.new_child() if templates is not None else collections.ChainMap({})
+            replacements.new_child() if replacements is not None else ScopeMap()
         )
-        self.mods = mods.new_child() if mods is not None else collections.ChainMap({})
+        self.macros = macros.new_child() if macros is not None else ScopeMap()
+        self.templates = templates.new_child() if templates is not None else ScopeMap()
+        self.mods = mods.new_child() if mods is not None else ScopeMap()
 
         self.always_applied_mods = applied_mods
         self.applied_mods = []
 
         self.actor_lists = list(actors) if actors else []
-        self.desc_stack = []
-        self.states: list[ZDStateObject | ZDCodeParseContext] = []
-        self.remote_children = []
+        self.description = None
+        self.states: list[ZDStateObject | ZDCodeParseContext] = StateList()
+        self.remote_children: list[ZDCodeParseContext] = StateList()
         self.remote_offset = remote_offset
+        self._count = self._remote_count = (-1, 0)
 
         self.break_ctx = self if break_ctx == "self" else break_ctx or self
         self.loop_ctx = self if loop_ctx == "self" else loop_ctx or self
@@ -1172,8 +1461,8 @@ class ZDCodeParseContext(object):
         if description:
             self.add_description(description)
 
-    def add_description(self, desc):
-        self.desc_stack.append(desc)
+    def add_description(self, desc, desc_args=()):
+        self.description = ZDCtxDescription(self.description, desc, desc_args)
 
     def get_applied_mods(self):
         if self.always_applied_mods is None:
@@ -1209,7 +1498,7 @@ class ZDCodeParseContext(object):
 
         _print_top(
             "{} ({}/{})".format(
-                self.desc_stack[-1], self.num_states(), self.remote_num_states()
+                self.description, self.num_states(), self.remote_num_states()
             )
         )
 
@@ -1251,19 +1540,31 @@ class ZDCodeParseContext(object):
                     _print(":")
 
     def num_states(self):
-        return sum(s.num_states() for s in self.states)
+        generation, count = self._count
+
+        if generation != StateList.generation:
+            count = sum(s.num_states() for s in self.states)
+            self._count = (StateList.generation, count)
+
+        return count
 
     def remote_num_states(self):
-        return (
-            self.remote_offset
-            + sum(
-                s.remote_num_states()
-                if isinstance(s, ZDCodeParseContext)
-                else s.num_states()
-                for s in self.states
+        generation, count = self._remote_count
+
+        if generation != StateList.generation:
+            count = (
+                self.remote_offset
+                + sum(
+                    s.remote_num_states()
+                    if isinstance(s, ZDCodeParseContext)
+                    else s.num_states()
+                    for s in self.states
+                )
+                + sum(c.remote_num_states() for c in self.remote_children)
             )
-            + sum(c.remote_num_states() for c in self.remote_children)
-        )
+            self._remote_count = (StateList.generation, count)
+
+        return count
 
     def remote_derive(
         self,
@@ -1271,6 +1572,7 @@ class ZDCodeParseContext(object):
         remote_offset: int = 0,
         break_ctx: "ZDCodeParseContext" | Literal["self"] | None = None,
         loop_ctx: "ZDCodeParseContext" | Literal["self"] | None = None,
+        desc_args: tuple = (),
     ) -> "ZDCodeParseContext":
         # derives without adding to states
         res = ZDCodeParseContext(
@@ -1284,10 +1586,10 @@ class ZDCodeParseContext(object):
             break_ctx=break_ctx or self.break_ctx,
             loop_ctx=loop_ctx or self.loop_ctx,
         )
-        res.desc_stack = list(self.desc_stack)
+        res.description = self.description
 
         if desc:
-            res.desc_stack.append(desc)
+            res.add_description(desc, desc_args)
 
         self.remote_children.append(res)
 
@@ -1298,6 +1600,7 @@ class ZDCodeParseContext(object):
         desc: str | None = None,
         break_ctx: "ZDCodeParseContext" | Literal["self"] | None = None,
         loop_ctx: "ZDCodeParseContext" | Literal["self"] | None = None,
+        desc_args: tuple = (),
     ) -> "ZDCodeParseContext":
         res = ZDCodeParseContext(
             self.replacements,
@@ -1309,10 +1612,10 @@ class ZDCodeParseContext(object):
             break_ctx=break_ctx or self.break_ctx,
             loop_ctx=loop_ctx or self.loop_ctx,
         )
-        res.desc_stack = list(self.desc_stack)
+        res.description = self.description
 
         if desc:
-            res.desc_stack.append(desc)
+            res.add_description(desc, desc_args)
 
         self.states.append(res)
 
@@ -1321,24 +1624,24 @@ class ZDCodeParseContext(object):
     def __repr__(self):
         return "ZDCodeParseContext({})".format(self.repr_describe())
 
-    def desc_block(self, desc: str):
-        return ZDCtxDescBlock(self, desc)
+    def desc_block(self, desc: str, desc_args: tuple = ()):
+        return ZDCtxDescBlock(self, desc, desc_args)
 
     def update(self, other_ctx: "ZDCodeParseContext"):
-        self.macros.maps.insert(-1, other_ctx.macros)
-        self.replacements.maps.insert(-1, other_ctx.replacements)
-        self.templates.maps.insert(-1, other_ctx.templates)
-        self.mods.maps.insert(-1, other_ctx.mods)
+        self.macros.insert(other_ctx.macros)
+        self.replacements.insert(other_ctx.replacements)
+        self.templates.insert(other_ctx.templates)
+        self.mods.insert(other_ctx.mods)
 
     def add_actor(self, ac: ZDActor):
         for al in self.actor_lists:
             al.append(ac)
 
     def describe(self):
-        return " at ".join(self.desc_stack[::-1])
+        return " at ".join(self.description or ())
 
     def repr_describe(self):
-        return ", ".join(self.desc_stack[::-1])
+        return ", ".join(self.description or ())
 
     def resolve(self, name, desc="a parametrizable name"):
         while name[0] == "@":
@@ -1384,15 +1687,17 @@ def pending_task(priority):
 
 
 class ZDCtxDescBlock:
-    def __init__(self, ctx, desc):
+    def __init__(self, ctx, desc, desc_args=()):
         self.ctx = ctx
         self.desc = desc
+        self.desc_args = desc_args
 
     def __enter__(self):
-        self.ctx.desc_stack.append(self.desc)
+        self.ctx.add_description(self.desc, self.desc_args)
 
     def __exit__(self, _1, _2, _3):
-        assert self.ctx.desc_stack.pop() == self.desc
+        assert self.ctx.description.desc == self.desc
+        self.ctx.description = self.ctx.description.parent
 
 
 class ZDModClause:
@@ -1406,31 +1711,68 @@ class ZDModClause:
         clause_ctx = self.context.derive("mod clause")
         clause_ctx.update(ctx)
 
-        res = []
+        # (states, the ones left to go through, the results so far), with
+        # the innermost block last; an explicit stack, since mods are
+        # applied to states nested arbitrarily deep
+        stack = [(target_states, iter(list(target_states)), [])]
 
-        for s in target_states:
-            if self.selector(self.code, clause_ctx, s):
-                alist = [s]
+        while stack:
+            states, remaining, res = stack[-1]
 
-                for eff in self.effects:
-                    nlist = []
+            for s in remaining:
+                if self.selector(self.code, clause_ctx, s):
+                    alist = [s]
 
-                    for a in alist:
-                        l = list(eff(self.code, clause_ctx, a))
-                        nlist.extend(l)
+                    for eff in self.effects:
+                        nlist = []
 
-                    alist = nlist
+                        for a in alist:
+                            l = list(eff(self.code, clause_ctx, a))
+                            nlist.extend(l)
 
-                res.extend(alist)
+                        alist = nlist
+
+                    res.extend(alist)
+
+                else:
+                    res.append(s)
+                    containers = list(s.state_containers())
+
+                    if containers:
+                        # go through the nested blocks first, in order
+                        stack.extend(
+                            (container, iter(list(container)), [])
+                            for container in reversed(containers)
+                        )
+                        break
 
             else:
-                for container in s.state_containers():
-                    self.apply(ctx, container)
+                stack.pop()
+                states.clear()
+                states.extend(res)
+
+
+# The kinds of state whose bodies the rewrites of macro returns, and of
+# loop breaks and continues, carry over to.
+MACRO_REWRITTEN = ("if", "ifjump", "sometimes", "repeat", "while", "whilejump", "for")
+LOOP_REWRITTEN = ("if", "ifjump", "sometimes", "repeat")
 
-                res.append(s)
 
-        target_states.clear()
-        target_states.extend(res)
+def nested_bodies(state):
+    """The bodies of a state of one of the kinds in MACRO_REWRITTEN, some
+    of which may be empty or None.
+    """
+    if state[0] == "repeat":
+        return (state[1][2],)
+
+    if state[0] == "sometimes":
+        return (dict(state[1])["body"],)
+
+    if state[0] == "for":
+        return (state[1][3], state[1][4])
+
+    # if and while statements, and their jump variants
+    return (state[1][1], state[1][2])
 
 
 class ZDCode:
@@ -1446,9 +1788,25 @@ class ZDCode:
         error_handler=None,
         preproc_defs=(),
         debug=False,
+        backend=None,
+        memo=None,
+        cache=None,
+        declarations=None,
+        id_seed=None,
     ):
-        res = cls()
-        success = res.add(code, fname, dirname, error_handler, preproc_defs, debug)
+        res = cls(id_seed)
+        success = res.add(
+            code,
+            fname,
+            dirname,
+            error_handler,
+            preproc_defs,
+            debug,
+            backend,
+            memo,
+            cache,
+            declarations,
+        )
 
         return res if success else None
 
@@ -1460,16 +1818,204 @@ class ZDCode:
         error_handler=None,
         preproc_defs=(),
         debug=False,
+        backend=None,
+        memo=None,
+        cache=None,
+        declarations=None,
     ):
-        data = zdlexer.parse_code(
+        self._hash_sources([(code.strip(" \t\n"), fname, dirname)])
+
+        data = self._parse_code(
+            code,
+            fname,
+            dirname,
+            error_handler,
+            preproc_defs,
+            backend,
+            memo,
+            cache,
+            declarations,
+        )
+
+        return self._add_parsed(data, error_handler, debug)
+
+    def _parse_code(
+        self,
+        code,
+        fname=None,
+        dirname=".",
+        error_handler=None,
+        preproc_defs=(),
+        backend=None,
+        memo=None,
+        cache=None,
+        declarations=None,
+    ):
+        # cache is a zdcode.cache.ParseCache, which reuses the ASTs of
+        # compilation units parsed before; declarations is a
+        # zdlexer.DeclarationCache, which reuses those of unchanged
+        # top-level declarations.
+        parse_code = zdlexer.parse_code if cache is None else cache.parse_code
+
+        return parse_code(
             code.strip(" \t\n"),
             dirname=dirname,
             filename=fname,
             error_handler=error_handler,
             imports=self.includes,
             preproc_defs=preproc_defs,
+            backend=backend,
+            memo=memo,
+            declarations=declarations,
         )
 
+    def add_all(
+        self,
+        sources,
+        error_handler=None,
+        preproc_defs=(),
+        debug=False,
+        backend=None,
+        memo=None,
+        cache=None,
+        jobs=None,
+        declarations=None,
+        units=None,
+    ):
+        """Adds every (code, fname, dirname) source in order, like add,
+        stopping at the first one that fails.
+
+        If jobs is more than 1, the sources are preprocessed and parsed in
+        up to that many processes (see zdcode.parallel), unless they are too
+        few or small to be worth it; the result is the same.
+
+        units is a zdcode.cache.UnitCache: the sources it has parsed
+        before, with the same definitions that they test, are reused, and
+        the rest are stored in it.
+        """
+        sources = [
+            (code.strip(" \t\n"), fname, dirname) for code, fname, dirname in sources
+        ]
+        self._hash_sources(sources)
+        parent = None
+
+        if units is not None:
+            reused = 0
+
+            for source in sources:
+                defs = preproc_defs
+
+                if not isinstance(defs, dict):
+                    defs = dict(defs)
+
+                entry = units.find(parent, source, defs)
+
+                if entry is None:
+                    break
+
+                units.hits += 1
+                reused += 1
+                entry.replay(defs, self.includes)
+                parent = entry
+
+                if not self._add_parsed(entry.new_ast(), error_handler, debug):
+                    return False
+
+            sources = sources[reused:]
+
+        if jobs is not None and jobs > 1 and memo is None:
+            from .parallel import useful_jobs
+
+            jobs = useful_jobs(jobs, sources)
+
+        if jobs is None or jobs <= 1 or memo is not None:
+            for source in sources:
+                code, fname, dirname = source
+                defs = preproc_defs
+
+                if not isinstance(defs, dict):
+                    defs = dict(defs)
+
+                if units is not None:
+                    defs = zdlexer.TrackingDict(defs)
+                    before = set(self.includes)
+
+                data = self._parse_code(
+                    code,
+                    fname,
+                    dirname,
+                    error_handler,
+                    defs,
+                    backend,
+                    memo,
+                    cache,
+                    declarations,
+                )
+
+                if units is not None:
+                    changes = defs.changes()
+                    parent = self._add_unit(
+                        units, parent, source, data, defs.read, changes, before
+                    )
+
+                    if isinstance(preproc_defs, dict):
+                        for key, value in changes.items():
+                            if value is zdlexer.MISSING:
+                                preproc_defs.pop(key, None)
+
+                            else:
+                                preproc_defs[key] = value
+
+                if not self._add_parsed(data, error_handler, debug):
+                    return False
+
+            return True
+
+        from .parallel import ParallelParser
+
+        parser = ParallelParser(jobs, backend, cache)
+        before = set(self.includes)
+
+        for i, parsed in enumerate(parser.parse(sources, preproc_defs, self.includes)):
+            if parsed is None:
+                # Add the rest here, to report the error like add would.
+                return self.add_all(
+                    sources[i:],
+                    error_handler,
+                    preproc_defs,
+                    debug,
+                    backend,
+                    cache=cache,
+                    declarations=declarations,
+                )
+
+            data, consulted, changes = parsed
+
+            if units is not None:
+                parent = self._add_unit(
+                    units, parent, sources[i], data, consulted, changes, before
+                )
+                before = set(self.includes)
+
+            if not self._add_parsed(data, error_handler, debug):
+                return False
+
+        return True
+
+    def _add_unit(self, units, parent, source, data, consulted, changes, before):
+        units.misses += 1
+
+        if not data:
+            return None
+
+        new_imports = {
+            fname: including
+            for fname, including in self.includes.items()
+            if fname not in before
+        }
+        return units.add(parent, source, data, consulted, changes, new_imports)
+
+    def _add_parsed(self, data, error_handler=None, debug=False):
         if data:
             try:
                 self._parse(data, debug=debug)
@@ -1817,86 +2363,89 @@ class ZDCode:
         else:
             return count
 
-    def _mutate_block(self, mut_func, block, *args):
-        return [mut_func(s, *args) for s in block]
+    def _macro_rewrite(self, inj_context):
+        # Rewrites each state in an injected macro, making things
+        # like macro-scope return statements possible.
 
-    def _maybe_mutate_block(self, mut_func, state, *args):
-        state = list(state)
+        def rewrite(state):
+            if hasattr(state, "to_decorate"):
+                return state.clone()
 
-        if state[0] == "ifjump":
-            jump, s_yes, s_no = state[1]
-            state[1] = (
-                jump,
-                self._mutate_block(mut_func, s_yes, *args),
-                s_no and self._mutate_block(mut_func, s_no, *args),
-            )
+            if state[0] == "return":
+                return ("skip", inj_context)
 
-        elif state[0] == "if":
-            cond, s_yes, s_no = state[1]
-            state[1] = (
-                cond,
-                self._mutate_block(mut_func, s_yes, *args),
-                s_no and self._mutate_block(mut_func, s_no, *args),
-            )
+            return state
 
-        elif state[0] == "sometimes":
-            state[1] = dict(state[1])
-            state[1]["body"] = self._mutate_block(mut_func, state[1]["body"], *args)
+        return rewrite, MACRO_REWRITTEN
 
-        elif state[0] == "repeat":
-            cval, xidx, body = state[1]
-            state[1] = (cval, xidx, self._mutate_block(mut_func, body, *args))
+    def _iter_rewrite(self, break_context, loop_context):
+        # Rewrites each state in a loop, making things like
+        # break and continue statements possible.
 
-        return state
+        def rewrite(state):
+            if hasattr(state, "to_decorate"):
+                return state
 
-    def _maybe_mutate_block_or_loop(self, mut_func, state, *args):
-        state = list(state)
+            if state[0] == "continue":
+                return ("skip", loop_context.loop_ctx)
 
-        if state[0] in ("while", "whilejump"):
-            cond, f_body, f_else = state[1]
+            if state[0] == "break":
+                return ("skip", break_context.break_ctx)
 
-            f_body = self._mutate_block(mut_func, f_body, *args)
-            f_else = f_else and self._mutate_block(mut_func, f_else, *args)
+            return state
 
-            state[1] = (cond, f_body, f_else)
+        return rewrite, LOOP_REWRITTEN
 
-        elif state[0] == "for":
-            itername, iteridx, itermode, f_body, f_else = state[1]
+    def _rewrites_body(self, body, rewritten, jumps):
+        """Whether a rewrite which carries over to the bodies of the kinds
+        of state in rewritten would find any of jumps in body ("clone"
+        stands for states lowered already).
 
-            f_body = self._mutate_block(mut_func, f_body, *args)
-            f_else = f_else and self._mutate_block(mut_func, f_else, *args)
+        Most macro and loop bodies have no return, break or continue
+        statement for their rewrite to bind, so it is left out; this is
+        analysed once per body, however many times it is lowered.
+        """
+        key = (id(body), rewritten)
 
-            state[1] = (itername, iteridx, itermode, f_body, f_else)
+        try:
+            return self.rewritten_bodies[key][1]
 
-        return self._maybe_mutate_block(mut_func, state, *args)
+        except KeyError:
+            pass
 
-    def _mutate_macro_state(self, state, inj_context):
-        # Mutates each state in an injected macro, making things
-        # like macro-scope return statements possible.
+        found = False
+        pending = [body]
 
-        if hasattr(state, "to_decorate"):
-            return state.clone()
+        while pending and not found:
+            for state in pending.pop():
+                if hasattr(state, "to_decorate"):
+                    found = "clone" in jumps
 
-        if state[0] == "return":
-            return ("skip", inj_context)
+                elif state[0] in jumps:
+                    found = True
 
-        return self._maybe_mutate_block_or_loop(
-            self._mutate_macro_state, state, inj_context
-        )
+                elif state[0] in rewritten:
+                    pending.extend(filter(None, nested_bodies(state)))
 
-    def _mutate_iter_state(self, state, break_context, loop_context):
-        # Mutates each state in a for loop, making things like
-        # break and continue statements possible.
+                if found:
+                    break
 
-        if state[0] == "continue":
-            return ("skip", loop_context.loop_ctx)
+        # the body is kept, so that its id is not reused
+        self.rewritten_bodies[key] = (body, found)
 
-        if state[0] == "break":
-            return ("skip", break_context.break_ctx)
+        return found
 
-        return self._maybe_mutate_block(
-            self._mutate_iter_state, state, break_context, loop_context
-        )
+    def _macro_rewrites(self, rewrites, inj_context, body):
+        if self._rewrites_body(body, MACRO_REWRITTEN, ("return", "clone")):
+            return rewrites + (self._macro_rewrite(inj_context),)
+
+        return rewrites
+
+    def _iter_rewrites(self, rewrites, break_context, loop_context, body):
+        if self._rewrites_body(body, LOOP_REWRITTEN, ("break", "continue")):
+            return rewrites + (self._iter_rewrite(break_context, loop_context),)
+
+        return rewrites
 
     def _parse_state_modifier(self, context: ZDCodeParseContext, modifier_chars):
         res = []
@@ -1980,6 +2529,32 @@ class ZDCode:
         return label.states
 
     def _parse_state(self, actor, context: ZDCodeParseContext, label, s, func=None):
+        # States nest as deep as the source code does, so nested bodies are
+        # lowered on an explicit stack instead of by recursion. Each
+        # _lower_state generator yields the nested states it needs lowered,
+        # and is resumed once they are, in the order recursive calls would
+        # have run in.
+        stack = [self._lower_state(actor, context, label, s, func, ())]
+
+        while stack:
+            try:
+                nested = next(stack[-1])
+
+            except StopIteration:
+                stack.pop()
+
+            else:
+                stack.append(self._lower_state(*nested))
+
+    def _lower_state(
+        self, actor, context: ZDCodeParseContext, label, s, func, rewrites
+    ):
+        # Rewrites (of macro returns, or loop breaks and continues) apply
+        # to the state, and carry over to the bodies of the kinds of state
+        # they name, as the states in those bodies are lowered.
+        for rewrite, _ in rewrites:
+            s = rewrite(s)
+
         def add_state(s, target=context):
             added = [s]
 
@@ -1995,6 +2570,8 @@ class ZDCode:
             add_state(s)
             return
 
+        rewrites = tuple(r for r in rewrites if s[0] in r[1])
+
         def pop_remote(target=context):
             assert target.remote_children
             target.remote_children.pop()
@@ -2084,20 +2661,18 @@ class ZDCode:
             if count >= 1:
                 for idx in range(count):
                     loop_ctx = break_ctx.derive(
-                        "body #{}".format(idx + 1), loop_ctx="self"
+                        "body #{}", loop_ctx="self", desc_args=(idx + 1,)
                     )
 
                     if xidx:
                         loop_ctx.replacements[xidx.upper()] = str(idx)
 
+                    loop_rewrites = self._iter_rewrites(
+                        rewrites, break_ctx, loop_ctx, body
+                    )
+
                     for a in body:
-                        self._parse_state(
-                            actor,
-                            loop_ctx,
-                            label,
-                            self._mutate_iter_state(a, break_ctx, loop_ctx),
-                            func,
-                        )
+                        yield actor, loop_ctx, label, a, func, loop_rewrites
 
         elif s[0] == "sometimes":
             s = dict(s[1])
@@ -2106,7 +2681,7 @@ class ZDCode:
             sms = ZDSometimes(actor, chance, [])
 
             for a in s["body"]:
-                self._parse_state(actor, context, sms, a, func)
+                yield actor, context, sms, a, func, rewrites
 
             add_state(sms)
 
@@ -2129,7 +2704,7 @@ class ZDCode:
             apply = ZDBlock(actor)
 
             for a in apply_block:
-                self._parse_state(actor, apply_ctx, apply, a, func)
+                yield actor, apply_ctx, apply, a, func, rewrites
 
             add_state(apply)
 
@@ -2138,13 +2713,13 @@ class ZDCode:
             if_ctx = context.remote_derive("if body", 3 if s[1][2] else 2)
 
             for a in s[1][1]:
-                self._parse_state(actor, if_ctx, ifs, a, func)
+                yield actor, if_ctx, ifs, a, func, rewrites
 
             if s[1][2]:
                 elses = ZDBlock(actor)
 
                 for a in s[1][2]:
-                    self._parse_state(actor, if_ctx, elses, a, func)
+                    yield actor, if_ctx, elses, a, func, rewrites
 
                 ifs.set_else(elses)
 
@@ -2164,13 +2739,13 @@ class ZDCode:
             if_ctx = context.remote_derive("ifjump body", 3)
 
             for a in s_yes:
-                self._parse_state(actor, if_ctx, ifs, a, func)
+                yield actor, if_ctx, ifs, a, func, rewrites
 
             if s_no:
                 elses = ZDBlock(actor)
 
                 for a in s_no:
-                    self._parse_state(actor, if_ctx, elses, a, func)
+                    yield actor, if_ctx, elses, a, func, rewrites
 
                 ifs.set_else(elses)
 
@@ -2193,20 +2768,15 @@ class ZDCode:
                 else_ctx = break_ctx.derive("else of whilejump")
 
                 for a in s_no:
-                    self._parse_state(actor, else_ctx, elses, a, func)
+                    yield actor, else_ctx, elses, a, func, rewrites
 
                 whs.set_else(elses)
 
             body_ctx = break_ctx.derive("body of whilejump", loop_ctx="self")
+            body_rewrites = self._iter_rewrites(rewrites, break_ctx, body_ctx, s_yes)
 
             for a in s_yes:
-                self._parse_state(
-                    actor,
-                    body_ctx,
-                    whs,
-                    self._mutate_iter_state(a, break_ctx, body_ctx),
-                    func,
-                )
+                yield actor, body_ctx, whs, a, func, body_rewrites
 
             add_state(whs)
             clear_remotes(break_ctx)
@@ -2222,14 +2792,12 @@ class ZDCode:
             if s[1][2]:
                 elses = ZDBlock(actor)
                 else_ctx = break_ctx.derive("else of while")
+                else_rewrites = self._iter_rewrites(
+                    rewrites, else_ctx, else_ctx, s[1][2]
+                )
+
                 for a in s[1][2]:
-                    self._parse_state(
-                        actor,
-                        else_ctx,
-                        elses,
-                        self._mutate_iter_state(a, else_ctx, else_ctx),
-                        func,
-                    )
+                    yield actor, else_ctx, elses, a, func, else_rewrites
 
                 whs.set_else(elses)
 
@@ -2238,15 +2806,10 @@ class ZDCode:
                 "body of while",
                 loop_ctx="self",
             )
+            body_rewrites = self._iter_rewrites(rewrites, break_ctx, body_ctx, s[1][1])
 
             for a in s[1][1]:
-                self._parse_state(
-                    actor,
-                    body_ctx,
-                    body,
-                    self._mutate_iter_state(a, break_ctx, body_ctx),
-                    func,
-                )
+                yield actor, body_ctx, body, a, func, body_rewrites
 
             whs.states.append(body)
 
@@ -2257,31 +2820,33 @@ class ZDCode:
             itername, iteridx, itermode, f_body, f_else = s[1]
 
             def do_for(iterator):
-                break_ctx = context.derive(f"for {itermode[0]}", break_ctx="self")
+                break_ctx = context.derive(
+                    "for {}", break_ctx="self", desc_args=(itermode[0],)
+                )
 
                 for i, item in enumerate(iterator):
                     iter_ctx = break_ctx.derive(
-                        f"{itermode[0]} loop body #{i + 1}", loop_ctx="self"
+                        "{} loop body #{}",
+                        loop_ctx="self",
+                        desc_args=(itermode[0], i + 1),
                     )
                     iter_ctx.replacements[itername.upper()] = item
 
                     if iteridx:
                         iter_ctx.replacements[iteridx.upper()] = str(i)
 
-                    for si, a in enumerate(f_body):
-                        self._parse_state(
-                            actor,
-                            iter_ctx,
-                            label,
-                            self._mutate_iter_state(a, break_ctx, iter_ctx),
-                            label,
-                        )
+                    iter_rewrites = self._iter_rewrites(
+                        rewrites, break_ctx, iter_ctx, f_body
+                    )
+
+                    for a in f_body:
+                        yield actor, iter_ctx, label, a, label, iter_rewrites
 
             def do_else():
                 else_ctx = context.derive("for-else")
 
                 for a in f_else:
-                    self._parse_state(actor, else_ctx, label, a, label)
+                    yield actor, else_ctx, label, a, label, rewrites
 
             if itermode[0] == "group":
                 group_name = context.resolve(itermode[1], "a parametrized group name")
@@ -2294,10 +2859,10 @@ class ZDCode:
                     )
 
                 elif self.groups[group_name.upper()]:
-                    do_for(iter(self.groups[group_name.upper()]))
+                    yield from do_for(iter(self.groups[group_name.upper()]))
 
                 else:
-                    do_else()
+                    yield from do_else()
 
             elif itermode[0] == "range":
                 rang = itermode[1]
@@ -2306,10 +2871,10 @@ class ZDCode:
                 r_to = rang[0] + self._parse_replaceable_number(rang[1], context)
 
                 if r_to > r_from:
-                    do_for(list(range(r_from, r_to, 1)))
+                    yield from do_for(list(range(r_from, r_to, 1)))
 
                 else:
-                    do_else()
+                    yield from do_else()
 
             else:
                 raise CompilerError(
@@ -2337,24 +2902,24 @@ class ZDCode:
                         )
                     )
 
-                macros = dict(act.context.macros)
+                macro = act.context.macros.get(r_name.upper())
 
             else:
-                macros = dict(context.macros)
+                macro = context.macros.get(r_name.upper())
 
-            if r_name.upper() in macros:
+            if macro is not None:
                 if r_from:
                     new_context = context.derive(
-                        "macro '{}' from {}".format(r_name, act.name)
+                        "macro '{}' from {}", desc_args=(r_name, act.name)
                     )
                     new_context.update(act.context)
                     r_qualname = "{}.{}".format(r_from, r_name)
 
                 else:
-                    new_context = context.derive("macro '{}'".format(r_name))
+                    new_context = context.derive("macro '{}'", desc_args=(r_name,))
                     r_qualname = r_name
 
-                (m_args, m_body) = macros[r_name.upper()]
+                (m_args, m_body) = macro
 
                 if len(m_args) != len(r_args):
                     raise CompilerError(
@@ -2368,14 +2933,10 @@ class ZDCode:
                         rn, context, an
                     )
 
+                macro_rewrites = self._macro_rewrites(rewrites, new_context, m_body)
+
                 for a in m_body:
-                    self._parse_state(
-                        actor,
-                        new_context,
-                        label,
-                        self._mutate_macro_state(a, new_context),
-                        label,
-                    )
+                    yield actor, new_context, label, a, label, macro_rewrites
 
             else:
                 if r_from:
@@ -2561,7 +3122,7 @@ class ZDCode:
             elif btype == "label":
                 label = ZDLabel(actor, bdata["name"])
 
-                with context.desc_block("label '{}'".format(label.name)):
+                with context.desc_block("label '{}'", (label.name,)):
                     for s in bdata["body"]:
                         self._parse_state(actor, context, label, s, None)
 
@@ -2605,7 +3166,7 @@ class ZDCode:
 
             for i, item in enumerate(iterator):
                 iter_ctx = break_ctx.remote_derive(
-                    "for-{} loop body".format(itermode[0]), loop_ctx="self"
+                    "for-{} loop body", loop_ctx="self", desc_args=(itermode[0],)
                 )
                 iter_ctx.replacements[itername.upper()] = item
 
@@ -2653,7 +3214,11 @@ class ZDCode:
     def _parse(self, actors, debug=False):
         parsed_actors = []
 
-        context = ZDCodeParseContext(actors=[parsed_actors], description="global")
+        context = ZDCodeParseContext(
+            actors=[parsed_actors],
+            templates=self.templates,
+            description="global",
+        )
 
         actors = [(context, a) for a in actors]
 
@@ -2838,6 +3403,8 @@ class ZDCode:
         while not pending.empty():
             pending.get_nowait().func()
 
+        self.templates.update(context.templates.layer)
+
         for a in parsed_actors:
             a.prepare_spawn_label()
 
@@ -2851,15 +3418,76 @@ class ZDCode:
 
         # print("(Reordered {} actors)".format(reorders))
 
-    def __init__(self):
+    def __init__(self, id_seed=None):
         self.includes = {}
         self.inventories = []
         self.anonymous_classes = []
         self.actors = []
         self.actor_names = {}
         self.groups = {}
-        self.id = make_id(35)
         self.num_anonym_macros = 0
+        self.rewritten_bodies = {}
+
+        # Templates outlive the compilation unit that declares them, so the
+        # units added after it can derive them too, and reuse the classes
+        # derived before with the same parameters.
+        self.templates = ScopeMap()
+        self.derivations_reused = 0
+        self.derivations_lowered = 0
+
+        # With an id_seed, like the name of the mod, IDs are deterministic
+        # (see make_id), for reproducible builds.
+        self.id_hash = None if id_seed is None else hashlib.shake_256()
+        self.num_ids = 0
+        self.num_whiles = 0
+        self.hashed_sources = False
+
+        if self.id_hash is not None:
+            self.id_hash.update(id_seed.encode("utf-8") + b"\0")
+
+        self.id = self.make_id(35)
+
+    def derivation_summary(self):
+        total = self.derivations_reused + self.derivations_lowered
+
+        return "Template derivations: {} reused, {} lowered ({:.1%} reused).".format(
+            self.derivations_reused,
+            self.derivations_lowered,
+            self.derivations_reused / total if total else 0,
+        )
+
+    def make_id(self, length=30):
+        """Returns a new ID, for names that must not clash with those of
+        other mods compiled separately.
+
+        IDs are random, unless the ZDCode has an ID seed. Then they are
+        derived from the seed, the sources added before, and the number of
+        IDs made before, so that the same sources always compile to the
+        same output; mods with different seeds or sources still get
+        different IDs.
+        """
+        if self.id_hash is None:
+            return make_id(length)
+
+        self.num_ids += 1
+
+        hash = self.id_hash.copy()
+        hash.update(b"#%d" % self.num_ids)
+
+        return hash.hexdigest((length + 1) // 2)[:length]
+
+    def _hash_sources(self, sources):
+        if self.id_hash is None:
+            return
+
+        for code, fname, _ in sources:
+            self.id_hash.update("{}\0{}\0".format(fname, code).encode("utf-8"))
+
+        # The ID of the whole compilation, which names anonymous classes
+        # and macros, depends on the first sources added.
+        if not self.hashed_sources:
+            self.hashed_sources = True
+            self.id = self.make_id(35)
 
     def reorder_inherits(self) -> int:
         new_order: list[ZDActor] = []
@@ -2893,43 +3521,14 @@ class ZDCode:
                 res.add_line(i.to_decorate())
 
         for a in self.actors:
-            res.add_line(a.to_decorate())
+            res.add_line(LazyTextNode(lambda a=a: [a.to_decorate()], 0))
 
         return res
 
-    def decorate(self):
-        return decorate(self)
-
-    def decorate(self):
-        return decorate(self)
+    def write_decorate(self, stream, indent=4):
+        """Writes the compiled DECORATE to the text stream, like a file or
+        sys.stdout, as it is rendered."""
+        self.to_decorate().write(stream, indent)
 
     def decorate(self):
         return decorate(self)
-        return decorate(self)
-
-    def decorate(self):
-        return decorate(self)
-
-    def decorate(self):
-        return decorate(self)
-        return decorate(self)
-
-    def decorate(self):
-        return decorate(self)
-
-    def decorate(self):
-        return decorate(self)
-        return decorate(self)
-
-    def decorate(self):
-        return decorate(self)
-
-    def decorate(self):
-        return decorate(self)
-        return decorate(self)
-        return decorate(self)
-        return decorate(self)
-        return decorate(self)
-        return decorate(self)
-        return decorate(self)
-        return decorate(self)
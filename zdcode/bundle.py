@@ -11,7 +11,9 @@ from collections import deque
 
 import attr
 
-from . import ZDCode
+from . import ZDCode, zdlexer
+from .cache import ParseCache, UnitCache
+from .depfile import write_depfile
 
 
 @functools.total_ordering
@@ -64,24 +66,52 @@ class BundleInputWalker:
     bundle: "Bundle" = attr.ib()
     deps: list[tuple[pathlib.Path, pathlib.PurePath]] = attr.ib(factory=list)
     bundled: set[str] = attr.ib(factory=set)
-    build_tasks: list[typing.Callable[[], bool]] = attr.ib(factory=list)
+    zdcode_lumps: list[pathlib.Path] = attr.ib(factory=list)
     error_handler: typing.Optional[
         typing.Callable[[ZDCode.ZDCodeError], None]
     ] = attr.ib(default=None)
     preproc_defs: dict[str, str] = attr.ib(factory=dict)
     collected: typing.Deque[tuple[str, str, bytes]] = attr.ib(factory=list)
+    cache: typing.Optional[ParseCache] = attr.ib(default=None)
+    jobs: typing.Optional[int] = attr.ib(default=None)
+    declarations: typing.Optional[zdlexer.DeclarationCache] = attr.ib(default=None)
+    units: typing.Optional[UnitCache] = attr.ib(default=None)
+
+    # if set, files are stored with a fixed date, so that the same inputs
+    # make the same outputs (see ZDCode.make_id for the DECORATE)
+    deterministic: bool = attr.ib(default=False)
+
+    # every file read from the inputs, and every archive (but not the files
+    # extracted from it), for dependency files
+    dependencies: set[str] = attr.ib(factory=set)
+    extracting: int = attr.ib(default=0)
 
     @classmethod
-    def new(self, bundle, error_handler=None, preproc_defs=None) -> "BundleInputWalker":
+    def new(
+        self,
+        bundle,
+        error_handler=None,
+        preproc_defs=None,
+        cache=None,
+        jobs=None,
+        declarations=None,
+        units=None,
+        id_seed=None,
+    ) -> "BundleInputWalker":
         return BundleInputWalker(
             bundled=set(),
             deps=[],
-            code=ZDCode(),
-            build_tasks=[],
+            code=ZDCode(id_seed),
+            zdcode_lumps=[],
             error_handler=error_handler,
             preproc_defs=preproc_defs or {},
             bundle=bundle,
             collected=deque(),
+            cache=cache,
+            jobs=jobs,
+            declarations=declarations,
+            units=units,
+            deterministic=id_seed is not None,
         )
 
     def add_dep(self, url: pathlib.Path, target: pathlib.PurePath) -> None:
@@ -93,16 +123,46 @@ class BundleInputWalker:
             self.scan_dep(mod, target)
 
     def build(self) -> typing.Optional[tuple[int, str]]:
-        while self.build_tasks:
-            task = self.build_tasks.pop()
-
-            if not task():
-                return (
-                    1,
-                    "Errors were found during the compilation of the ZDCode lumps!",
-                )
-
-        self.collect(pathlib.PurePath("DECORATE"), self.code.decorate().encode("utf-8"))
+        sources = []
+
+        while self.zdcode_lumps:
+            zdc = self.zdcode_lumps.pop()
+            sources.append((zdc.read_text(), zdc.name, zdc.parent))
+
+        if self.units is not None:
+            # the DECORATE of another target, which tested the same
+            # definitions
+            decorate, imports = self.units.output(sources, self.preproc_defs)
+
+            if decorate is not None:
+                self.units.hits += len(sources)
+                self.units.reused_outputs += 1
+                self.code.includes.update(imports)
+                self.collect(pathlib.PurePath("DECORATE"), decorate.encode("utf-8"))
+                return None
+
+        preproc_defs = dict(self.preproc_defs)
+
+        if not self.code.add_all(
+            sources,
+            self.error_handler,
+            preproc_defs=self.preproc_defs,
+            cache=self.cache,
+            jobs=self.jobs,
+            declarations=self.declarations,
+            units=self.units,
+        ):
+            return (
+                1,
+                "Errors were found during the compilation of the ZDCode lumps!",
+            )
+
+        decorate = self.code.decorate()
+
+        if self.units is not None:
+            self.units.store_output(sources, preproc_defs, decorate)
+
+        self.collect(pathlib.PurePath("DECORATE"), decorate.encode("utf-8"))
 
         return None
 
@@ -121,7 +181,14 @@ class BundleInputWalker:
             num += 1
             out_path = target + "." + str(num)
 
-        out_zip.writestr(out_path, data)
+        if self.deterministic:
+            info = zipfile.ZipInfo(out_path, date_time=(1980, 1, 1, 0, 0, 0))
+            info.compress_type = out_zip.compression
+            info.external_attr = 0o600 << 16
+            out_zip.writestr(info, data)
+
+        else:
+            out_zip.writestr(out_path, data)
 
     def assemble(self):
         zips: dict[str, zipfile.ZipFile] = {}
@@ -166,13 +233,22 @@ class BundleInputWalker:
             with zipfile.ZipFile(url) as zipped:
                 zipped.extractall(extractdest)
 
-            self.scan_dep_dir(extractdest, target, relative)
+            self.extracting += 1
+
+            try:
+                self.scan_dep_dir(extractdest, target, relative)
+
+            finally:
+                self.extracting -= 1
 
     def scan_dep_file(
         self, url: pathlib.Path, target: pathlib.PurePath, relative: pathlib.PurePath
     ):
+        if not self.extracting:
+            self.dependencies.add(str(url))
+
         if url.stem.split(".")[0].upper() == "ZDCODE":
-            self.build_tasks.append(self._compile_task(url))
+            self.zdcode_lumps.append(url)
 
         if url.suffix.upper() in (".PK3", ".PKZ", ".ZIP"):
             self.scan_dep_zip(url, target, relative)
@@ -187,23 +263,11 @@ class BundleInputWalker:
         if output:
             self.collected.append((str(out_path), output.name.lower(), data))
 
-    def _compile_task(self, zdc):
-        def compile_mod_zdcode():
-            with zdc.open() as zdc_fp:
-                return self.code.add(
-                    zdc_fp.read(),
-                    zdc.name,
-                    zdc.parent,
-                    self.error_handler,
-                    preproc_defs=self.preproc_defs,
-                )
-
-        return compile_mod_zdcode
-
     def scan_dep_dir(
         self, url: pathlib.Path, target: pathlib.PurePath, relative: pathlib.PurePath
     ):
-        for filepath in url.rglob("*"):
+        # sorted, since the ZDCode lumps are compiled in the order found
+        for filepath in sorted(url.rglob("*")):
             if filepath.is_file() and filepath.name != "DEPINDEX":
                 self.scan_dep_file(
                     filepath, target / filepath.parent.relative_to(url), relative
@@ -263,11 +327,23 @@ class Bundle:
         self,
         error_handler=None,
         preproc_defs=(),
+        cache=None,
+        jobs=None,
+        depfile=None,
+        declarations=None,
+        units=None,
+        id_seed=None,
+        stats=False,
     ):
         walker = BundleInputWalker.new(
             error_handler=error_handler or self.error_handler,
             preproc_defs=dict(preproc_defs),
             bundle=self,
+            cache=cache,
+            jobs=jobs,
+            declarations=declarations,
+            units=units,
+            id_seed=id_seed,
         )
 
         for mod, modtarg in self.mods:
@@ -284,6 +360,9 @@ class Bundle:
         if err:
             return err
 
+        if stats and walker.code.derivations_reused + walker.code.derivations_lowered:
+            print(walker.code.derivation_summary())
+
         # count files bundled
         print("Collected {} files.".format(len(walker.collected)))
 
@@ -291,4 +370,11 @@ class Bundle:
         print("Assembling...")
         walker.assemble()
 
+        if depfile:
+            write_depfile(
+                depfile,
+                [out.output for out in self.outputs.values()],
+                walker.dependencies | set(walker.code.includes),
+            )
+
         return (0, "Success!")
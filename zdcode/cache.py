@@ -0,0 +1,332 @@
+"""Persistent, on-disk cache of parsed compilation units.
+
+Preprocessing and parsing are most of the time spent compiling ZDCode,
+and build setups such as Zake compile the same, mostly unchanged sources
+over and over (once per target, and again on every rebuild). A ParseCache
+keeps the AST of each compilation unit on disk, keyed by a hash of its
+source text, the preprocessor definitions and includes it starts out with,
+and the parser itself.
+
+Each entry also records what the unit #include'd: the glob patterns, the
+files they matched, and the hash of every file read. An entry is only
+used while all of those are unchanged, so editing an included file, or
+adding one that matches an include pattern, is a cache miss.
+"""
+import copy
+import glob
+import hashlib
+import io
+import os
+import pickle
+import types
+
+from . import __VERSION__, zdlexer
+
+default_directory = ".zdcode-cache"
+
+# Bumped whenever the layout of the cache entries changes.
+format_version = 2
+
+
+def file_hash(fname):
+    with open(fname, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+_parser_hash = None
+
+
+def parser_hash():
+    """Hashes the parser's own source, so that changing the grammar (or the
+    AST it builds) does not reuse stale entries."""
+    global _parser_hash
+
+    if _parser_hash is None:
+        from . import rdparser
+
+        digest = hashlib.sha256(
+            "{} {}".format(__VERSION__, format_version).encode("utf-8")
+        )
+
+        for module in (zdlexer, rdparser):
+            with open(module.__file__, "rb") as fp:
+                digest.update(fp.read())
+
+        _parser_hash = digest.hexdigest()
+
+    return _parser_hash
+
+
+class ASTPickler(pickle.Pickler):
+    # The parser puts closures in the AST (state selectors and modifier
+    # effects); those are pickled as a call to the factory that made them.
+    def reducer_override(self, obj):
+        if isinstance(obj, types.FunctionType) and hasattr(obj, "factory_call"):
+            factory, arg = obj.factory_call
+            return factory, (arg,)
+
+        return NotImplemented
+
+
+class ParseCache:
+    def __init__(self, directory=default_directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+        # Units that miss the cache are usually edits of units parsed
+        # before, so their unchanged declarations are reused.
+        self.declarations = zdlexer.DeclarationCache()
+
+    def key(self, code, filename, dirname, preproc_defs, imports):
+        digest = hashlib.sha256(parser_hash().encode("utf-8"))
+
+        for part in (
+            code,
+            repr(filename),
+            os.path.abspath(dirname),
+            repr(sorted(dict(preproc_defs).items())),
+            repr(sorted(dict(imports).items())),
+        ):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def load(self, key):
+        """Returns the entry stored under key, if any, and if none of the
+        files it was parsed from changed since."""
+        try:
+            with open(self.entry_path(key), "rb") as fp:
+                entry = pickle.load(fp)
+
+        except Exception:
+            # Missing, corrupt or unreadable entries are just misses.
+            return None
+
+        for pattern, matches in entry["globs"].items():
+            if glob.glob(pattern) != matches:
+                return None
+
+        for fname, digest in entry["files"].items():
+            try:
+                if file_hash(fname) != digest:
+                    return None
+
+            except OSError:
+                return None
+
+        return entry
+
+    def store(self, key, entry):
+        os.makedirs(self.directory, exist_ok=True)
+
+        data = io.BytesIO()
+        ASTPickler(data, pickle.HIGHEST_PROTOCOL).dump(entry)
+
+        # Write to a temporary file first, so that concurrent builds never
+        # read half-written entries.
+        path = self.entry_path(key)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+
+        with open(temp_path, "wb") as fp:
+            fp.write(data.getvalue())
+
+        os.replace(temp_path, path)
+
+    def parse_code(
+        self,
+        code,
+        filename=None,
+        dirname=".",
+        error_handler=None,
+        preproc_defs=(),
+        imports=(),
+        backend=None,
+        memo=None,
+        declarations=None,
+    ):
+        """Like zdlexer.parse_code, but reuses the cached AST when possible.
+
+        The preprocessor adds to preproc_defs and imports when they are
+        dicts (definitions and included files carry over to the next
+        compilation units), so a cache hit replays those changes too.
+        """
+        key = self.key(code, filename, dirname, preproc_defs, imports)
+        entry = self.load(key)
+
+        if entry is not None:
+            self.hits += 1
+            self.replay(entry, preproc_defs, imports)
+            return entry["ast"]
+
+        self.misses += 1
+
+        defs = zdlexer.TrackingDict(preproc_defs)
+        all_imports = dict(imports)
+        include_globs = {}
+
+        data = zdlexer.parse_code(
+            code,
+            filename=filename,
+            dirname=dirname,
+            error_handler=error_handler,
+            preproc_defs=defs,
+            imports=all_imports,
+            backend=backend,
+            memo=memo,
+            include_globs=include_globs,
+            declarations=self.declarations if declarations is None else declarations,
+        )
+
+        new_imports = {k: v for k, v in all_imports.items() if k not in imports}
+        entry = {
+            "ast": data,
+            "consulted": defs.read,
+            "defs": defs.changes(),
+            "imports": new_imports,
+            "globs": include_globs,
+            "files": {fname: file_hash(fname) for fname in new_imports},
+        }
+        self.replay(entry, preproc_defs, imports)
+
+        if data:
+            self.store(key, entry)
+
+        return data
+
+    def replay(self, entry, preproc_defs, imports):
+        if isinstance(preproc_defs, dict):
+            # Looks up what the unit tested, and makes the changes it made
+            # one by one, for callers that track them (see UnitCache).
+            for key in entry["consulted"]:
+                preproc_defs.get(key)
+
+            for key, value in entry["defs"].items():
+                if value is zdlexer.MISSING:
+                    preproc_defs.pop(key, None)
+
+                else:
+                    preproc_defs[key] = value
+
+        if isinstance(imports, dict):
+            imports.update(entry["imports"])
+
+
+class UnitEntry:
+    def __init__(self, parent, ast, consulted, changes, imports):
+        self.parent = parent
+        # the compiler is free to change the AST it is given, so the entry
+        # keeps a copy of its own, and hands out copies of that
+        self.ast = copy.deepcopy(ast)
+        self.consulted = consulted
+        self.changes = changes
+        self.imports = imports
+        self.stamps = {fname: zdlexer.file_stamp(fname) for fname in imports}
+
+    def new_ast(self):
+        return copy.deepcopy(self.ast)
+
+    def matches(self, preproc_defs):
+        for key, value in self.consulted.items():
+            if preproc_defs.get(key, zdlexer.MISSING) != value:
+                return False
+
+        for fname, stamp in self.stamps.items():
+            try:
+                if zdlexer.file_stamp(fname) != stamp:
+                    return False
+
+            except OSError:
+                return False
+
+        return True
+
+    def replay(self, preproc_defs, imports):
+        for key, value in self.changes.items():
+            if value is zdlexer.MISSING:
+                preproc_defs.pop(key, None)
+
+            else:
+                preproc_defs[key] = value
+
+        imports.update(self.imports)
+
+
+class UnitCache:
+    """Keeps the ASTs of compilation units in memory, between the targets of
+    a build, along with the definitions each of them tested.
+
+    Preprocessing a unit only depends on those of the definitions it
+    tests, and on the state the units before it left: the files they
+    included, and the definitions they made. So a unit is reused for any
+    target whose definitions agree on the ones it tested, as long as the
+    units before it were reused from the same entries (every entry is
+    stored under the one before it). When all the units of a target are
+    reused, so is the DECORATE compiled from them.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.outputs = {}
+        self.hits = 0
+        self.misses = 0
+        self.reused_outputs = 0
+
+    def find(self, parent, source, preproc_defs):
+        for entry in self.entries.get((parent, source), ()):
+            if entry.matches(preproc_defs):
+                return entry
+
+        return None
+
+    def add(self, parent, source, ast, consulted, changes, new_imports):
+        """Stores the AST of source, parsed right after the unit of parent,
+        with the definitions it tested, and the changes it made to them
+        and to the imports."""
+        entry = UnitEntry(parent, ast, consulted, changes, new_imports)
+        self.entries.setdefault((parent, source), []).append(entry)
+        return entry
+
+    def last(self, sources, preproc_defs):
+        """The entry of the last of sources, if all of them can be reused
+        with preproc_defs, along with the imports they made."""
+        defs = dict(preproc_defs)
+        imports = {}
+        entry = None
+
+        for code, fname, dirname in sources:
+            entry = self.find(entry, (code.strip(" \t\n"), fname, dirname), defs)
+
+            if entry is None:
+                return None, None
+
+            entry.replay(defs, imports)
+
+        return entry, imports
+
+    def output(self, sources, preproc_defs):
+        """The DECORATE compiled from sources before, and the imports they
+        made, if all of them can be reused with preproc_defs."""
+        entry, imports = self.last(sources, preproc_defs)
+
+        if entry is None or entry not in self.outputs:
+            return None, None
+
+        return self.outputs[entry], imports
+
+    def store_output(self, sources, preproc_defs, decorate):
+        """Keeps the DECORATE compiled from sources, which were all just
+        added with preproc_defs."""
+        entry, _ = self.last(sources, preproc_defs)
+
+        if entry is not None:
+            self.outputs[entry] = decorate
+
+    def summary(self):
+        return "Compilation units: {} reused, {} parsed; {} outputs reused.".format(
+            self.hits, self.misses, self.reused_outputs
+        )
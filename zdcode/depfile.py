@@ -0,0 +1,36 @@
+"""Makefile-style dependency files.
+
+A dependency file lists the files an output was built from, in the
+syntax make (and ninja's depfile support) reads, so that an outer build
+system can skip running ZDCode entirely while none of them changed.
+"""
+import os
+import typing
+
+
+def escape(path: str) -> str:
+    return path.replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+
+def format_depfile(targets: typing.Iterable[str], deps: typing.Iterable[str]) -> str:
+    """The rule making every one of targets depend on every one of deps.
+
+    Every dependency also gets an empty rule of its own, so that make does
+    not stop with an error when one of them is deleted (like gcc -MP).
+    """
+    deps = sorted({os.path.normpath(str(dep)) for dep in deps})
+    rule = " ".join(escape(os.path.normpath(str(target))) for target in targets)
+    lines = [rule + ":" + "".join(" \\\n  " + escape(dep) for dep in deps)]
+
+    for dep in deps:
+        lines.append("")
+        lines.append(escape(dep) + ":")
+
+    return "\n".join(lines) + "\n"
+
+
+def write_depfile(
+    filename: str, targets: typing.Iterable[str], deps: typing.Iterable[str]
+):
+    with open(filename, "w") as fp:
+        fp.write(format_depfile(targets, deps))
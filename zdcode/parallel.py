@@ -0,0 +1,201 @@
+"""Preprocesses and parses many compilation units at once, in a pool of
+worker processes.
+
+Parsing a compilation unit only depends on its source, and on the
+preprocessor state it starts out with: the definitions, and the files that
+were already included (which are not included again). Since the
+preprocessor carries that state over from one unit to the next, every unit
+is parsed speculatively, from the state known when it was sent to the
+pool. The results are then taken in the original order, and whenever a unit
+turns out to have tested a definition or an import which the units before
+it have since changed (say, because one of them #define'd something), that
+unit alone is parsed again from the right state.
+
+Units that fail to parse are left to the caller, which parses them again
+in its own process, so that errors are reported exactly as they would be
+without the pool.
+
+Starting the pool takes a while (every worker imports zdcode), so small
+builds are better off parsed in one process; see useful_jobs.
+"""
+import io
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from . import zdlexer
+from .cache import ASTPickler, ParseCache
+
+_worker_caches: dict[str, ParseCache] = {}
+
+# below this many characters of source in all, starting the pool takes
+# longer than it saves
+min_parallel_size = 256 * 1024
+
+
+def useful_jobs(jobs, units):
+    """Returns how many processes are worth parsing the (code, filename,
+    dirname) units in: no more than there are units or CPUs, and 1 if
+    they are too small to make up for starting the pool at all.
+    """
+    if sum(len(code) for code, _, _ in units) < min_parallel_size:
+        return 1
+
+    return min(jobs, len(units), os.cpu_count() or 1)
+
+
+def still_reads(mapping, read):
+    """Whether every key in read, as recorded by a zdlexer.TrackingDict,
+    still has the same value (or absence) in mapping."""
+    return all(
+        mapping.get(key, zdlexer.MISSING) == value for key, value in read.items()
+    )
+
+
+def parse_unit(code, filename, dirname, preproc_defs, imports, backend, cache_dir):
+    """Runs in the worker processes.
+
+    Returns, pickled, the AST along with the definitions it tested, the
+    changes it made to them, the imports that parsing it added, and the
+    ones it tested, or None if the unit does not parse, and the number of
+    ParseCache hits and misses.
+    """
+    defs = zdlexer.TrackingDict(preproc_defs)
+    all_imports = zdlexer.TrackingDict(imports)
+    parse_code = zdlexer.parse_code
+    cache = None
+    hits = misses = 0
+
+    if cache_dir is not None:
+        cache = _worker_caches.get(cache_dir)
+
+        if cache is None:
+            cache = _worker_caches[cache_dir] = ParseCache(cache_dir)
+
+        hits, misses = cache.hits, cache.misses
+        parse_code = cache.parse_code
+
+    try:
+        data = parse_code(
+            code,
+            filename=filename,
+            dirname=dirname,
+            preproc_defs=defs,
+            imports=all_imports,
+            backend=backend,
+        )
+
+    except (Exception, zdlexer.PreprocessingError, zdlexer.ZDParseError):
+        result = None
+
+    else:
+        result = (
+            data,
+            defs.read,
+            defs.changes(),
+            all_imports.changes(),
+            all_imports.read,
+        )
+
+    if cache is not None:
+        counts = (cache.hits - hits, cache.misses - misses)
+
+    else:
+        counts = (0, 0)
+
+    out = io.BytesIO()
+    ASTPickler(out, pickle.HIGHEST_PROTOCOL).dump((result, counts))
+    return out.getvalue()
+
+
+class ParallelParser:
+    def __init__(self, jobs=None, backend=None, cache=None):
+        self.jobs = jobs
+        self.backend = backend
+        self.cache = cache
+
+        # how many units had to be parsed again, from the right state
+        self.reparsed = 0
+
+    def parse(self, units, preproc_defs, imports):
+        """Parses every (code, filename, dirname) unit, and yields their
+        ASTs in order, along with the definitions each tested and the
+        changes it made to them, updating preproc_defs and imports as
+        parsing them one after another would.
+
+        Yields None for a unit that did not parse, in which case
+        preproc_defs and imports are left as they were before it.
+        """
+        units = list(units)
+        cache_dir = None if self.cache is None else self.cache.directory
+
+        # the definitions every unit starts out with; they only carry over
+        # from one unit to the next in a dict, which is updated
+        defs = preproc_defs if isinstance(preproc_defs, dict) else dict(preproc_defs)
+
+        with ProcessPoolExecutor(self.jobs) as pool:
+
+            def submit(i):
+                state = (dict(defs), dict(imports))
+                code, filename, dirname = units[i]
+                future = pool.submit(
+                    parse_unit,
+                    code,
+                    filename,
+                    dirname,
+                    state[0],
+                    state[1],
+                    self.backend,
+                    cache_dir,
+                )
+                return state, future
+
+            pending = [submit(i) for i in range(len(units))]
+
+            for i in range(len(units)):
+                while True:
+                    state, future = pending[i]
+                    result, (hits, misses) = pickle.loads(future.result())
+
+                    if self.cache is not None:
+                        self.cache.hits += hits
+                        self.cache.misses += misses
+
+                    if result is None:
+                        stale = state != (defs, imports)
+
+                    else:
+                        stale = not (
+                            still_reads(defs, result[1])
+                            and still_reads(imports, result[4])
+                        )
+
+                    if not stale:
+                        break
+
+                    # Started from a state which differs in what the unit
+                    # tests; the units after it are checked in turn.
+                    self.reparsed += 1
+                    pending[i] = submit(i)
+
+                if result is None:
+                    for _, later in pending[i + 1 :]:
+                        later.cancel()
+
+                    yield None
+                    return
+
+                data, consulted, changes, new_imports, _ = result
+
+                if defs is preproc_defs:
+                    for key, value in changes.items():
+                        if value is zdlexer.MISSING:
+                            defs.pop(key, None)
+
+                        else:
+                            defs[key] = value
+
+                if isinstance(imports, dict):
+                    imports.update(new_imports)
+
+                yield data, consulted, changes
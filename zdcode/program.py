@@ -5,6 +5,8 @@ import sys
 import zdcode
 import zdcode.zake as zake
 from zdcode.bundle import Bundle
+from zdcode.cache import ParseCache, default_directory
+from zdcode.depfile import write_depfile
 
 
 def print_parse_error(e):
@@ -22,9 +24,9 @@ def from_stdin():
         print("No data to use! Provide as stdin or as arguments.")
         sys.exit(1)
 
-    print(
-        zdcode.ZDCode.parse("\n".join(data), error_handler=print_parse_error).decorate()
-    )
+    code = zdcode.ZDCode.parse("\n".join(data), error_handler=print_parse_error)
+    code.write_decorate(sys.stdout)
+    print()
 
 
 class TupleTrue(argparse.Action):
@@ -98,6 +100,80 @@ def arg_parser():
         default=None,
         help="output plain text file from with compiled DECORATE",
     )
+    aparser.add_argument(
+        "--parser",
+        type=str,
+        choices=zdcode.zdlexer.parser_backends,
+        dest="parser",
+        required=False,
+        default=None,
+        help="parser backend to use (default: {})".format(
+            zdcode.zdlexer.default_backend
+        ),
+    )
+    aparser.add_argument(
+        "--packrat",
+        type=bool,
+        nargs="?",
+        dest="packrat",
+        required=False,
+        default=False,
+        const=True,
+        help="memoizes grammar rules while parsing, and prints the cache hits of every rule (only with --parser parsy)",
+    )
+    aparser.add_argument(
+        "--cache",
+        type=str,
+        nargs="?",
+        metavar="DIR",
+        dest="cache",
+        required=False,
+        default=None,
+        const=default_directory,
+        help="reuses the parsed ASTs of unchanged sources, stored in DIR (default: {})".format(
+            default_directory
+        ),
+    )
+    aparser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        nargs="?",
+        metavar="N",
+        dest="jobs",
+        required=False,
+        default=None,
+        const=os.cpu_count(),
+        help="preprocesses and parses the input files in up to N processes, if they are large enough to be worth it (default: one per CPU; not used with --packrat)",
+    )
+    aparser.add_argument(
+        "--depfile",
+        type=str,
+        metavar="DEPFILE",
+        dest="depfile",
+        required=False,
+        default=None,
+        help="writes a Makefile-style dependency file, listing the input files and every file they included, for the output file",
+    )
+    aparser.add_argument(
+        "--id-seed",
+        type=str,
+        metavar="SEED",
+        dest="id_seed",
+        required=False,
+        default=None,
+        help="derives the IDs that keep the names of separately compiled mods apart from SEED (like the name of the mod) and the sources, instead of randomly, so that the same sources always compile to the same output",
+    )
+    aparser.add_argument(
+        "--stats",
+        type=bool,
+        nargs="?",
+        dest="stats",
+        required=False,
+        default=False,
+        const=True,
+        help="prints how many template derivations were reused",
+    )
     aparser.set_defaults(func=do_compile)
 
     return aparser
@@ -120,22 +196,51 @@ def main_zake():
 
 
 def do_compile(args):
-    code = zdcode.ZDCode()
+    if args.packrat and (args.parser or zdcode.zdlexer.default_backend) != "parsy":
+        print("--packrat only works with the parsy parser backend (--parser parsy).")
+        return 2
+
+    code = zdcode.ZDCode(args.id_seed)
 
     preproc_defs = dict(args.prepdefs or [])
+    memo = zdcode.zdlexer.PackratMemo() if args.packrat else None
+    cache = ParseCache(args.cache) if args.cache else None
+
+    sources = [
+        (fp.read(), os.path.basename(fp.name), os.path.dirname(fp.name))
+        for fp in args.input
+    ]
+
+    if not code.add_all(
+        sources,
+        preproc_defs=preproc_defs,
+        error_handler=print_parse_error,
+        debug=args.print_ast,
+        backend=args.parser,
+        memo=memo,
+        cache=cache,
+        jobs=args.jobs,
+    ):
+        # Compilation error found - it was already printed.
+        return 1
+
+    if cache is not None:
+        print("Parse cache: {} hits, {} misses.".format(cache.hits, cache.misses))
+
+    if args.stats and code.derivations_reused + code.derivations_lowered:
+        print(code.derivation_summary())
+
+    if memo is not None:
+        print("Packrat cache hits per rule:")
+        print(memo.summary())
+
+    code.write_decorate(args.out_compile)
+
+    if args.depfile:
+        write_depfile(
+            args.depfile,
+            [args.out_compile.name],
+            [fp.name for fp in args.input] + list(code.includes),
+        )
 
-    for fp in args.input:
-        if not code.add(
-            fp.read(),
-            os.path.basename(fp.name),
-            os.path.dirname(fp.name),
-            preproc_defs=preproc_defs,
-            error_handler=print_parse_error,
-            debug=args.print_ast,
-        ):
-            # Compilation error found - it was already printed.
-            return 1
-
-    dec = code.decorate()
-    args.out_compile.write(dec)
     print("Output compiled successfully.")
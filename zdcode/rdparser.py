@@ -0,0 +1,2675 @@
+"""Hand-written recursive-descent backend for the ZDCode grammar.
+
+This parses the same language as the combinator grammar in zdlexer, and
+produces the exact same AST shapes, so that ZDCode._parse cannot tell the
+two backends apart. It is selected by passing backend="rd" to
+zdlexer.parse_postcode (or parse_code, or ZDCode.add), or with the --parser
+command line option.
+
+ZDCode's grammar is scannerless (sprite frames, goto targets and labels
+all have their own lexical rules), so the parser works on character
+offsets. The whitespace runs are found up front, with a single regex, so
+that skipping whitespace, which is by far the most frequent operation of
+the grammar, takes constant time.
+
+Every rule is a method that takes a character offset and returns either
+a (new offset, value) tuple, or None on failure. Failures are recorded the
+same way parsy records them (the furthest offset reached, and what was
+expected there), including the effect of .desc(), so that errors point at
+the same place and expect the same things with both backends.
+
+Statements nest arbitrarily deep (if, while, repeat, apply, ...), so the
+rules that make up a state body are generators instead: rather than
+calling a nested rule, they yield it (with its arguments) and receive its
+result. RDParser.run drives them on an explicit stack, so that parsing
+deeply nested code does not need a deep Python stack.
+"""
+import re
+import types
+
+import parsy
+
+from . import zdlexer
+
+space_re = re.compile(r"\s+")
+
+string_body_1_re = re.compile(r'[^"\\]+')
+string_body_2_re = re.compile(r"[^\'\\]+")
+string_esc_u_re = re.compile(r"u[0-9a-fA-F]{4}")
+string_esc_x_re = re.compile(r"x[0-9a-fA-F]{2}")
+number_re = re.compile(r"[\+\-]?\d+(.\d+)?(e[\+\-]?\d+)?")
+number_hex_re = re.compile(r"0x[0-9A-Fa-f]+")
+number_bin_re = re.compile(r"0b[01]+")
+ident_re = re.compile(r"[a-zA-Z_][a-zA-Z_0-9]*")
+modifier_part_re = re.compile(r'[a-zA-Z0-9\'\",\w"]+')
+group_name_re = re.compile(r"[a-zA-Z0-9_]+")
+p_group_name_re = re.compile(r"\@*[a-zA-Z0-9_]+")
+variable_name_re = re.compile(r"[a-zA-Z_\$][a-zA-Z0-9_\$\[\]]*")
+integer_re = re.compile(r"\-?\d+")
+operator_re = re.compile(r"[\+\-\|\>\<\~\&\!\=\*\/\%\[\]]+")
+argument_sep_re = re.compile(r",\s*")
+flag_name_re = re.compile(r"[a-zA-Z0-9_\.]+")
+derivation_macro_name_re = re.compile(r"[a-zA-Z\_][a-zA-Z\_0-9]*")
+derivation_property_name_re = re.compile(r"[a-zA-Z0-9\_\.]+")
+property_name_re = re.compile(r"[a-zA-Z0-9_\.]+")
+label_name_re = re.compile(r"[a-zA-Z\_\-]+")
+user_var_name_re = re.compile(r"user_[a-zA-Z0-9_]+")
+var_type_re = re.compile(r"[a-zA-Z_.][a-zA-Z0-9_]+")
+mod_name_re = re.compile(r"[a-zA-Z_-][a-zA-Z_0-9-]+")
+combo_name_re = re.compile(r"[a-zA-Z0-9_]+")
+abstract_name_re = re.compile(r"[a-zA-Z_]+")
+sprite_re = re.compile(r"[A-Z0-9_]{4}")
+frame_re = re.compile(r"[A-Z_.\#]")
+macro_ref_re = re.compile(r"\@*[a-zA-Z_][a-zA-Z_0-9]*")
+goto_target_re = re.compile(r"[a-zA-Z0-9\_\-\:\.]+\s?(?:\+\d+)?")
+superclass_name_re = re.compile(r"[a-zA-Z][a-zA-Z0-9_]+")
+replaced_name_re = re.compile(r"[a-zA-Z0-9_]+")
+class_number_re = re.compile(r"[0-9]+")
+digits_re = re.compile(r"\d+")
+
+
+class RDParser:
+    def __init__(self, code):
+        self.code = code
+        self.length = len(code)
+
+        # Upper-casing only keeps offsets if every character maps to
+        # exactly one character; otherwise compare slice by slice, like
+        # parsy does.
+        upper = code.upper()
+        self.upper = upper if len(upper) == len(code) else None
+
+        self.furthest = -1
+        self.expected = frozenset()
+
+        # offset -> end of the whitespace run the offset is in (0 if none)
+        self.space_end = [0] * (len(code) + 1)
+
+        for m in space_re.finditer(code):
+            start, end = m.span()
+            self.space_end[start:end] = [end] * (end - start)
+
+    # Failure bookkeeping
+
+    def fail(self, index, expected):
+        if index > self.furthest:
+            self.furthest = index
+            self.expected = frozenset((expected,))
+
+        elif index == self.furthest and expected not in self.expected:
+            self.expected = self.expected | {expected}
+
+        return None
+
+    def merge(self, result):
+        if result.furthest > self.furthest:
+            self.furthest = result.furthest
+            self.expected = result.expected
+
+        elif result.furthest == self.furthest:
+            self.expected = self.expected | result.expected
+
+    def run(self, rule, *args):
+        # Drives a generator rule. Every (rule, *args) it yields is called,
+        # and, if that is a generator rule too, pushed on the stack instead
+        # of being recursed into; the result is sent back to the caller.
+        stack = [rule(*args)]
+        value = None
+
+        while stack:
+            try:
+                call = stack[-1].send(value)
+
+            except StopIteration as stop:
+                stack.pop()
+                value = stop.value
+                continue
+
+            value = call[0](*call[1:])
+
+            if isinstance(value, types.GeneratorType):
+                stack.append(value)
+                value = None
+
+        return value
+
+    def described(self, rule, index, description, *args):
+        # Equivalent to parsy's .desc(): a failure inside the rule is
+        # reported as the description, at the offset the rule started at.
+        saved = self.furthest, self.expected
+        res = rule(index, *args)
+
+        if res is None:
+            self.furthest, self.expected = saved
+            self.fail(index, description)
+
+        return res
+
+    # Terminals
+
+    def s(self, index, lit):
+        if self.code.startswith(lit, index):
+            return index + len(lit)
+
+        return self.fail(index, lit)
+
+    def ist(self, index, lit):
+        if self.upper is not None:
+            matched = self.upper.startswith(lit.upper(), index)
+
+        else:
+            matched = self.code[index : index + len(lit)].upper() == lit.upper()
+
+        if matched:
+            return index + len(lit)
+
+        return self.fail(index, lit)
+
+    def ist_desc(self, index, lit, description):
+        saved = self.furthest, self.expected
+
+        if self.ist(index, lit) is None:
+            self.furthest, self.expected = saved
+            return self.fail(index, description)
+
+        return index + len(lit)
+
+    def rx(self, index, regex):
+        m = regex.match(self.code, index)
+
+        if m is None:
+            return self.fail(index, regex.pattern)
+
+        return m
+
+    def rx_desc(self, index, regex, description):
+        m = regex.match(self.code, index)
+
+        if m is None:
+            return self.fail(index, description)
+
+        return m
+
+    def ws(self, index):
+        end = self.space_end[index]
+
+        if not end:
+            return self.fail(index, "whitespace")
+
+        return end
+
+    def wo(self, index):
+        end = self.space_end[index]
+
+        if not end:
+            self.fail(index, "whitespace")
+            return index
+
+        return end
+
+    def ws_after(self, index, lit):
+        # (ist(lit) << whitespace)
+        index = self.ist(index, lit)
+
+        if index is None:
+            return None
+
+        return self.ws(index)
+
+    def any_ist(self, index, *lits):
+        for lit in lits:
+            res = self.ist(index, lit)
+
+            if res is not None:
+                return res
+
+        return None
+
+    def inheritance_keyword(self, index):
+        return self.any_ist(index, "inherits", "extends", "expands")
+
+    def optional_semicolon(self, index):
+        res = self.s(index, ";")
+        return index if res is None else res
+
+    # Literals
+
+    def string_esc(self, index):
+        index = self.s(index, "\\")
+
+        if index is None:
+            return None
+
+        for lit in ("\\", "/", '"'):
+            res = self.s(index, lit)
+
+            if res is not None:
+                return res, lit
+
+        res = self.s(index, "t")
+
+        if res is not None:
+            return res, "\t"
+
+        for regex in (string_esc_u_re, string_esc_x_re):
+            m = self.rx(index, regex)
+
+            if m is not None:
+                return m.end(), chr(int(m.group()[1:], 16))
+
+        return None
+
+    def string_literal(self, index):
+        for delim, body_re in (('"', string_body_1_re), ("'", string_body_2_re)):
+            pos = self.s(index, delim)
+
+            if pos is None:
+                continue
+
+            parts = []
+
+            while True:
+                m = self.rx(pos, body_re)
+
+                if m is not None:
+                    parts.append(m.group())
+                    pos = m.end()
+                    continue
+
+                res = self.string_esc(pos)
+
+                if res is None:
+                    break
+
+                pos, part = res
+                parts.append(part)
+
+            pos = self.s(pos, delim)
+
+            if pos is not None:
+                return pos, "".join(parts)
+
+        return None
+
+    def number_lit(self, index):
+        m = self.rx(index, number_re)
+
+        if m is not None:
+            return m.end(), ("number", m.group())
+
+        for regex in (number_hex_re, number_bin_re):
+            m = self.rx(index, regex)
+
+            if m is not None:
+                return m.end(), ("number", int(m.group()))
+
+        return None
+
+    def variable_name(self, index):
+        m = self.rx(index, variable_name_re)
+
+        if m is None:
+            return None
+
+        return m.end(), m.group()
+
+    def replaceable_number(self, index):
+        m = self.rx(index, integer_re)
+
+        if m is not None:
+            return m.end(), m.group()
+
+        return self.variable_name(index)
+
+    def format_string_item(self, index):
+        res = self.string_literal(index)
+
+        if res is not None:
+            return res[0], ("str", res[1])
+
+        res = self.numeric_eval(index)
+
+        if res is not None:
+            return res[0], ("eval", res[1])
+
+        res = self.variable_name(index)
+
+        if res is not None:
+            return res[0], ("fmt", res[1])
+
+        return None
+
+    def format_string_literal(self, index):
+        index = self.ist(index, "f")
+
+        if index is None:
+            return None
+
+        index = self.s(self.wo(index), "{")
+
+        if index is None:
+            return None
+
+        index, items = self.sep_by_wo(self.wo(index), self.format_string_item)
+        index = self.s(self.wo(index), "}")
+
+        if index is None:
+            return None
+
+        return index, items
+
+    def formattable_classname(self, index):
+        res = self.format_string_literal(index)
+
+        if res is not None:
+            return res[0], ("format", res[1])
+
+        m = self.rx(index, group_name_re)
+
+        if m is not None:
+            return m.end(), ("string", m.group())
+
+        return None
+
+    def numeric_eval(self, index):
+        index = self.ist(index, "e")
+
+        if index is None:
+            return None
+
+        index = self.s(self.wo(index), "{")
+
+        if index is None:
+            return None
+
+        res = zdlexer._eval_climb(self.code, index, 0)
+
+        if not res.status:
+            self.merge(res)
+            return None
+
+        index = self.s(zdlexer.eval_ws_re.match(self.code, res.index).end(), "}")
+
+        if index is None:
+            return None
+
+        return index, res.value
+
+    # Repetition helpers
+
+    def many(self, index, rule, *args):
+        values = []
+
+        while True:
+            res = rule(index, *args)
+
+            if res is None:
+                return index, values
+
+            index, value = res
+            values.append(value)
+
+    def sep_by_wo(self, index, rule):
+        # rule.sep_by(wo)
+        res = rule(index)
+
+        if res is None:
+            return index, []
+
+        index, value = res
+        values = [value]
+
+        while True:
+            res = rule(self.wo(index))
+
+            if res is None:
+                return index, values
+
+            index, value = res
+            values.append(value)
+
+    def sep_by_comma(self, index, rule):
+        # rule.sep_by(s(",") >> wo), or rule.sep_by(s(",") << wo)
+        res = rule(index)
+
+        if res is None:
+            return index, []
+
+        index, value = res
+        values = [value]
+
+        while True:
+            pos = self.s(index, ",")
+
+            if pos is None:
+                return index, values
+
+            res = rule(self.wo(pos))
+
+            if res is None:
+                return index, values
+
+            index, value = res
+            values.append(value)
+
+    # State modifiers
+
+    def state_modifier_item(self, index):
+        pos = self.s(index, "{")
+
+        if pos is not None:
+            m = self.rx_desc(pos, ident_re, "modifier parameter name")
+
+            if m is not None:
+                pos = self.s(m.end(), "}")
+
+                if pos is not None:
+                    return pos, ("replace", m.group())
+
+        pos = self.ist(index, "(")
+
+        if pos is not None:
+            pos, inner = self.state_modifier_name(pos)
+            pos = self.ist(pos, ")")
+
+            if pos is not None:
+                return pos, (
+                    "recurse",
+                    [("part", "("), ("recurse", inner), ("part", ")")],
+                )
+
+        m = self.rx(index, modifier_part_re)
+
+        if m is not None:
+            return m.end(), ("part", m.group())
+
+        return None
+
+    def state_modifier_name(self, index):
+        return self.many(index, self.state_modifier_item)
+
+    def modifier(self, index):
+        index = self.s(index, "[")
+
+        if index is None:
+            return None
+
+        index, name = self.state_modifier_name(index)
+        index = self.s(index, "]")
+
+        if index is None:
+            return None
+
+        return index, name
+
+    # Expressions
+
+    def literal(self, index):
+        res = self.described(self.call_literal, index, "call")
+
+        if res is not None:
+            return res[0], ("call expr", res[1])
+
+        res = self.format_string_literal(index)
+
+        if res is not None:
+            return res[0], ("format string", res[1])
+
+        res = self.numeric_eval(index)
+
+        if res is not None:
+            return res[0], ("eval", res[1])
+
+        res = self.described(self.string_literal, index, "string")
+
+        if res is not None:
+            return res[0], ("string", res[1])
+
+        m = self.rx_desc(index, variable_name_re, "actor variable")
+
+        if m is not None:
+            return m.end(), ("actor variable", m.group())
+
+        return self.described(self.number_lit, index, "number")
+
+    def paren_expr(self, index):
+        index = self.s(index, "(")
+
+        if index is None:
+            return None
+
+        index, expr = self.expression(index)
+        index = self.s(index, ")")
+
+        if index is None:
+            return None
+
+        return index, expr
+
+    def expression_item(self, index):
+        res = self.described(self.paren_expr, index, "parenthetic expression")
+
+        if res is not None:
+            return res[0], ("paren expr", res[1])
+
+        res = self.literal(index)
+
+        if res is not None:
+            return res[0], ("literal", res[1])
+
+        m = self.rx_desc(index, operator_re, "operator")
+
+        if m is not None:
+            return m.end(), ("operator", m.group())
+
+        return None
+
+    def expression(self, index):
+        # Never fails; the empty expression is valid.
+        index, items = self.sep_by_wo(self.wo(index), self.expression_item)
+        return self.wo(index), ("expr", items)
+
+    def parameter(self, index):
+        res = self.anonymous_class(index)
+
+        if res is not None:
+            return res
+
+        res = self.anonymous_macro(index)
+
+        if res is not None:
+            return res
+
+        res = self.templated_class_derivation(index)
+
+        if res is not None:
+            return res
+
+        index, expr = self.expression(index)
+        return index, ("expression", expr)
+
+    def arg_expression(self, index):
+        index, param = self.parameter(index)
+        return index, ("position arg", param)
+
+    def expr_argument_list(self, index):
+        return self.sep_by_comma(index, self.arg_expression)
+
+    def parameter_list(self, index):
+        return self.sep_by_comma(index, self.parameter)
+
+    def macro_argument_list(self, index, description="macro argument name"):
+        index = self.wo(index)
+        m = self.rx_desc(index, ident_re, description)
+        names = []
+
+        while m is not None:
+            names.append(m.group())
+            index = m.end()
+
+            sep = self.rx(index, argument_sep_re)
+
+            if sep is None:
+                break
+
+            m = self.rx_desc(sep.end(), ident_re, description)
+
+        return self.wo(index), names
+
+    def call_literal(self, index):
+        m = self.rx_desc(index, ident_re, "called expression function name")
+
+        if m is None:
+            return None
+
+        index = self.s(self.wo(m.end()), "(")
+
+        if index is None:
+            return None
+
+        index, args = self.expr_argument_list(self.wo(index))
+        index = self.s(self.wo(index), ")")
+
+        if index is None:
+            return None
+
+        return index, [m.group(), args]
+
+    def state_call(self, index):
+        m = self.rx_desc(index, ident_re, "called state function name")
+
+        if m is None:
+            return None
+
+        index = self.wo(m.end())
+        args = None
+        pos = self.s(index, "(")
+
+        if pos is not None:
+            pos, arglist = self.expr_argument_list(self.wo(pos))
+            pos = self.s(self.wo(pos), ")")
+
+            if pos is not None:
+                index, args = pos, arglist
+
+        return index, [m.group(), args]
+
+    # Classes
+
+    def superclass(self, index):
+        res = self.templated_class_derivation(index)
+
+        if res is not None:
+            return res
+
+        m = self.rx(index, superclass_name_re)
+
+        if m is not None:
+            return m.end(), ("classname", m.group())
+
+        return None
+
+    def described_superclass(self, index):
+        return self.described(self.superclass, index, "inherited class")
+
+    def group_clause(self, index):
+        # ((ist("group") << whitespace) >> group_name << whitespace)
+        index = self.ws_after(index, "group")
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, group_name_re, "group name")
+
+        if m is None:
+            return None
+
+        index = self.ws(m.end())
+
+        if index is None:
+            return None
+
+        return index, m.group()
+
+    def optional_group_clause(self, index):
+        res = self.group_clause(index)
+
+        if res is None:
+            return index, None
+
+        return res[0], res[1] or None
+
+    def args_clause(self, index):
+        # (wo >> s("(") >> macro_argument_list << s(")") << wo)
+        index = self.s(self.wo(index), "(")
+
+        if index is None:
+            return None
+
+        index, args = self.macro_argument_list(index)
+        index = self.s(index, ")")
+
+        if index is None:
+            return None
+
+        return self.wo(index), args
+
+    def optional_args_clause(self, index):
+        res = self.args_clause(index)
+
+        if res is None:
+            return index, []
+
+        return res[0], res[1] or []
+
+    def macro_body(self, index, name_re):
+        # seq(name, args, state_body).map(dict), after 'macro' and whitespace
+        m = self.rx_desc(index, name_re, "macro name")
+
+        if m is None:
+            return None
+
+        index, args = self.optional_args_clause(m.end())
+        res = self.run_state_body(index)
+
+        if res is None:
+            return None
+
+        return res[0], {"name": m.group(), "args": args, "body": res[1]}
+
+    def property_value(self, index):
+        return self.sep_by_comma(index, self.parameter)
+
+    def property_assignment(self, index):
+        # ((whitespace >> ist("to") << whitespace) | (wo >> s("=") << wo))
+        pos = self.ws(index)
+
+        if pos is not None:
+            pos = self.ist(pos, "to")
+
+            if pos is not None:
+                pos = self.ws(pos)
+
+                if pos is not None:
+                    return pos
+
+        pos = self.s(self.wo(index), "=")
+
+        if pos is not None:
+            return self.wo(pos)
+
+        return None
+
+    def property_body(self, index, name_re):
+        index = self.described(self.ws_after, index, "'set' keyword", "set")
+
+        if index is None:
+            return None
+
+        m = self.rx(index, name_re)
+
+        if m is None:
+            return None
+
+        index = self.described(self.property_assignment, m.end(), "'to' or equal sign")
+
+        if index is None:
+            return None
+
+        index, value = self.property_value(index)
+        return index, {"name": m.group(), "value": value}
+
+    def flag_body(self, index, lit, sign):
+        # ((ist(lit) << whitespace) | string(sign)) >> flag name
+        pos = self.ws_after(index, lit)
+
+        if pos is None:
+            pos = self.s(index, sign)
+
+            if pos is None:
+                return None
+
+        m = self.rx_desc(pos, flag_name_re, "flag name")
+
+        if m is None:
+            return None
+
+        return m.end(), m.group()
+
+    def var_type(self, index):
+        index = self.s(self.wo(index), ":")
+
+        if index is None:
+            return None
+
+        m = self.rx(self.wo(index), var_type_re)
+
+        if m is None:
+            return None
+
+        return m.end(), m.group()
+
+    def optional_var_type(self, index):
+        res = self.described(self.var_type, index, "var type")
+
+        if res is None:
+            return index, "int"
+
+        return res[0], res[1] or "int"
+
+    def var_size(self, index):
+        index = self.s(self.wo(index), "[")
+
+        if index is None:
+            return None
+
+        res = self.replaceable_number(index)
+
+        if res is None:
+            return None
+
+        index = self.s(res[0], "]")
+
+        if index is None:
+            return None
+
+        return index, res[1]
+
+    def user_var(self, index, described_size):
+        index = self.ws_after(index, "var")
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, user_var_name_re, "var name")
+
+        if m is None:
+            return None
+
+        if described_size:
+            res = self.described(self.var_size, m.end(), "array size")
+
+        else:
+            res = self.var_size(m.end())
+
+        if res is None:
+            index, size = m.end(), None
+
+        else:
+            index, size = res
+
+        index, vtype = self.optional_var_type(index)
+        return index, {"name": m.group(), "size": int(size or 0), "type": vtype}
+
+    def label(self, index):
+        index = self.any_ist(index, "label", "state")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, label_name_re, "label name")
+
+        if m is None:
+            return None
+
+        res = self.run_state_body(m.end())
+
+        if res is None:
+            return None
+
+        return self.wo(res[0]), {"name": m.group(), "body": res[1]}
+
+    def override_array(self, index):
+        index = self.ws_after(index, "array")
+
+        if index is None:
+            return None
+
+        return index, dict("array")
+
+    def derivation_item(self, index):
+        res = self.flag_body(index, "is", "+")
+
+        if res is not None:
+            return res[0], ("flag", res[1])
+
+        res = self.flag_body(index, "isn't", "-")
+
+        if res is not None:
+            return res[0], ("unflag", res[1])
+
+        pos = self.ws_after(index, "macro")
+
+        if pos is not None:
+            res = self.macro_body(pos, derivation_macro_name_re)
+
+            if res is not None:
+                return res[0], ("macro", res[1])
+
+        res = self.property_body(index, derivation_property_name_re)
+
+        if res is not None:
+            return res[0], ("property", res[1])
+
+        res = self.described(self.label, index, "override label")
+
+        if res is not None:
+            return res[0], ("label", res[1])
+
+        res = self.user_var(index, False)
+
+        if res is not None:
+            return res[0], ("user var", res[1])
+
+        res = self.described(self.override_array, index, "override array")
+
+        if res is not None:
+            return res[0], ("array", res[1])
+
+        res = self.mod_block(index)
+
+        if res is not None:
+            return res[0], ("mod", res[1])
+
+        return None
+
+    def derivation_body(self, index):
+        index = self.s(self.wo(index), "{")
+
+        if index is None:
+            return None
+
+        items = []
+
+        while True:
+            res = self.derivation_item(self.wo(index))
+
+            if res is None:
+                break
+
+            index = self.wo(self.optional_semicolon(self.wo(res[0])))
+            items.append(res[1])
+
+        index = self.s(index, "}")
+
+        if index is None:
+            return None
+
+        return index, items
+
+    def templated_class_derivation(self, index):
+        m = self.rx_desc(index, ident_re, "name of templated class")
+
+        if m is None:
+            return None
+
+        index = self.wo(m.end())
+        pos = self.s(index, "::()")
+
+        if pos is not None:
+            index, params = pos, []
+
+        else:
+            pos = self.s(index, "::(")
+
+            if pos is None:
+                return None
+
+            pos, params = self.parameter_list(self.wo(pos))
+            index = self.s(self.wo(pos), ")")
+
+            if index is None:
+                return None
+
+        inheritance = None
+        pos = self.ws(index)
+
+        if pos is not None:
+            pos = self.inheritance_keyword(pos)
+
+            if pos is not None:
+                pos = self.ws(pos)
+
+                if pos is not None:
+                    res = self.described_superclass(pos)
+
+                    if res is not None:
+                        index, inheritance = res
+
+        index, group = self.optional_group_clause(index)
+
+        res = self.derivation_body(index)
+
+        if res is None:
+            body = []
+
+        else:
+            index, body = res
+            body = body or []
+
+        return index, (
+            "template derivation",
+            [
+                m.group(),
+                params,
+                ("inheritance", inheritance),
+                ("group", group),
+                body,
+            ],
+        )
+
+    def anonymous_inheritance(self, index):
+        index = self.described(
+            self.inheritance_keyword, index, "inheritance declaration"
+        )
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        return self.superclass(index)
+
+    def anonymous_group(self, index):
+        index = self.described(self.ws_after, index, "group keyword", "group")
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, group_name_re, "group name")
+
+        if m is None:
+            return None
+
+        return m.end(), m.group()
+
+    def anonymous_class_body(self, index):
+        index = self.ist(index, "{")
+
+        if index is None:
+            return None
+
+        index, body = self.many(self.wo(index), self.class_body)
+        index = self.ist(self.wo(index), "}")
+
+        if index is None:
+            return None
+
+        return self.wo(index), body
+
+    def anonymous_class(self, index):
+        index = self.described(self.any_ist, index, "class statement", "actor", "class")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        res = self.described(self.anonymous_inheritance, index, "inherited class name")
+        inheritance = None
+
+        if res is not None:
+            index, inheritance = res
+
+        index = self.wo(index)
+
+        res = self.anonymous_group(index)
+        group = None
+
+        if res is not None:
+            index, group = res[0], res[1] or None
+
+        res = self.anonymous_class_body(index)
+        body = []
+
+        if res is not None:
+            index, body = res[0], res[1] or []
+
+        return index, (
+            "anonymous class",
+            [("inheritance", inheritance), ("group", group), ("body", body)],
+        )
+
+    def anonymous_macro(self, index):
+        index = self.ist(index, "macro")
+
+        if index is None:
+            return None
+
+        args = []
+        pos = self.s(index, "(")
+
+        if pos is not None:
+            pos, arglist = self.macro_argument_list(pos)
+            pos = self.s(pos, ")")
+
+            if pos is not None:
+                index, args = self.wo(pos), arglist or []
+
+        res = self.run_state_body(index)
+
+        if res is None:
+            return None
+
+        return res[0], ("anonymous macro", [args, res[1]])
+
+    def class_body_item(self, index):
+        pos = self.ist(index, "macro")
+
+        if pos is not None:
+            pos = self.ws(pos)
+
+            if pos is not None:
+                res = self.macro_body(pos, ident_re)
+
+                if res is not None:
+                    return res[0], ("macro", res[1])
+
+        res = self.property_body(index, property_name_re)
+
+        if res is not None:
+            return res[0], ("property", res[1])
+
+        res = self.flag_body(index, "is", "+")
+
+        if res is not None:
+            return res[0], ("flag", res[1])
+
+        res = self.user_var(index, True)
+
+        if res is not None:
+            return res[0], ("user var", res[1])
+
+        res = self.flag_body(index, "isn't", "-")
+
+        if res is not None:
+            return res[0], ("unflag", res[1])
+
+        pos = self.ist(index, "combo")
+
+        if pos is not None:
+            pos = self.ws(pos)
+
+            if pos is not None:
+                m = self.rx_desc(pos, combo_name_re, "combo name")
+
+                if m is not None:
+                    return m.end(), ("flag combo", m.group())
+
+        pos = self.any_ist(index, "function ", "method ")
+
+        if pos is not None:
+            m = self.rx_desc(pos, ident_re, "function name")
+
+            if m is not None:
+                res = self.run_state_body(m.end())
+
+                if res is not None:
+                    return res[0], (
+                        "function",
+                        {"name": m.group(), "body": res[1]},
+                    )
+
+        res = self.label(index)
+
+        if res is not None:
+            return res[0], ("label", res[1])
+
+        res = self.mod_block(index)
+
+        if res is not None:
+            return res[0], ("mod", res[1])
+
+        res = self.global_apply(index)
+
+        if res is not None:
+            return res[0], ("apply", res[1])
+
+        res = self.class_for_loop(index)
+
+        if res is not None:
+            return res[0], ("for", res[1])
+
+        return None
+
+    def class_body(self, index):
+        res = self.class_body_item(self.wo(index))
+
+        if res is None:
+            return None
+
+        return self.wo(self.optional_semicolon(self.wo(res[0]))), res[1]
+
+    def abstract_label_body(self, index):
+        index = self.any_ist(index, "abstract label", "abstract state")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, abstract_name_re, "label name")
+
+        if m is None:
+            return None
+
+        return self.optional_semicolon(m.end()), m.group()
+
+    def abstract_array_body(self, index):
+        index = self.ist(index, "abstract array")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, user_var_name_re, "array name")
+
+        if m is None:
+            return None
+
+        res = self.var_size(m.end())
+
+        if res is None:
+            index, size = m.end(), None
+
+        else:
+            index, size = res
+
+        index, vtype = self.optional_var_type(index)
+        index = self.wo(self.optional_semicolon(self.wo(index)))
+
+        return index, {
+            "name": m.group(),
+            "size": int(size) if size else "any",
+            "type": vtype,
+        }
+
+    def abstract_macro_body(self, index):
+        index = self.ist(index, "abstract macro")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, abstract_name_re, "macro name")
+
+        if m is None:
+            return None
+
+        index = self.wo(m.end())
+        args = []
+        pos = self.s(index, "(")
+
+        if pos is not None:
+            pos, arglist = self.macro_argument_list(self.wo(pos))
+            pos = self.s(self.wo(pos), ")")
+
+            if pos is not None:
+                index, args = pos, arglist or []
+
+        index = self.wo(self.optional_semicolon(self.wo(index)))
+
+        return index, {"name": m.group(), "args": args}
+
+    def class_group(self, index):
+        # ((whitespace >> ist("group") << whitespace).desc(...) >> group_name)
+        index = self.described(self.ws_group, index, "group keyword")
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, group_name_re, "group name")
+
+        if m is None:
+            return None
+
+        return m.end(), m.group()
+
+    def ws_group(self, index):
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        return self.ws_after(index, "group")
+
+    def class_inheritance(self, index):
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        index = self.inheritance_keyword(index)
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        return self.described_superclass(index)
+
+    def class_replacement(self, index):
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        index = self.ist(index, "replaces")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        m = self.rx(index, replaced_name_re)
+
+        if m is None:
+            return None
+
+        return m.end(), m.group()
+
+    def class_number(self, index):
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        index = self.s(index, "#")
+
+        if index is None:
+            return None
+
+        m = self.rx(index, class_number_re)
+
+        if m is None:
+            return None
+
+        return m.end(), int(m.group())
+
+    def class_header(self, index):
+        # The group, inheritance, replacement and class number clauses
+        # shared by actor_class and templated_actor_class.
+        res = self.class_group(index)
+        group = None
+
+        if res is not None:
+            index, group = res[0], res[1] or None
+
+        res = self.class_inheritance(index)
+        inheritance = None
+
+        if res is not None:
+            index, inheritance = res
+
+        res = self.described(self.class_replacement, index, "replaced class name")
+        replacement = None
+
+        if res is not None:
+            index, replacement = res
+
+        res = self.described(self.class_number, index, "class number")
+        number = None
+
+        if res is not None:
+            index, number = res
+
+        return self.wo(index), [
+            ("group", group),
+            ("inheritance", inheritance),
+            ("replacement", replacement),
+            ("class number", number),
+        ]
+
+    def class_body_block(self, index, item):
+        index = self.s(index, "{")
+
+        if index is None:
+            return None
+
+        index, body = self.many(self.wo(index), item)
+        index = self.s(self.wo(index), "}")
+
+        if index is None:
+            return None
+
+        return self.wo(index), body
+
+    def actor_class(self, index):
+        index = self.described(self.class_keyword, index, "class statement")
+
+        if index is None:
+            return None
+
+        res = self.described(self.formattable_classname, index, "class name")
+
+        if res is None:
+            return None
+
+        index, clauses = self.class_header(res[0])
+        classname = ("classname", res[1])
+
+        res = self.class_body_block(index, self.class_body)
+
+        if res is None:
+            index, body = self.optional_semicolon(index), []
+
+        else:
+            index, body = res
+
+        return index, [classname, *clauses, ("body", body)]
+
+    def class_keyword(self, index):
+        index = self.any_ist(index, "actor", "class")
+
+        if index is None:
+            return None
+
+        return self.ws(index)
+
+    def template_body_item(self, index):
+        res = self.described(self.abstract_macro_body, index, "abstract macro")
+
+        if res is not None:
+            return res[0], ("abstract macro", res[1])
+
+        res = self.described(self.abstract_array_body, index, "abstract array")
+
+        if res is not None:
+            return res[0], ("abstract array", res[1])
+
+        res = self.described(self.abstract_label_body, index, "abstract label")
+
+        if res is not None:
+            return res[0], ("abstract label", res[1])
+
+        return self.class_body(index)
+
+    def templated_actor_class(self, index):
+        index = self.described(
+            self.any_ist, index, "class template", "actor", "class", "template"
+        )
+
+        if index is None:
+            return None
+
+        index = self.s(index, "<")
+
+        if index is None:
+            return None
+
+        index, params = self.macro_argument_list(index, "template parameter name")
+        index = self.s(index, ">")
+
+        if index is None:
+            return None
+
+        res = self.described(self.formattable_classname, self.wo(index), "class name")
+
+        if res is None:
+            return None
+
+        index, clauses = self.class_header(res[0])
+        classname = ("classname", res[1])
+
+        res = self.class_body_block(index, self.template_body_item)
+
+        if res is None:
+            return None
+
+        return res[0], [
+            ("parameters", params),
+            classname,
+            *clauses,
+            ("body", res[1]),
+        ]
+
+    def static_template_derivation(self, index):
+        index = self.wo(index)
+        res = self.anonymous_derivation(index)
+
+        if res is None:
+            res = self.named_derivation(index)
+
+            if res is None:
+                return None
+
+        return self.wo(self.optional_semicolon(res[0])), res[1]
+
+    def derivation_tail(self, index, keyword):
+        # ... group clause, then the source derivation after the keyword
+        index, group = self.optional_group_clause(index)
+        index = self.ist(index, keyword)
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        res = self.templated_class_derivation(index)
+
+        if res is None:
+            return None
+
+        return res[0], [("group", group), ("source", res[1])]
+
+    def anonymous_derivation(self, index):
+        index = self.ws_after(index, "derive")
+
+        if index is None:
+            return None
+
+        inheritance = None
+        pos = self.inheritance_keyword(index)
+
+        if pos is not None:
+            pos = self.ws(pos)
+
+            if pos is not None:
+                res = self.described_superclass(pos)
+
+                if res is not None:
+                    index, inheritance = res
+
+        res = self.derivation_tail(index, "a")
+
+        if res is None:
+            return None
+
+        return res[0], [("classname", None), ("inheritance", inheritance), *res[1]]
+
+    def named_derivation(self, index):
+        index = self.ws_after(index, "derive")
+
+        if index is None:
+            return None
+
+        res = self.described(self.formattable_classname, index, "name of derived class")
+
+        if res is None:
+            return None
+
+        classname = res[1]
+        index = self.ws(res[0])
+
+        if index is None:
+            return None
+
+        inheritance = None
+        pos = self.inheritance_keyword(index)
+
+        if pos is not None:
+            pos = self.ws(pos)
+
+            if pos is not None:
+                res = self.described_superclass(pos)
+
+                if res is not None:
+                    pos = self.ws(res[0])
+
+                    if pos is not None:
+                        index, inheritance = pos, res[1]
+
+        res = self.derivation_tail(index, "as")
+
+        if res is None:
+            return None
+
+        return res[0], [("classname", classname), ("inheritance", inheritance), *res[1]]
+
+    def group_declaration(self, index):
+        index = self.described(self.ws_after, index, "group statement", "group")
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(self.wo(index), group_name_re, "group name")
+
+        if m is None:
+            return None
+
+        index = m.end()
+        items = []
+        pos = self.s(self.wo(index), "{")
+
+        if pos is not None:
+            pos, names = self.sep_by_comma(pos, self.group_item)
+            pos = self.s(pos, "}")
+
+            if pos is not None:
+                index = pos
+                items = names if names and tuple(names) != ("",) else []
+
+        return self.optional_semicolon(index), [("name", m.group()), ("items", items)]
+
+    def group_item(self, index):
+        m = self.rx(index, group_name_re)
+
+        if m is None:
+            return None
+
+        return m.end(), m.group()
+
+    # Modifier blocks
+
+    def mod_block(self, index):
+        index = self.ws_after(index, "mod")
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, mod_name_re, "modifier name")
+
+        if m is None:
+            return None
+
+        res = self.mod_block_body(m.end())
+
+        if res is None:
+            return None
+
+        return self.wo(res[0]), [m.group(), res[1]]
+
+    def mod_block_body(self, index):
+        res = self.modifier_clause(index)
+
+        if res is not None:
+            return res[0], [res[1]]
+
+        index = self.s(self.wo(index), "{")
+
+        if index is None:
+            return None
+
+        index = self.wo(index)
+        clauses = []
+
+        while True:
+            res = self.modifier_clause(index)
+
+            if res is None:
+                break
+
+            index = self.optional_semicolon(self.wo(res[0]))
+            clauses.append(res[1])
+
+        index = self.s(self.wo(index), "}")
+
+        if index is None:
+            return None
+
+        return index, clauses
+
+    def modifier_clause(self, index):
+        res = self.modifier_selector_expr(self.wo(index))
+
+        if res is None:
+            return None
+
+        selector = res[1]
+        index = self.wo(res[0])
+        res = self.modifier_effect(index)
+
+        if res is not None:
+            return self.wo(res[0]), [selector, [res[1]]]
+
+        index = self.s(index, "{")
+
+        if index is None:
+            return None
+
+        index = self.wo(index)
+        effects = []
+
+        while True:
+            res = self.modifier_effect(index)
+
+            if res is None:
+                break
+
+            index = self.wo(self.optional_semicolon(self.wo(res[0])))
+            effects.append(res[1])
+
+        if not effects:
+            return None
+
+        index = self.s(index, "}")
+
+        if index is None:
+            return None
+
+        return self.wo(index), [selector, effects]
+
+    def modifier_effect(self, index):
+        for lit, description, effect in (
+            ("+flag", "+flag effect", zdlexer.mod_flag),
+            ("-flag", "-flag effect", zdlexer.mod_delflag),
+        ):
+            pos = self.ist_desc(index, lit, description)
+
+            if pos is not None:
+                pos = self.ws(pos)
+
+                if pos is not None:
+                    pos, name = self.state_modifier_name(pos)
+                    return pos, effect(name)
+
+        for lit, description, effect in (
+            ("prefix", "prefix effect", zdlexer.mod_prefix),
+            ("suffix", "suffix effect", zdlexer.mod_suffix),
+        ):
+            pos = self.ist_desc(index, lit, description)
+
+            if pos is not None:
+                pos = self.ws(pos)
+
+                if pos is not None:
+                    res = self.run_state_body(pos)
+
+                    if res is not None:
+                        return res[0], effect(res[1])
+
+        pos = self.ist_desc(index, "manipulate", "manipulate effect")
+
+        if pos is not None:
+            pos = self.ws(pos)
+
+            if pos is not None:
+                m = self.rx_desc(pos, ident_re, "virtual macro name")
+
+                if m is not None:
+                    res = self.described(
+                        self.run_state_body,
+                        self.wo(m.end()),
+                        "manipulated state body template",
+                    )
+
+                    if res is not None:
+                        return res[0], zdlexer.mod_manipulate([m.group(), res[1]])
+
+        return None
+
+    def selector_call(self, index, keyword):
+        index = self.ist(index, keyword)
+
+        if index is None:
+            return None
+
+        return self.s(self.wo(index), "(")
+
+    def modifier_selector_basic(self, index):
+        pos = self.selector_call(index, "flag")
+
+        if pos is not None:
+            pos, name = self.state_modifier_name(pos)
+            pos = self.s(pos, ")")
+
+            if pos is not None:
+                return pos, zdlexer.selector_flag(name)
+
+        pos = self.selector_call(index, "sprite")
+
+        if pos is not None:
+            res = self.sprite_name(pos)
+
+            if res is not None:
+                pos = self.s(res[0], ")")
+
+                if pos is not None:
+                    return pos, zdlexer.selector_name(res[1])
+
+        pos = self.selector_call(index, "duration")
+
+        if pos is not None:
+            m = self.rx(pos, digits_re)
+            duration = 0
+
+            if m is not None:
+                pos, duration = m.end(), int(m.group())
+
+            pos = self.s(pos, ")")
+
+            if pos is not None:
+                return pos, zdlexer.selector_duration(duration)
+
+        return None
+
+    def binary_selector(self, index, lit, description, combine):
+        res = self.modifier_selector_expr(index)
+
+        if res is None:
+            return None
+
+        pos = self.ist_desc(self.wo(res[0]), lit, description)
+
+        if pos is None:
+            return None
+
+        other = self.modifier_selector_expr(self.wo(pos))
+
+        if other is None:
+            return None
+
+        return self.wo(other[0]), combine([res[1], other[1]])
+
+    def modifier_selector_expr(self, index):
+        index = self.wo(index)
+        res = self.modifier_selector_basic(index)
+
+        if res is not None:
+            return res
+
+        pos = self.ist_desc(index, "any", "any selector")
+
+        if pos is not None:
+            return pos, zdlexer.selector_any("any")
+
+        pos = self.ist_desc(index, "!", "not operator")
+
+        if pos is not None:
+            res = self.modifier_selector_expr(self.wo(pos))
+
+            if res is not None:
+                return self.wo(res[0]), zdlexer.selector_not(res[1])
+
+        pos = self.s(index, "(")
+
+        if pos is None:
+            return None
+
+        for lit, description, combine in (
+            ("&&", "and operator", zdlexer.selector_and),
+            ("||", "or operator", zdlexer.selector_or),
+            ("^^", "xor operator", zdlexer.selector_xor),
+        ):
+            res = self.binary_selector(pos, lit, description, combine)
+
+            if res is not None:
+                break
+
+        else:
+            res = self.modifier_selector_expr(pos)
+
+            if res is None:
+                return None
+
+            res = self.wo(res[0]), res[1]
+
+        index = self.s(res[0], ")")
+
+        if index is None:
+            return None
+
+        return index, res[1]
+
+    # States
+
+    def sprite_name(self, index):
+        m = self.rx(index, sprite_re)
+
+        if m is not None:
+            return m.end(), ("normal", m.group())
+
+        for lit in ('"####"', "####"):
+            pos = self.s(index, lit)
+
+            if pos is not None:
+                return pos, ("normal", lit)
+
+        index = self.ws_after(index, "param")
+
+        if index is None:
+            return None
+
+        m = self.rx(index, ident_re)
+
+        if m is None:
+            return None
+
+        return m.end(), ("parametrized", m.group())
+
+    def state_tail(self, index):
+        # modifiers, then an optional action
+        index, modifiers = self.many(index, self.modifier)
+        index = self.wo(index)
+        res = self.state_action(index)
+
+        if res is None:
+            return index, [modifiers, None]
+
+        return res[0], [modifiers, res[1]]
+
+    def normal_state(self, index):
+        res = self.described(self.sprite_name, index, "state name")
+
+        if res is not None:
+            sprite = res[1]
+            pos = self.wo(res[0])
+            frames = []
+
+            while True:
+                m = self.rx(pos, frame_re)
+
+                if m is None:
+                    break
+
+                frames.append(m.group())
+                pos = m.end()
+
+            m = self.rx_desc(self.wo(pos), integer_re, "state duration")
+
+            if m is not None:
+                pos, tail = self.state_tail(self.wo(m.end()))
+                return pos, [sprite, frames, int(m.group()), *tail]
+
+        pos = self.ist_desc(index, "keepst", "'keepst' state")
+
+        if pos is not None:
+            pos = self.ws(pos)
+
+            if pos is not None:
+                m = self.rx_desc(pos, integer_re, "state duration")
+
+                if m is not None:
+                    pos, tail = self.state_tail(self.wo(m.end()))
+                    return pos, [("normal", '"####"'), '"#"', int(m.group()), *tail]
+
+        pos = self.ist_desc(index, "invisi", "'invisi' state")
+
+        if pos is not None:
+            pos = self.ws(pos)
+
+            if pos is not None:
+                m = self.rx_desc(pos, integer_re, "state duration")
+                duration = 0
+
+                if m is not None:
+                    pos, duration = m.end(), int(m.group()) or 0
+
+                pos, tail = self.state_tail(self.wo(pos))
+                return pos, [("normal", "TNT1"), "A", duration, *tail]
+
+        return None
+
+    def state_action(self, index):
+        res = self.action_body_repeat(index)
+
+        if res is not None:
+            return res[0], ("repeated inline body", res[1])
+
+        res = self.state_call(index)
+
+        if res is not None:
+            return res[0], ("action", res[1])
+
+        res = self.action_body(index)
+
+        if res is not None:
+            return res[0], ("inline body", res[1])
+
+        return None
+
+    def action_body_item(self, index):
+        res = self.state_action(index)
+
+        if res is None:
+            return None
+
+        return self.wo(self.optional_semicolon(res[0])), res[1]
+
+    def action_body(self, index):
+        index = self.s(index, "{")
+
+        if index is None:
+            return None
+
+        index, actions = self.many(self.wo(index), self.action_body_item)
+        index = self.s(index, "}")
+
+        if index is None:
+            return None
+
+        return index, actions
+
+    def repeat_header(self, index):
+        # ist("x") >> wo >> count, then an optional index variable
+        index = self.ist(index, "x")
+
+        if index is None:
+            return None
+
+        res = self.described(
+            self.replaceable_number, self.wo(index), "amount of times to repeat"
+        )
+
+        if res is None:
+            return None
+
+        index, count = res
+        res = self.repeat_index(index)
+
+        if res is None:
+            return self.wo(index), [count, None]
+
+        return self.wo(res[0]), [count, res[1] or None]
+
+    def repeat_index(self, index):
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        index = self.ist(index, "index")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, variable_name_re, "repeat index name")
+
+        if m is None:
+            return None
+
+        index = self.ws(m.end())
+
+        if index is None:
+            return None
+
+        return index, m.group()
+
+    def action_body_repeat(self, index):
+        res = self.repeat_header(index)
+
+        if res is None:
+            return None
+
+        index, header = res
+        res = self.state_action(index)
+
+        if res is None:
+            return None
+
+        return res[0], [*header, res[1]]
+
+    # Statements (the ones that nest are generator rules, see run)
+
+    def repeat_statement(self, index):
+        res = self.repeat_header(index)
+
+        if res is None:
+            return None
+
+        index, header = res
+        res = yield self.state_body, index
+
+        if res is None:
+            return None
+
+        return res[0], [*header, res[1]]
+
+    def keyword_statement(self, index, lit, description):
+        # (wo >> ist(lit)).desc(description)
+        saved = self.furthest, self.expected
+        pos = self.ist(self.wo(index), lit)
+
+        if pos is None:
+            self.furthest, self.expected = saved
+            return self.fail(index, description)
+
+        return pos, lit
+
+    def optional_body(self, index):
+        # state_body.optional().map(lambda x: x if x is not None else [])
+        res = yield self.state_body, index
+
+        if res is None:
+            return index, []
+
+        return res
+
+    def else_clause(self, index):
+        # s(";").optional() >> wo >> s("else") >> wo >> body << wo
+        index = self.s(self.wo(self.optional_semicolon(index)), "else")
+
+        if index is None:
+            return None
+
+        index, body = yield self.optional_body, self.wo(index)
+        return self.wo(index), body
+
+    def conditional_tail(self, index, head):
+        index, body = yield self.optional_body, index
+        index = self.wo(index)
+        res = yield self.else_clause, index
+
+        if res is None:
+            return index, [head, body, None]
+
+        return res[0], [head, body, res[1]]
+
+    def if_statement(self, index, lit="if", description="if statement"):
+        index = self.ist_desc(index, lit, description)
+
+        if index is None:
+            return None
+
+        index = self.s(self.wo(index), "(")
+
+        if index is None:
+            return None
+
+        index, cond = self.expression(self.wo(index))
+        index = self.s(self.wo(index), ")")
+
+        if index is None:
+            return None
+
+        return (yield self.conditional_tail, self.wo(index), cond)
+
+    def while_statement(self, index):
+        return self.if_statement(index, "while", "while statement")
+
+    def ifjump_statement(self, index, lit="ifjump", description="ifjump statement"):
+        index = self.ist_desc(index, lit, description)
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        res = self.state_call(index)
+
+        if res is None:
+            return None
+
+        return (yield self.conditional_tail, self.wo(res[0]), res[1])
+
+    def whilejump_statement(self, index):
+        return self.ifjump_statement(index, "whilejump", "whilejump statement")
+
+    def for_mode(self, index):
+        pos = self.ws_after(index, "group")
+
+        if pos is not None:
+            m = self.rx_desc(pos, p_group_name_re, "group name")
+
+            if m is not None:
+                return self.wo(m.end()), ("group", m.group())
+
+        pos = self.ws_after(index, "range")
+
+        if pos is not None:
+            res = self.p_range_vals(pos)
+
+            if res is not None:
+                return self.wo(res[0]), ("range", res[1])
+
+        return None
+
+    def p_range_vals(self, index):
+        res = self.replaceable_number(index)
+        start = 0
+
+        if res is not None:
+            index, start = res
+
+        index = self.wo(index)
+        pos = self.ist(index, "..")
+
+        if pos is not None:
+            pos = self.s(self.wo(pos), "=")
+
+            if pos is not None:
+                res = self.replaceable_number(self.wo(pos))
+
+                if res is not None:
+                    return res[0], [start, (1, res[1])]
+
+        res = self.replaceable_number(index)
+
+        if res is None:
+            return None
+
+        return res[0], [start, (0, res[1])]
+
+    def for_index(self, index):
+        index = self.ist_desc(index, "index", "index keyword")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, variable_name_re, "iteration index name")
+
+        if m is None:
+            return None
+
+        index = self.ws(m.end())
+
+        if index is None:
+            return None
+
+        return index, m.group()
+
+    def for_template(self, index, body):
+        index = self.ist_desc(index, "for", "for statement")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, variable_name_re, "iteration parameter name")
+
+        if m is None:
+            return None
+
+        index = self.ws(m.end())
+
+        if index is None:
+            return None
+
+        res = self.for_index(index)
+        iter_index = None
+
+        if res is not None:
+            index, iter_index = res[0], res[1] or None
+
+        index = self.ws_after(index, "in")
+
+        if index is None:
+            return None
+
+        res = self.for_mode(index)
+
+        if res is None:
+            return None
+
+        index, mode = res
+        res = yield body, self.wo(index)
+        index, loop_body = self.wo(res[0]), res[1]
+
+        index = self.wo(index)
+        else_body = None
+        pos = self.ist(index, "else")
+
+        if pos is not None:
+            res = yield body, self.wo(pos)
+            index, else_body = self.wo(res[0]), res[1]
+
+        return index, [m.group(), iter_index, mode, loop_body, else_body]
+
+    def for_statement(self, index):
+        return self.for_template(index, self.optional_body)
+
+    def optional_nested_source_code(self, index):
+        res = self.nested_source_code(index)
+
+        if res is None:
+            return index, []
+
+        return res
+
+    def static_for_loop(self, index):
+        return self.run(self.for_template, index, self.optional_nested_source_code)
+
+    def optional_nested_class_body(self, index):
+        pos = self.s(index, "{")
+
+        if pos is None:
+            return index, []
+
+        pos, body = self.many(pos, self.class_body)
+        pos = self.s(pos, "}")
+
+        if pos is None:
+            return index, []
+
+        return pos, body
+
+    def class_for_loop(self, index):
+        return self.run(self.for_template, index, self.optional_nested_class_body)
+
+    def sometimes_statement(self, index):
+        index = self.s(index, "sometimes")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        pos = self.s(index, "(")
+        chance = None
+
+        if pos is not None:
+            pos, expr = self.expression(self.wo(pos))
+            pos = self.s(self.wo(pos), ")")
+
+            if pos is not None:
+                index, chance = pos, expr
+
+        if chance is None:
+            res = self.replaceable_number(index)
+
+            if res is None:
+                return None
+
+            index, num = res
+            chance = (
+                "expr",
+                [
+                    (
+                        "literal",
+                        (("number" if type(num) is int else "actor variable"), num),
+                    )
+                ],
+            )
+
+        index = self.wo(self.optional_percent(index))
+        index, body = yield self.optional_body, index
+
+        return index, [("chance", chance), ("body", body)]
+
+    def optional_percent(self, index):
+        res = self.s(index, "%")
+        return index if res is None else res
+
+    def actor_function_call(self, index):
+        index = self.ist_desc(index, "call ", "'call' statement")
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, ident_re, "called function name")
+
+        if m is None:
+            return None
+
+        return m.end(), m.group()
+
+    def apply_block(self, index):
+        index = self.ist_desc(index, "apply", "apply statement")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        m = self.rx(index, mod_name_re)
+
+        if m is None:
+            return None
+
+        # like described(), around a generator rule
+        index = self.wo(m.end())
+        saved = self.furthest, self.expected
+        res = yield self.state_body, index
+
+        if res is None:
+            self.furthest, self.expected = saved
+            return self.fail(index, "apply block body")
+
+        return self.wo(res[0]), [m.group(), res[1]]
+
+    def global_apply(self, index):
+        index = self.ist_desc(index, "apply", "class-scoped apply statement")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        res = self.mod_block_body(index)
+
+        if res is not None:
+            return self.wo(res[0]), ("body", res[1])
+
+        m = self.rx(index, mod_name_re)
+
+        if m is None:
+            return None
+
+        return self.wo(m.end()), ("name", m.group())
+
+    def macro_source(self, index):
+        index = self.ist_desc(index, "from", "'from' determiner")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, macro_ref_re, "extern macro classname")
+
+        if m is None:
+            return None
+
+        index = self.ws(m.end())
+
+        if index is None:
+            return None
+
+        return index, m.group()
+
+    def macro_call(self, index):
+        res = self.macro_source(index)
+        source = None
+
+        if res is not None:
+            index, source = res[0], res[1] or None
+
+        index = self.ist_desc(index, "inject", "'inject' statement")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        m = self.rx_desc(index, macro_ref_re, "injected macro name")
+
+        if m is None:
+            return None
+
+        index = self.wo(m.end())
+        args = []
+        pos = self.s(index, "(")
+
+        if pos is not None:
+            pos, arglist = self.expr_argument_list(pos)
+            pos = self.s(pos, ")")
+
+            if pos is not None:
+                index, args = pos, arglist or []
+
+        return index, [source, m.group(), args]
+
+    def flow_control(self, index):
+        for lit in ("stop", "wait", "fail", "loop"):
+            pos = self.ist(index, lit)
+
+            if pos is not None:
+                return pos, lit
+
+        index = self.ist(index, "goto")
+
+        if index is None:
+            return None
+
+        index = self.ws(index)
+
+        if index is None:
+            return None
+
+        m = self.rx(index, goto_target_re)
+
+        if m is None:
+            return None
+
+        return m.end(), "goto " + m.group()
+
+    def state_no_colon(self, index):
+        for lit in ("return", "break", "continue"):
+            res = self.keyword_statement(index, lit, lit + " statement")
+
+            if res is not None:
+                return res[0], (lit, res[1])
+
+        for tag, rule in (
+            ("if", self.if_statement),
+            ("ifjump", self.ifjump_statement),
+            ("whilejump", self.whilejump_statement),
+            ("for", self.for_statement),
+            ("sometimes", self.sometimes_statement),
+            ("while", self.while_statement),
+            ("call", self.actor_function_call),
+            ("apply", self.apply_block),
+            ("inject", self.macro_call),
+            ("flow", self.flow_control),
+            ("frames", self.normal_state),
+            ("repeat", self.repeat_statement),
+        ):
+            res = yield rule, index
+
+            if res is not None:
+                return res[0], (tag, res[1])
+
+        return None
+
+    def state(self, index):
+        res = yield self.state_no_colon, index
+
+        if res is None:
+            return None
+
+        index = self.s(res[0], ";")
+
+        if index is None:
+            return None
+
+        return index, res[1]
+
+    def state_body(self, index):
+        res = yield self.state_no_colon, index
+
+        if res is not None:
+            return res[0], [res[1]]
+
+        index = self.s(self.wo(index), "{")
+
+        if index is None:
+            return None
+
+        # state.sep_by(wo)
+        index = pos = self.wo(index)
+        states = []
+
+        while True:
+            res = yield self.state, pos
+
+            if res is None:
+                break
+
+            index, state = res
+            states.append(state)
+            pos = self.wo(index)
+
+        index = self.s(self.wo(index), "}")
+
+        if index is None:
+            return None
+
+        return index, states
+
+    def run_state_body(self, index):
+        return self.run(self.state_body, index)
+
+    # Top level
+
+    def macro_def(self, index):
+        index = self.ws_after(index, "macro")
+
+        if index is None:
+            return None
+
+        res = self.macro_body(index, ident_re)
+
+        if res is None:
+            return None
+
+        return res[0], ("macro", res[1])
+
+    def top_level_item(self, index):
+        for tag, rule in (
+            ("group", self.group_declaration),
+            ("macro", self.macro_def),
+            ("class", self.actor_class),
+            ("static template derivation", self.static_template_derivation),
+            ("class template", self.templated_actor_class),
+            ("for", self.static_for_loop),
+        ):
+            res = rule(index)
+
+            if res is not None:
+                return res[0], (tag, res[1])
+
+        return None
+
+    def source_code(self, index):
+        index, items = self.sep_by_wo(self.wo(index), self.top_level_item)
+        return self.wo(index), items
+
+    def nested_source_code(self, index):
+        index = self.ist(index, "{")
+
+        if index is None:
+            return None
+
+        index, items = self.source_code(index)
+        index = self.ist(index, "}")
+
+        if index is None:
+            return None
+
+        index = self.ist(self.wo(index), ";")
+
+        if index is None:
+            return None
+
+        return index, items
+
+    def parse(self):
+        index, items = self.source_code(0)
+
+        if index < self.length:
+            self.fail(index, "EOF")
+            raise parsy.ParseError(self.expected, self.code, self.furthest)
+
+        return items
+
+
+def parse(code):
+    """Parses preprocessed ZDCode source, like zdlexer.source_code_top.parse.
+
+    Raises parsy.ParseError on failure, so that callers can handle both
+    backends the same way.
+    """
+    return RDParser(code).parse()
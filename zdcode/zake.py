@@ -8,6 +8,8 @@ from enum import Enum
 import attr
 
 from .bundle import Bundle, BundleOutput
+from .cache import ParseCache, UnitCache
+from .zdlexer import DeclarationCache
 
 
 class ZakeException(Exception):
@@ -24,6 +26,7 @@ class ZakeTarget:
         self.definitions: dict[str, str] = {}
         self.inputs: list[tuple[str, str]] = []
         self.outputs: dict[str, BundleOutput] = {}
+        self.depfile: typing.Optional[str] = None
 
     def add_input(self, inp):
         self.inputs.append(inp)
@@ -34,6 +37,8 @@ class ZakeTarget:
     def bundle(self, **kwargs):
         bundle = Bundle(*self.inputs, outputs=self.outputs)
 
+        kwargs.setdefault("depfile", self.depfile)
+
         return bundle.bundle(
             preproc_defs={k.upper(): v for k, v in self.definitions.items()}, **kwargs
         )
@@ -44,6 +49,14 @@ class Zake:
 
     def __init__(self):
         self.targets: dict[str, ZakeTarget] = {}
+        self.cache: typing.Optional[ParseCache] = None
+        self.jobs: typing.Optional[int] = None
+        self.id_seed: typing.Optional[str] = None
+        self.stats: bool = False
+
+        # compilation units (and whole DECORATE outputs) reused between
+        # targets, when they test the same definitions
+        self.units = UnitCache()
 
     def add_target(self, name: str) -> ZakeTarget:
         return self.targets.setdefault(name, ZakeTarget(name))
@@ -61,6 +74,24 @@ class Zake:
         version = c_general["version"].strip()
         targets = c_general["targets"].strip().split()
 
+        # parsed ASTs of unchanged sources are shared between targets, and
+        # between runs
+        if "cache" in c_general:
+            self.cache = ParseCache(c_general["cache"].strip())
+
+        # sources are parsed in this many processes
+        if "jobs" in c_general:
+            self.jobs = c_general.getint("jobs")
+
+        # the same sources always make the same outputs, with IDs derived
+        # from the name of the mod (see ZDCode.make_id)
+        if c_general.getboolean("deterministic", fallback=False):
+            self.id_seed = name
+
+        # prints statistics, like how many template derivations and
+        # compilation units were reused
+        self.stats = c_general.getboolean("stats", fallback=False)
+
         if "partitions" in c_general:
             bundles = [x.lower() for x in c_general["partitions"].strip().split()]
 
@@ -140,6 +171,10 @@ class Zake:
             for inp in pats["inputs"].strip().split():
                 targ.add_input((inp, ""))
 
+            # dependency file, for outer build systems
+            if "depfile" in pats:
+                targ.depfile = pats["depfile"].strip()
+
             if "injects" in pats:
                 for injs in pats["injects"].strip().split():
                     match = self.inj_field_pat.match(injs)
@@ -207,6 +242,20 @@ class Zake:
         return targs
 
     def execute(self, **kwargs):
+        kwargs.setdefault("cache", self.cache)
+        kwargs.setdefault("jobs", self.jobs)
+        kwargs.setdefault("units", self.units)
+        kwargs.setdefault("id_seed", self.id_seed)
+        kwargs.setdefault("stats", self.stats)
+
+        # Targets mostly differ in their definitions, which leave most
+        # top-level declarations the same; those are only parsed once.
+        if self.cache is not None:
+            kwargs.setdefault("declarations", self.cache.declarations)
+
+        else:
+            kwargs.setdefault("declarations", DeclarationCache())
+
         print(
             "Starting ZDCode bundling barrage with {} targets.".format(
                 len(self.targets)
@@ -265,6 +314,9 @@ def main(print_status_code=True):
         )
     )
 
+    if zake.stats:
+        print(zake.units.summary())
+
     exit(acc_status)
 
 
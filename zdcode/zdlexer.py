@@ -1,14 +1,31 @@
-# pylint: disable=unreachable
+import bisect
+import collections
+import collections.abc
+import copy
+import functools
 import glob
-import json
+import itertools
 import math
+import operator
 import os
 import re
 import sys
+import threading
 import traceback
+from array import array
 
 import parsy
-from parsy import fail, generate, regex, seq, string, success, whitespace
+from parsy import (
+    Parser,
+    Result,
+    fail,
+    forward_declaration,
+    regex,
+    seq,
+    string,
+    success,
+    whitespace,
+)
 
 s = string
 fa = fail
@@ -41,12 +58,6 @@ string_literal = (string_delim_1 >> string_body_plex_1 << string_delim_1) | (
 )
 lwhitespace = whitespace | s("\n") | s("\r")
 
-ifneq = re.compile(r"^\#IF(N|NOT)EQ(UALS?)?$")
-ifundef = re.compile(r"^\#IF(U?N|NOT)DEF(INED)?$")
-defmacro = re.compile(r"^\#DEF(INE)?M(AC(RO)?)?$")
-
-error_line = re.compile(r"(.+?) at (\d+)\:(\d+)$")
-
 
 class PreprocessingError(BaseException):
     def __init__(self, problem, line, fname=None, line_content=None):
@@ -86,9 +97,112 @@ class ZDParseError(BaseException):
         )
 
 
-@generate
-def state_modifier_name():
-    return (
+class ZDNestingError(ZDParseError):
+    """Raised when code nests deeper than the parsy backend can recurse."""
+
+    def __init__(self, filename=None):
+        ZDParseError.__init__(self, None)
+        self.filename = filename
+
+    def __str__(self):
+        return "code nested too deeply for the parsy parser backend{}; the rd backend (--parser rd) parses nesting of any depth".format(
+            "" if self.filename is None else ' in "{}"'.format(self.filename)
+        )
+
+
+class PackratMemo:
+    """Opt-in packrat cache for one parse.
+
+    While a parse runs with a PackratMemo, the results of the rules wrapped
+    with packrat() are cached by (rule, index), so that alternatives that
+    share a prefix do not parse the same span over and over. The results
+    are dropped after every parse, but the hit and miss counters add up, to
+    see which rules benefit from memoization.
+    """
+
+    def __init__(self):
+        self.stream = None
+        self.results = {}
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def summary(self):
+        names = sorted(self.misses, key=lambda name: (-self.hits[name], name))
+
+        return "\n".join(
+            "{:<28} {:>8} hits {:>8} misses".format(
+                name, self.hits[name], self.misses[name]
+            )
+            for name in names
+        )
+
+
+_packrat_state = threading.local()
+
+
+def packrat(name, parser):
+    @Parser
+    def packrat_parser(stream, index):
+        memo = getattr(_packrat_state, "memo", None)
+
+        if memo is None or memo.stream is not stream:
+            return parser(stream, index)
+
+        key = (name, index)
+
+        try:
+            res = memo.results[key]
+
+        except KeyError:
+            res = memo.results[key] = parser(stream, index)
+            memo.misses[name] += 1
+
+        else:
+            memo.hits[name] += 1
+
+        return res
+
+    return packrat_parser
+
+
+# Rules that are referenced before they are defined, either because they
+# are recursive or because the grammar is laid out top-down. Every rule is
+# built exactly once, at import time.
+state_modifier_name = forward_declaration()
+numeric_eval = forward_declaration()
+expression = forward_declaration()
+parameter = forward_declaration()
+call_literal = forward_declaration()
+templated_class_derivation = forward_declaration()
+mod_block = forward_declaration()
+class_body = forward_declaration()
+superclass = forward_declaration()
+anonymous_class = forward_declaration()
+state_action = forward_declaration()
+action_body = forward_declaration()
+replaceable_number = forward_declaration()
+action_body_repeat = forward_declaration()
+state_no_colon = forward_declaration()
+modifier_selector_expr = forward_declaration()
+mod_block_body = forward_declaration()
+state_body = forward_declaration()
+sometimes_statement = forward_declaration()
+apply_block = forward_declaration()
+global_apply = forward_declaration()
+if_statement = forward_declaration()
+for_statement = forward_declaration()
+class_for_loop = forward_declaration()
+ifjump_statement = forward_declaration()
+whilejump_statement = forward_declaration()
+while_statement = forward_declaration()
+repeat_statement = forward_declaration()
+anonymous_macro = forward_declaration()
+nested_source_code = forward_declaration()
+source_code = forward_declaration()
+
+
+state_modifier_name.become(
+    (
         (
             s("{")
             >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*")
@@ -105,14 +219,11 @@ def state_modifier_name():
         .many()
         .desc("state keyword")
     )
-    yield
+)
 
 
-@generate
-def modifier():
-    # State modifier. Not to be confused with the 'mod' modifier block.
-    return string("[").then(state_modifier_name).skip(s("]"))
-    yield
+# State modifier. Not to be confused with the 'mod' modifier block.
+modifier = string("[").then(state_modifier_name).skip(s("]"))
 
 
 def _apply_replacements(expr, replacements):
@@ -132,367 +243,379 @@ def apply_replacements(expr, replacements):
     return _apply_replacements(expression.parse(expr), replacements)
 
 
-@generate
-def number_lit():
-    return (
-        regex(r"[\+\-]?\d+(.\d+)?(e[\+\-]?\d+)?").tag("number")
-        | regex(r"0x[0-9A-Fa-f]+").map(int).tag("number")
-        | regex(r"0b[01]+").map(int).tag("number")
-    )
-    yield
+number_lit = (
+    regex(r"[\+\-]?\d+(.\d+)?(e[\+\-]?\d+)?").tag("number")
+    | regex(r"0x[0-9A-Fa-f]+").map(int).tag("number")
+    | regex(r"0b[01]+").map(int).tag("number")
+)
 
 
-@generate
-def group_name():
-    return regex(r"[a-zA-Z0-9_]+").desc("group name")
-    yield
+group_name = regex(r"[a-zA-Z0-9_]+").desc("group name")
 
 
-@generate
-def p_group_name():
-    return regex(r"\@*[a-zA-Z0-9_]+").desc("group name")
-    yield
+p_group_name = regex(r"\@*[a-zA-Z0-9_]+").desc("group name")
 
 
-@generate
-def p_range_vals():
-    return seq(
-        (replaceable_number | success(0)) << wo,
-        ist("..") >> wo >> (s("=") >> wo >> replaceable_number).tag(1)
-        | replaceable_number.tag(0),
-    )
-    yield
+p_range_vals = seq(
+    (replaceable_number | success(0)) << wo,
+    ist("..") >> wo >> (s("=") >> wo >> replaceable_number).tag(1)
+    | replaceable_number.tag(0),
+)
 
 
-@generate
-def variable_name():
-    return regex(r"[a-zA-Z_\$][a-zA-Z0-9_\$\[\]]*")
-    yield
+variable_name = regex(r"[a-zA-Z_\$][a-zA-Z0-9_\$\[\]]*")
 
 
-@generate
-def format_string_literal():
-    return (
-        ist("f")
-        >> wo
-        >> s("{")
-        >> wo
-        >> (
-            (
-                string_literal.tag("str")
-                | numeric_eval.tag("eval")
-                | variable_name.tag("fmt")
-            ).sep_by(wo)
-        )
-        << wo
-        << s("}")
+format_string_literal = (
+    ist("f")
+    >> wo
+    >> s("{")
+    >> wo
+    >> (
+        (
+            string_literal.tag("str")
+            | numeric_eval.tag("eval")
+            | variable_name.tag("fmt")
+        ).sep_by(wo)
     )
-    yield
+    << wo
+    << s("}")
+)
 
 
-@generate
-def formattable_string():
-    return format_string_literal.tag("format") | string_literal.tag("string")
-    yield
+formattable_string = format_string_literal.tag("format") | string_literal.tag("string")
 
 
-@generate
-def formattable_classname():
-    return format_string_literal.tag("format") | regex(r"[a-zA-Z0-9_]+").tag("string")
-    yield
+formattable_classname = format_string_literal.tag("format") | regex(
+    r"[a-zA-Z0-9_]+"
+).tag("string")
 
 
-@generate
-def eval_literal():
-    return (
-        (regex(r"[\-\+]?"))
-        + (regex(r"\d+\.\d*") | regex(r"\d*.\d+"))
-        + (regex(r"([Ee][\-\+]?\d+)?") | success(""))
-    ).map(float) | (
-        (regex(r"[\-\+]") | regex(r"0x[xo]") | success("")) + (regex(r"[0-9]+"))
-    ).map(
-        int
-    )
-    yield
+# Compile-time evaluations (e{...}) are parsed by precedence climbing: every
+# token is read once, and the operator tables below define precedence and
+# associativity, based on C. The resulting tree is made of
+# ("operation", (func, args)) and ("literal", literal) tuples, which are
+# folded by ZDCode._parse_evaluation.
+def _eval_pi(a):
+    return math.pi * a
 
 
-@generate
-def eval_body_child():
-    return (
-        (ist("(") >> eval_body << ist(")"))
-        | eval_literal.tag("number").tag("literal")
-        | variable_name.tag("actor variable").tag("literal")
-        | eval_operation.tag("operation")
-    )
-    yield
+def _eval_and(a, b):
+    return 1 if (a and b) else 0
 
 
-@generate
-def eval_body():
-    return (
-        wo
-        >> (
-            (ist("(") >> eval_body << ist(")"))
-            | eval_operation.tag("operation")
-            | eval_literal.tag("number").tag("literal")
-            | variable_name.tag("actor variable").tag("literal")
-        )
-        << wo
-    )
-    yield
+def _eval_or(a, b):
+    return 1 if (a or b) else 0
 
 
-# operator precedence based on C
-def opmap(operands, func):
-    if operands == 1:
-        return lambda x: (lambda _, a: (func, (a,)))(*x)
+def _eval_xor(a, b):
+    return 1 if ((a == 0) != (b == 0)) else 0
 
-    else:
-        return lambda x: (lambda a, _, b: (func, (a, b)))(*x)
-
-
-def make_operators(child):
-    return [
-        # Unary sign precedence
-        seq(ist("+") << wo, child).map(opmap(1, lambda a: +a)),
-        seq(ist("-") << wo, child).map(opmap(1, lambda a: -a)),
-        seq(ist("round") << wo, child).map(opmap(1, lambda a: int(a))),
-        seq(ist("floor") << wo, child).map(opmap(1, lambda a: math.floor(a))),
-        seq(ist("ceil") << wo, child).map(opmap(1, lambda a: math.ceil(a))),
-        seq(ist("sin") << wo, child).map(opmap(1, lambda a: math.sin(a))),
-        seq(ist("cos") << wo, child).map(opmap(1, lambda a: math.cos(a))),
-        seq(ist("tan") << wo, child).map(opmap(1, lambda a: math.tan(a))),
-        seq(ist("asin") << wo, child).map(opmap(1, lambda a: math.asin(a))),
-        seq(ist("acos") << wo, child).map(opmap(1, lambda a: math.acos(a))),
-        seq(ist("atan") << wo, child).map(opmap(1, lambda a: math.atan(a))),
-        seq(ist("pi") << wo, child).map(opmap(1, lambda a: math.pi * a)),
-        # Multiplicative precedence
-        seq(child, wo >> ist("%") << wo, child).map(opmap(2, lambda a, b: a % b)),
-        seq(child, wo >> ist("*") << wo, child).map(opmap(2, lambda a, b: a * b)),
-        seq(child, wo >> ist("/") << wo, child).map(opmap(2, lambda a, b: a / b)),
-        seq(child, wo >> ist("//") << wo, child).map(opmap(2, lambda a, b: a // b)),
-        # Additive precedence
-        seq(child, wo >> ist("+") << wo, child).map(opmap(2, lambda a, b: a + b)),
-        seq(child, wo >> ist("-") << wo, child).map(opmap(2, lambda a, b: a - b)),
-        # Bit shift precedence
-        seq(child, wo >> ist(">>") << wo, child).map(opmap(2, lambda a, b: a >> b)),
-        seq(child, wo >> ist("<<") << wo, child).map(opmap(2, lambda a, b: a << b)),
-        # Bitwise operation precedence
-        seq(child, wo >> ist("&") << wo, child).map(opmap(2, lambda a, b: a & b)),
-        seq(child, wo >> ist("^") << wo, child).map(opmap(2, lambda a, b: a ^ b)),
-        seq(child, wo >> ist("|") << wo, child).map(opmap(2, lambda a, b: a | b)),
-        # Logical (1 or 0) operation precedence
-        seq(child, wo >> ist("&&") << wo, child).map(
-            opmap(2, lambda a, b: 1 if (a and b) else 0)
-        ),
-        seq(child, wo >> ist("||") << wo, child).map(
-            opmap(2, lambda a, b: 1 if (a or b) else 0)
-        ),
-        seq(child, wo >> ist("^^") << wo, child).map(
-            opmap(2, lambda a, b: 1 if ((a == 0) != (b == 0)) else 0)
-        ),
-        # Ternary operation precedence
-        seq(child, wo >> ist("?") << wo, child, wo >> ist(":") << wo, child).map(
-            lambda cond, _, yes, _2, no: (
-                (lambda cond, yes, no: yes if cond else no),
-                (cond, yes, no),
-            )
-        ),
-        # Comma operation precedence
-        seq(child, ist(","), child).map(opmap(2, lambda a, b: b)),
-    ]
 
+def _eval_ternary(cond, yes, no):
+    return yes if cond else no
 
-@generate
-def eval_operation():
-    res = None
 
-    for o in make_operators(eval_body_child):
-        if res is None:
-            res = o
+def _eval_comma(a, b):
+    return b
 
-        else:
-            res = res | o
 
-    return res
-    yield
+eval_prefix_operators = {
+    "+": operator.pos,
+    "-": operator.neg,
+    "ROUND": int,
+    "FLOOR": math.floor,
+    "CEIL": math.ceil,
+    "SIN": math.sin,
+    "COS": math.cos,
+    "TAN": math.tan,
+    "ASIN": math.asin,
+    "ACOS": math.acos,
+    "ATAN": math.atan,
+    "PI": _eval_pi,
+}
 
+# operator -> (precedence, function); higher binds tighter
+eval_infix_operators = {
+    ",": (1, _eval_comma),
+    "?": (2, _eval_ternary),
+    "||": (3, _eval_or),
+    "^^": (4, _eval_xor),
+    "&&": (5, _eval_and),
+    "|": (6, operator.or_),
+    "^": (7, operator.xor),
+    "&": (8, operator.and_),
+    ">>": (9, operator.rshift),
+    "<<": (9, operator.lshift),
+    "+": (10, operator.add),
+    "-": (10, operator.sub),
+    "%": (11, operator.mod),
+    "*": (11, operator.mul),
+    "/": (11, operator.truediv),
+    "//": (11, operator.floordiv),
+}
 
-@generate
-def numeric_eval():
-    return ist("e") >> wo >> s("{") >> eval_body << s("}")
-    yield
+eval_ws_re = re.compile(r"\s*")
+eval_prefix_re = re.compile(
+    r"[\+\-]|(?:round|floor|ceil|sin|cos|tan|asin|acos|atan|pi)\b", re.I
+)
+eval_infix_re = re.compile(r"//|>>|<<|&&|\|\||\^\^|[%\*/\+\-&\^\|\?,]")
+eval_float_re = re.compile(r"(?:\d+\.\d*|\.\d+)(?:[Ee][\-\+]?\d+)?")
+eval_int_re = re.compile(r"0[xX][0-9a-fA-F]+|0[oO][0-7]+|0[bB][01]+|\d+")
+eval_variable_re = re.compile(r"[a-zA-Z_\$][a-zA-Z0-9_\$\[\]]*")
 
 
-@generate
-def literal():
-    return (
-        call_literal.tag("call expr").desc("call")
-        | format_string_literal.tag("format string")
-        | numeric_eval.tag("eval")
-        | string_literal.tag("string").desc("string")
-        | variable_name.tag("actor variable").desc("actor variable")
-        | number_lit.desc("number")
-    )
-    yield
+def _eval_operand(stream, index):
+    index = eval_ws_re.match(stream, index).end()
+
+    m = eval_prefix_re.match(stream, index)
+
+    if m:
+        res = _eval_climb(stream, m.end(), len(eval_infix_operators) + 1)
+
+        if res.status:
+            func = eval_prefix_operators[m.group(0).upper()]
+            return Result.success(res.index, ("operation", (func, (res.value,))))
+
+        if m.group(0) in "+-":
+            return res
+
+        # a variable that happens to be named like a prefix function
+
+    if stream.startswith("(", index):
+        res = _eval_climb(stream, index + 1, 0)
 
+        if not res.status:
+            return res
 
-@generate
-def array_literal():
-    return (wo >> s("{") >> wo >> expression.sep_by(s(",") << wo) << s("}")).tag(
-        "array"
+        index = eval_ws_re.match(stream, res.index).end()
+
+        if not stream.startswith(")", index):
+            return Result.failure(index, "')'").aggregate(res)
+
+        return Result.success(index + 1, res.value)
+
+    m = eval_float_re.match(stream, index)
+
+    if m:
+        return Result.success(m.end(), ("literal", ("number", float(m.group(0)))))
+
+    m = eval_int_re.match(stream, index)
+
+    if m:
+        digits = m.group(0)
+
+        # only prefixed literals are in another base; 010 is still ten
+        value = int(digits, 0) if digits[1:2].isalpha() else int(digits)
+        return Result.success(m.end(), ("literal", ("number", value)))
+
+    m = eval_variable_re.match(stream, index)
+
+    if m:
+        return Result.success(m.end(), ("literal", ("actor variable", m.group(0))))
+
+    return Result.failure(index, "evaluation operand")
+
+
+def _eval_climb(stream, index, min_prec):
+    res = _eval_operand(stream, index)
+
+    if not res.status:
+        return res
+
+    left = res.value
+    index = res.index
+
+    while True:
+        op_index = eval_ws_re.match(stream, index).end()
+        m = eval_infix_re.match(stream, op_index)
+
+        if not m:
+            break
+
+        prec, func = eval_infix_operators[m.group(0)]
+
+        if prec < min_prec:
+            break
+
+        if m.group(0) == "?":
+            # right-associative; the middle operand extends up to the colon
+            yes = _eval_climb(stream, m.end(), 0)
+
+            if not yes.status:
+                return yes
+
+            colon = eval_ws_re.match(stream, yes.index).end()
+
+            if not stream.startswith(":", colon):
+                return Result.failure(colon, "':'").aggregate(yes)
+
+            no = _eval_climb(stream, colon + 1, prec)
+
+            if not no.status:
+                return no
+
+            left = ("operation", (func, (left, yes.value, no.value)))
+            index = no.index
+
+        else:
+            right = _eval_climb(stream, m.end(), prec + 1)
+
+            if not right.status:
+                return right
+
+            left = ("operation", (func, (left, right.value)))
+            index = right.index
+
+    return Result.success(index, left).aggregate(
+        Result.failure(index, "evaluation operator")
     )
-    yield
 
 
-@generate
-def paren_expr():
-    return s("(") >> expression << s(")")
-    yield
+@Parser
+def eval_body(stream, index):
+    res = _eval_climb(stream, index, 0)
 
+    if not res.status:
+        return res
 
-@generate
-def expression():
-    return (
-        wo
-        >> (
-            (
-                paren_expr.tag("paren expr").desc("parenthetic expression")
-                | literal.tag("literal")
-                | regex(r"[\+\-\|\>\<\~\&\!\=\*\/\%\[\]]+")
-                .desc("operator")
-                .tag("operator")
+    return Result.success(eval_ws_re.match(stream, res.index).end(), res.value)
+
+
+numeric_eval.become(ist("e") >> wo >> s("{") >> eval_body << s("}"))
+
+
+literal = packrat(
+    "literal",
+    call_literal.tag("call expr").desc("call")
+    | format_string_literal.tag("format string")
+    | numeric_eval.tag("eval")
+    | string_literal.tag("string").desc("string")
+    | variable_name.tag("actor variable").desc("actor variable")
+    | number_lit.desc("number"),
+)
+
+
+array_literal = (wo >> s("{") >> wo >> expression.sep_by(s(",") << wo) << s("}")).tag(
+    "array"
+)
+
+
+paren_expr = s("(") >> expression << s(")")
+
+
+expression.become(
+    packrat(
+        "expression",
+        (
+            wo
+            >> (
+                (
+                    paren_expr.tag("paren expr").desc("parenthetic expression")
+                    | literal.tag("literal")
+                    | regex(r"[\+\-\|\>\<\~\&\!\=\*\/\%\[\]]+")
+                    .desc("operator")
+                    .tag("operator")
+                )
+                .sep_by(wo)
+                .tag("expr")
             )
-            .sep_by(wo)
-            .tag("expr")
+            << wo
         )
-        << wo
-    ) | (wo >> paren_expr.tag("paren expr") << wo)
-    yield
+        | (wo >> paren_expr.tag("paren expr") << wo),
+    )
+)
 
 
-@generate
-def arg_expression():
-    return parameter.tag("position arg").desc("positional argument value")
-    yield
+arg_expression = parameter.tag("position arg").desc("positional argument value")
 
 
-@generate
-def argument_list():
-    return (literal).sep_by(regex(r",\s*"))
-    yield
+argument_list = (literal).sep_by(regex(r",\s*"))
 
 
-@generate
-def macro_argument_list():
-    return (
-        wo
-        >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*")
-        .desc("macro argument name")
-        .sep_by(regex(r",\s*"))
-        << wo
-    )
-    yield
+macro_argument_list = (
+    wo
+    >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*")
+    .desc("macro argument name")
+    .sep_by(regex(r",\s*"))
+    << wo
+)
 
 
-@generate
-def template_parameter_list():
-    return (
-        wo
-        >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*")
-        .desc("template parameter name")
-        .sep_by(regex(r",\s*"))
-        << wo
-    )
-    yield
+template_parameter_list = (
+    wo
+    >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*")
+    .desc("template parameter name")
+    .sep_by(regex(r",\s*"))
+    << wo
+)
 
 
-@generate
-def expr_argument_list():
-    return arg_expression.sep_by(s(",") >> wo)
-    yield
+expr_argument_list = arg_expression.sep_by(s(",") >> wo)
 
 
-@generate
-def parameter():
-    return (
-        anonymous_class
-        | anonymous_macro
-        | templated_class_derivation
-        | expression.tag("expression")
+parameter.become(
+    packrat(
+        "parameter",
+        (
+            anonymous_class
+            | anonymous_macro
+            | templated_class_derivation
+            | expression.tag("expression")
+        ),
     )
-    yield
+)
 
 
 def specialized_parameter_list(ptype):
-    @generate
-    def plist():
-        return ptype.sep_by(s(",") >> wo, min=1)
-        yield
-
-    return plist
+    return ptype.sep_by(s(",") >> wo, min=1)
 
 
 parameter_list = specialized_parameter_list(parameter)
 
 
-@generate
-def actor_function_call():
-    return (
-        ist("call ")
-        .desc("'call' statement")
-        .then(regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("called function name"))
-    )
-    yield
+actor_function_call = (
+    ist("call ")
+    .desc("'call' statement")
+    .then(regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("called function name"))
+)
 
 
-@generate
-def state_call():
-    return seq(
-        regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("called state function name").skip(wo),
-        s("(").then(wo).then(expr_argument_list).skip(wo).skip(s(")")).optional(),
-    )
-    yield
+state_call = seq(
+    regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("called state function name").skip(wo),
+    s("(").then(wo).then(expr_argument_list).skip(wo).skip(s(")")).optional(),
+)
 
 
-@generate
-def return_statement():
-    return (wo >> ist("return")).desc("return statement")
-    yield
+return_statement = (wo >> ist("return")).desc("return statement")
 
 
-@generate
-def continue_statement():
-    return (wo >> ist("continue")).desc("continue statement")
-    yield
+continue_statement = (wo >> ist("continue")).desc("continue statement")
 
 
-@generate
-def break_statement():
-    return (wo >> ist("break")).desc("break statement")
-    yield
+break_statement = (wo >> ist("break")).desc("break statement")
 
 
-@generate
-def call_literal():
-    return seq(
-        regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("called expression function name") << wo,
-        (s("(") >> wo >> expr_argument_list << wo << s(")")),
+call_literal.become(
+    packrat(
+        "call_literal",
+        seq(
+            regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("called expression function name")
+            << wo,
+            (s("(") >> wo >> expr_argument_list << wo << s(")")),
+        ),
     )
-    yield
+)
 
 
-@generate
-def label():
-    return (
-        seq(
-            ((ist("label") | ist("state")) << whitespace)
-            >> regex(r"[a-zA-Z\_\-]+").desc("label name").tag("name"),
-            state_body.tag("body"),
-        ).map(dict)
-        << wo
-    )
-    yield
+label = (
+    seq(
+        ((ist("label") | ist("state")) << whitespace)
+        >> regex(r"[a-zA-Z\_\-]+").desc("label name").tag("name"),
+        state_body.tag("body"),
+    ).map(dict)
+    << wo
+)
 
 
 def expression_not_empty(expr):
@@ -506,519 +629,486 @@ def expression_not_empty(expr):
         return bool(expr)
 
 
-@generate
-def templated_class_derivation():
-    return seq(
-        regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("name of templated class").skip(wo),
-        (
-            (s("::()") >> success([]))
-            | (s("::(").then(wo).then(parameter_list).skip(wo).skip(s(")")))
-        ),
-        (
-            (whitespace >> (ist("inherits") | ist("extends") | ist("expands")))
-            >> whitespace
-            >> superclass.desc("inherited class")
-        )
-        .optional()
-        .tag("inheritance")
-        .desc("inherited class name"),
-        ((ist("group") << whitespace) >> group_name << whitespace)
-        .optional()
-        .map(lambda x: x or None)
-        .tag("group"),
-        (
-            wo.then(s("{"))
-            .then(
-                wo.then(
-                    (
-                        ((ist("is") << whitespace) | string("+"))
-                        >> regex(r"[a-zA-Z0-9_\.]+").desc("flag name")
-                    ).tag("flag")
-                    | (
-                        ((ist("isn't") << whitespace) | string("-"))
-                        >> regex(r"[a-zA-Z0-9_\.]+").desc("flag name")
-                    ).tag("unflag")
-                    | ist("macro")
-                    .then(whitespace)
-                    .then(
-                        seq(
-                            regex(r"[a-zA-Z\_][a-zA-Z\_0-9]*")
-                            .desc("macro name")
-                            .tag("name"),
-                            (wo >> s("(") >> macro_argument_list << s(")") << wo)
-                            .optional()
-                            .map(lambda a: a or [])
-                            .tag("args"),
-                            state_body.tag("body"),
-                        )
-                        .map(dict)
-                        .tag("macro")
-                    )
-                    | seq(
-                        (ist("set") >> whitespace).desc("'set' keyword")
-                        >> regex(r"[a-zA-Z0-9\_\.]+").tag("name"),
+templated_class_derivation.become(
+    packrat(
+        "templated_class_derivation",
+        seq(
+            regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("name of templated class").skip(wo),
+            (
+                (s("::()") >> success([]))
+                | (s("::(").then(wo).then(parameter_list).skip(wo).skip(s(")")))
+            ),
+            (
+                (whitespace >> (ist("inherits") | ist("extends") | ist("expands")))
+                >> whitespace
+                >> superclass.desc("inherited class")
+            )
+            .optional()
+            .tag("inheritance")
+            .desc("inherited class name"),
+            ((ist("group") << whitespace) >> group_name << whitespace)
+            .optional()
+            .map(lambda x: x or None)
+            .tag("group"),
+            (
+                wo.then(s("{"))
+                .then(
+                    wo.then(
                         (
-                            (whitespace >> ist("to") << whitespace)
-                            | (wo >> s("=") << wo)
-                        ).desc("'to' or equal sign")
-                        >> parameter.sep_by((s(",") << wo)).tag("value"),
-                    )
-                    .map(dict)
-                    .tag("property")
-                    | label.desc("override label").tag("label")
-                    | (
-                        (ist("var") << whitespace)
-                        >> seq(
-                            regex(r"user_[a-zA-Z0-9_]+").desc("var name").tag("name"),
-                            (wo.then(s("[")).then(replaceable_number).skip(s("]")))
-                            .optional()
-                            .map(lambda x: int(x or 0))
-                            .tag("size"),
-                            (
-                                wo.then(s(":"))
-                                .then(wo)
-                                .then(regex(r"[a-zA-Z_.][a-zA-Z0-9_]+"))
+                            ((ist("is") << whitespace) | string("+"))
+                            >> regex(r"[a-zA-Z0-9_\.]+").desc("flag name")
+                        ).tag("flag")
+                        | (
+                            ((ist("isn't") << whitespace) | string("-"))
+                            >> regex(r"[a-zA-Z0-9_\.]+").desc("flag name")
+                        ).tag("unflag")
+                        | ist("macro")
+                        .then(whitespace)
+                        .then(
+                            seq(
+                                regex(r"[a-zA-Z\_][a-zA-Z\_0-9]*")
+                                .desc("macro name")
+                                .tag("name"),
+                                (wo >> s("(") >> macro_argument_list << s(")") << wo)
+                                .optional()
+                                .map(lambda a: a or [])
+                                .tag("args"),
+                                state_body.tag("body"),
                             )
-                            .desc("var type")
-                            .optional()
-                            .map(lambda t: t or "int")
-                            .tag("type"),
+                            .map(dict)
+                            .tag("macro")
+                        )
+                        | seq(
+                            (ist("set") >> whitespace).desc("'set' keyword")
+                            >> regex(r"[a-zA-Z0-9\_\.]+").tag("name"),
+                            (
+                                (whitespace >> ist("to") << whitespace)
+                                | (wo >> s("=") << wo)
+                            ).desc("'to' or equal sign")
+                            >> parameter.sep_by((s(",") << wo)).tag("value"),
                         )
                         .map(dict)
-                        .tag("user var")
-                    )
-                    | (
-                        (ist("array") << whitespace)
-                        .map(dict)
-                        .desc("override array")
-                        .tag("array")
+                        .tag("property")
+                        | label.desc("override label").tag("label")
+                        | (
+                            (ist("var") << whitespace)
+                            >> seq(
+                                regex(r"user_[a-zA-Z0-9_]+")
+                                .desc("var name")
+                                .tag("name"),
+                                (wo.then(s("[")).then(replaceable_number).skip(s("]")))
+                                .optional()
+                                .map(lambda x: int(x or 0))
+                                .tag("size"),
+                                (
+                                    wo.then(s(":"))
+                                    .then(wo)
+                                    .then(regex(r"[a-zA-Z_.][a-zA-Z0-9_]+"))
+                                )
+                                .desc("var type")
+                                .optional()
+                                .map(lambda t: t or "int")
+                                .tag("type"),
+                            )
+                            .map(dict)
+                            .tag("user var")
+                        )
+                        | (
+                            (ist("array") << whitespace)
+                            .map(dict)
+                            .desc("override array")
+                            .tag("array")
+                        )
+                        | mod_block.tag("mod")
                     )
-                    | mod_block.tag("mod")
+                    .skip(wo)
+                    .skip(s(";").optional().optional())
+                    .skip(wo)
+                    .many()
+                    .optional()
                 )
-                .skip(wo)
-                .skip(s(";").optional().optional())
-                .skip(wo)
-                .many()
-                .optional()
+                .skip(s("}"))
             )
-            .skip(s("}"))
-        )
-        .optional()
-        .map(lambda x: x or []),
-    ).tag("template derivation")
-    yield
+            .optional()
+            .map(lambda x: x or []),
+        ).tag("template derivation"),
+    )
+)
 
 
-@generate
-def static_template_derivation():
-    return (
-        wo
-        >> (
-            # anonymous derive
-            seq(
-                (ist("derive") >> success(None) << whitespace).tag("classname"),
-                (
-                    ((ist("inherits") | ist("extends") | ist("expands")))
-                    >> whitespace
-                    >> superclass.desc("inherited class")
-                )
-                .optional()
-                .tag("inheritance")
-                .desc("inherited class name"),
-                ((ist("group") << whitespace) >> group_name << whitespace)
-                .optional()
-                .map(lambda x: x or None)
-                .tag("group"),
-                ist("a") >> whitespace >> templated_class_derivation.tag("source"),
+static_template_derivation = (
+    wo
+    >> (
+        # anonymous derive
+        seq(
+            (ist("derive") >> success(None) << whitespace).tag("classname"),
+            (
+                ((ist("inherits") | ist("extends") | ist("expands")))
+                >> whitespace
+                >> superclass.desc("inherited class")
             )
-            # named derive
-            | seq(
-                ist("derive")
+            .optional()
+            .tag("inheritance")
+            .desc("inherited class name"),
+            ((ist("group") << whitespace) >> group_name << whitespace)
+            .optional()
+            .map(lambda x: x or None)
+            .tag("group"),
+            ist("a") >> whitespace >> templated_class_derivation.tag("source"),
+        )
+        # named derive
+        | seq(
+            ist("derive")
+            >> whitespace
+            >> (formattable_classname.desc("name of derived class")).tag("classname")
+            << whitespace,
+            (
+                ((ist("inherits") | ist("extends") | ist("expands")))
                 >> whitespace
-                >> (formattable_classname.desc("name of derived class")).tag(
-                    "classname"
-                )
-                << whitespace,
-                (
-                    ((ist("inherits") | ist("extends") | ist("expands")))
-                    >> whitespace
-                    >> superclass.desc("inherited class")
-                    << whitespace
-                )
-                .optional()
-                .tag("inheritance")
-                .desc("inherited class name"),
-                ((ist("group") << whitespace) >> group_name << whitespace)
-                .optional()
-                .map(lambda x: x or None)
-                .tag("group"),
-                ist("as") >> whitespace >> templated_class_derivation.tag("source"),
+                >> superclass.desc("inherited class")
+                << whitespace
             )
+            .optional()
+            .tag("inheritance")
+            .desc("inherited class name"),
+            ((ist("group") << whitespace) >> group_name << whitespace)
+            .optional()
+            .map(lambda x: x or None)
+            .tag("group"),
+            ist("as") >> whitespace >> templated_class_derivation.tag("source"),
         )
-        << s(";").optional()
-        << wo
     )
-    yield
+    << s(";").optional()
+    << wo
+)
 
 
-@generate
-def mod_name():
-    return regex(r"[a-zA-Z_-][a-zA-Z_0-9-]+")
-    yield
+mod_name = regex(r"[a-zA-Z_-][a-zA-Z_0-9-]+")
 
 
-@generate
-def mod_block():
-    return (
+mod_block.become(
+    (
         seq(
             (ist("mod") << whitespace) >> mod_name.desc("modifier name"), mod_block_body
         )
         << wo
     )
-    yield
+)
 
 
-@generate
-def nested_class_body():
-    return s("{") >> class_body.many().optional() << s("}")
-    yield
+nested_class_body = s("{") >> class_body.many().optional() << s("}")
 
 
-@generate
-def class_body():
-    return (
-        wo.then(
-            seq(
-                ist("macro")
-                >> whitespace
-                >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("macro name").tag("name"),
-                (wo >> s("(") >> macro_argument_list << s(")") << wo)
-                .optional()
-                .map(lambda a: a or [])
-                .tag("args"),
-                state_body.tag("body"),
-            )
-            .map(dict)
-            .tag("macro")
-            | seq(
-                (ist("set") >> whitespace).desc("'set' keyword")
-                >> regex(r"[a-zA-Z0-9_\.]+").tag("name"),
-                ((whitespace >> ist("to") << whitespace) | (wo >> s("=") << wo)).desc(
-                    "'to' or equal sign"
+class_body.become(
+    packrat(
+        "class_body",
+        (
+            wo.then(
+                seq(
+                    ist("macro")
+                    >> whitespace
+                    >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("macro name").tag("name"),
+                    (wo >> s("(") >> macro_argument_list << s(")") << wo)
+                    .optional()
+                    .map(lambda a: a or [])
+                    .tag("args"),
+                    state_body.tag("body"),
                 )
-                >> parameter.sep_by((s(",") << wo)).tag("value"),
-            )
-            .map(dict)
-            .tag("property")
-            | (
-                ((ist("is") << whitespace) | string("+"))
-                >> regex(r"[a-zA-Z0-9_\.]+").desc("flag name")
-            ).tag("flag")
-            | (ist("var") << whitespace)
-            >> seq(
-                regex(r"user_[a-zA-Z0-9_]+").desc("var name").tag("name"),
-                (wo >> s("[") >> replaceable_number << s("]"))
-                .desc("array size")
-                .optional()
-                .map(lambda x: int(x or 0))
-                .tag("size"),
-                (wo >> s(":") >> wo >> regex(r"[a-zA-Z_.][a-zA-Z0-9_]+"))
-                .desc("var type")
-                .optional()
-                .map(lambda t: t or "int")
-                .tag("type"),
-            )
-            .map(dict)
-            .tag("user var")
-            | (
-                ((ist("isn't") << whitespace) | string("-"))
-                >> regex(r"[a-zA-Z0-9_\.]+").desc("flag name")
-            ).tag("unflag")
-            | (
-                ist("combo") >> whitespace >> regex(r"[a-zA-Z0-9_]+").desc("combo name")
-            ).tag("flag combo")
-            | seq(
-                (ist("function ") | ist("method "))
-                >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("function name").tag("name"),
-                state_body.tag("body"),
-            )
-            .map(dict)
-            .tag("function")
-            | label.tag("label")
-            | mod_block.tag("mod")
-            | global_apply.tag("apply")
-            | class_for_loop.tag("for")
-        ).skip(wo)
-        << s(";").optional()
-        << wo
+                .map(dict)
+                .tag("macro")
+                | seq(
+                    (ist("set") >> whitespace).desc("'set' keyword")
+                    >> regex(r"[a-zA-Z0-9_\.]+").tag("name"),
+                    (
+                        (whitespace >> ist("to") << whitespace) | (wo >> s("=") << wo)
+                    ).desc("'to' or equal sign")
+                    >> parameter.sep_by((s(",") << wo)).tag("value"),
+                )
+                .map(dict)
+                .tag("property")
+                | (
+                    ((ist("is") << whitespace) | string("+"))
+                    >> regex(r"[a-zA-Z0-9_\.]+").desc("flag name")
+                ).tag("flag")
+                | (ist("var") << whitespace)
+                >> seq(
+                    regex(r"user_[a-zA-Z0-9_]+").desc("var name").tag("name"),
+                    (wo >> s("[") >> replaceable_number << s("]"))
+                    .desc("array size")
+                    .optional()
+                    .map(lambda x: int(x or 0))
+                    .tag("size"),
+                    (wo >> s(":") >> wo >> regex(r"[a-zA-Z_.][a-zA-Z0-9_]+"))
+                    .desc("var type")
+                    .optional()
+                    .map(lambda t: t or "int")
+                    .tag("type"),
+                )
+                .map(dict)
+                .tag("user var")
+                | (
+                    ((ist("isn't") << whitespace) | string("-"))
+                    >> regex(r"[a-zA-Z0-9_\.]+").desc("flag name")
+                ).tag("unflag")
+                | (
+                    ist("combo")
+                    >> whitespace
+                    >> regex(r"[a-zA-Z0-9_]+").desc("combo name")
+                ).tag("flag combo")
+                | seq(
+                    (ist("function ") | ist("method "))
+                    >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*")
+                    .desc("function name")
+                    .tag("name"),
+                    state_body.tag("body"),
+                )
+                .map(dict)
+                .tag("function")
+                | label.tag("label")
+                | mod_block.tag("mod")
+                | global_apply.tag("apply")
+                | class_for_loop.tag("for")
+            ).skip(wo)
+            << s(";").optional()
+            << wo
+        ),
     )
-    yield
+)
 
 
-@generate
-def abstract_label_body():
-    return (
-        (ist("abstract label") | ist("abstract state"))
-        >> whitespace
-        >> regex(r"[a-zA-Z_]+").desc("label name")
-        << s(";").optional()
-    )
-    yield
+abstract_label_body = (
+    (ist("abstract label") | ist("abstract state"))
+    >> whitespace
+    >> regex(r"[a-zA-Z_]+").desc("label name")
+    << s(";").optional()
+)
 
 
-@generate
-def abstract_array_body():
-    return (
-        seq(
-            ist("abstract array")
-            >> whitespace
-            >> regex(r"user_[a-zA-Z0-9_]+").desc("array name").tag("name"),
-            (wo >> s("[") >> replaceable_number << s("]"))
-            .optional()
-            .map(lambda x: int(x) if x else "any")
-            .tag("size"),
-            (wo >> s(":") >> wo >> regex(r"[a-zA-Z_.][a-zA-Z0-9_]+"))
-            .desc("var type")
-            .optional()
-            .map(lambda t: t or "int")
-            .tag("type"),
-        ).map(dict)
-        << wo
-        << s(";").optional()
-        << wo
-    )
-    yield
+abstract_array_body = (
+    seq(
+        ist("abstract array")
+        >> whitespace
+        >> regex(r"user_[a-zA-Z0-9_]+").desc("array name").tag("name"),
+        (wo >> s("[") >> replaceable_number << s("]"))
+        .optional()
+        .map(lambda x: int(x) if x else "any")
+        .tag("size"),
+        (wo >> s(":") >> wo >> regex(r"[a-zA-Z_.][a-zA-Z0-9_]+"))
+        .desc("var type")
+        .optional()
+        .map(lambda t: t or "int")
+        .tag("type"),
+    ).map(dict)
+    << wo
+    << s(";").optional()
+    << wo
+)
 
 
-@generate
-def abstract_macro_body():
-    return (
-        seq(
-            ist("abstract macro")
-            >> whitespace
-            >> regex(r"[a-zA-Z_]+").desc("macro name").tag("name")
-            << wo,
-            (s("(") >> wo >> macro_argument_list << wo << s(")"))
-            .optional()
-            .map(lambda x: x or [])
-            .tag("args"),
-        ).map(dict)
-        << wo
-        << s(";").optional()
-        << wo
-    )
-    yield
+abstract_macro_body = (
+    seq(
+        ist("abstract macro")
+        >> whitespace
+        >> regex(r"[a-zA-Z_]+").desc("macro name").tag("name")
+        << wo,
+        (s("(") >> wo >> macro_argument_list << wo << s(")"))
+        .optional()
+        .map(lambda x: x or [])
+        .tag("args"),
+    ).map(dict)
+    << wo
+    << s(";").optional()
+    << wo
+)
 
 
-@generate
-def sprite_name():
-    return (regex(r"[A-Z0-9_]{4}") | s('"####"') | s("####")).tag("normal") | (
-        ist("param") >> whitespace >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*")
-    ).tag("parametrized")
-    yield
+sprite_name = (regex(r"[A-Z0-9_]{4}") | s('"####"') | s("####")).tag("normal") | (
+    ist("param") >> whitespace >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*")
+).tag("parametrized")
 
 
-@generate
-def superclass():
-    return templated_class_derivation | regex(r"[a-zA-Z][a-zA-Z0-9_]+").tag("classname")
-    yield
+superclass.become(
+    templated_class_derivation | regex(r"[a-zA-Z][a-zA-Z0-9_]+").tag("classname")
+)
 
 
-@generate
-def group_declaration():
-    return (
-        seq(
-            (
-                (ist("group") << whitespace).desc("group statement") >> wo >> group_name
-            ).tag("name"),
-            (wo >> s("{") >> regex(r"[a-zA-Z0-9_]+").sep_by(s(",") << wo) << s("}"))
-            .optional()
-            .map(lambda x: x if x and tuple(x) != ("",) else [])
-            .tag("items"),
-        )
-        << s(";").optional()
-    )
-    yield
-
-
-@generate
-def actor_class():
-    return seq(
-        ((ist("actor") | ist("class")) << whitespace).desc("class statement")
-        >> formattable_classname.desc("class name").tag("classname"),
-        ((whitespace >> ist("group") << whitespace).desc("group keyword") >> group_name)
-        .optional()
-        .map(lambda x: x or None)
-        .tag("group"),
-        (
-            (whitespace >> (ist("inherits") | ist("extends") | ist("expands")))
-            >> whitespace
-            >> superclass.desc("inherited class")
-        )
-        .optional()
-        .tag("inheritance")
-        .desc("inherited class name"),
-        (whitespace >> (ist("replaces") >> whitespace >> regex(r"[a-zA-Z0-9_]+")))
-        .desc("replaced class name")
-        .optional()
-        .tag("replacement")
-        .desc("replacement"),
-        (whitespace >> s("#") >> regex(r"[0-9]+"))
-        .desc("class number")
-        .map(int)
+group_declaration = (
+    seq(
+        ((ist("group") << whitespace).desc("group statement") >> wo >> group_name).tag(
+            "name"
+        ),
+        (wo >> s("{") >> regex(r"[a-zA-Z0-9_]+").sep_by(s(",") << wo) << s("}"))
         .optional()
-        .tag("class number")
-        .desc("class number")
-        .skip(wo),
-        (
-            (s("{") >> wo >> class_body.many().optional() << wo.then(s("}")).skip(wo))
-            | s(";").optional().map(lambda _: [])
-        ).tag("body"),
+        .map(lambda x: x if x and tuple(x) != ("",) else [])
+        .tag("items"),
     )
-    yield
+    << s(";").optional()
+)
 
 
-@generate
-def templated_actor_class():
-    return seq(
-        (ist("actor") | ist("class") | ist("template")).desc("class template")
-        >> s("<")
-        >> template_parameter_list.tag("parameters")
-        << s(">")
-        << wo,
-        formattable_classname.desc("class name").tag("classname"),
-        ((whitespace >> ist("group") << whitespace).desc("group keyword") >> group_name)
-        .optional()
-        .map(lambda x: x or None)
-        .tag("group"),
-        (
-            (whitespace >> (ist("inherits") | ist("extends") | ist("expands")))
-            >> whitespace
-            >> superclass.desc("inherited class")
-        )
-        .optional()
-        .tag("inheritance")
-        .desc("inherited class name"),
-        (whitespace >> (ist("replaces") >> whitespace >> regex(r"[a-zA-Z0-9_]+")))
-        .desc("replaced class name")
-        .optional()
-        .tag("replacement")
-        .desc("replacement"),
-        (whitespace >> s("#") >> regex(r"[0-9]+"))
-        .desc("class number")
-        .map(int)
-        .optional()
-        .tag("class number")
-        .desc("class number")
-        .skip(wo),
-        (
-            s("{")
-            >> wo
-            >> (
-                abstract_macro_body.desc("abstract macro").tag("abstract macro")
-                | abstract_array_body.desc("abstract array").tag("abstract array")
-                | abstract_label_body.desc("abstract label").tag("abstract label")
-                | class_body
-            )
-            .many()
-            .optional()
-            << wo.then(s("}")).skip(wo)
-        ).tag("body"),
+actor_class = seq(
+    ((ist("actor") | ist("class")) << whitespace).desc("class statement")
+    >> formattable_classname.desc("class name").tag("classname"),
+    ((whitespace >> ist("group") << whitespace).desc("group keyword") >> group_name)
+    .optional()
+    .map(lambda x: x or None)
+    .tag("group"),
+    (
+        (whitespace >> (ist("inherits") | ist("extends") | ist("expands")))
+        >> whitespace
+        >> superclass.desc("inherited class")
     )
-    yield
+    .optional()
+    .tag("inheritance")
+    .desc("inherited class name"),
+    (whitespace >> (ist("replaces") >> whitespace >> regex(r"[a-zA-Z0-9_]+")))
+    .desc("replaced class name")
+    .optional()
+    .tag("replacement")
+    .desc("replacement"),
+    (whitespace >> s("#") >> regex(r"[0-9]+"))
+    .desc("class number")
+    .map(int)
+    .optional()
+    .tag("class number")
+    .desc("class number")
+    .skip(wo),
+    (
+        (s("{") >> wo >> class_body.many().optional() << wo.then(s("}")).skip(wo))
+        | s(";").optional().map(lambda _: [])
+    ).tag("body"),
+)
 
 
-@generate
-def anonymous_class():
-    return seq(
-        (ist("actor") | ist("class")).desc("class statement")
+templated_actor_class = seq(
+    (ist("actor") | ist("class") | ist("template")).desc("class template")
+    >> s("<")
+    >> template_parameter_list.tag("parameters")
+    << s(">")
+    << wo,
+    formattable_classname.desc("class name").tag("classname"),
+    ((whitespace >> ist("group") << whitespace).desc("group keyword") >> group_name)
+    .optional()
+    .map(lambda x: x or None)
+    .tag("group"),
+    (
+        (whitespace >> (ist("inherits") | ist("extends") | ist("expands")))
         >> whitespace
+        >> superclass.desc("inherited class")
+    )
+    .optional()
+    .tag("inheritance")
+    .desc("inherited class name"),
+    (whitespace >> (ist("replaces") >> whitespace >> regex(r"[a-zA-Z0-9_]+")))
+    .desc("replaced class name")
+    .optional()
+    .tag("replacement")
+    .desc("replacement"),
+    (whitespace >> s("#") >> regex(r"[0-9]+"))
+    .desc("class number")
+    .map(int)
+    .optional()
+    .tag("class number")
+    .desc("class number")
+    .skip(wo),
+    (
+        s("{")
+        >> wo
         >> (
-            (ist("inherits") | ist("extends") | ist("expands")).desc(
-                "inheritance declaration"
-            )
-            >> whitespace
-            >> superclass
+            abstract_macro_body.desc("abstract macro").tag("abstract macro")
+            | abstract_array_body.desc("abstract array").tag("abstract array")
+            | abstract_label_body.desc("abstract label").tag("abstract label")
+            | class_body
         )
-        .desc("inherited class name")
-        .optional()
-        .tag("inheritance")
-        << wo,
-        ((ist("group") << whitespace).desc("group keyword") >> group_name)
-        .optional()
-        .map(lambda x: x or None)
-        .tag("group"),
-        (ist("{") >> wo >> class_body.many().optional() << wo << ist("}") << wo)
+        .many()
         .optional()
-        .map(lambda x: x or [])
-        .tag("body"),
-    ).tag("anonymous class")
-    yield
+        << wo.then(s("}")).skip(wo)
+    ).tag("body"),
+)
 
 
-@generate
-def normal_state():
-    return (
+anonymous_class.become(
+    packrat(
+        "anonymous_class",
         seq(
-            sprite_name.desc("state name").skip(wo),
-            (regex(r"[A-Z_.\#]").many() | s('"#"') | s("#"))
-            .desc("state sprite")
-            .skip(wo),
-            regex(r"\-?\d+").map(int).desc("state duration").skip(wo),
-            modifier.many().desc("modifier").skip(wo).optional(),
-            state_action.optional(),
-        )
-        | seq(
-            ist("keepst").desc("'keepst' state").skip(whitespace)
-            >> regex(r"\-?\d+").map(int).desc("state duration").skip(wo),
-            modifier.many().desc("modifier").skip(wo).optional(),
-            state_action.optional(),
-        ).map(lambda l: [("normal", '"####"'), '"#"', *l])
-        | seq(
-            ist("invisi").desc("'invisi' state").skip(whitespace)
-            >> regex(r"\-?\d+")
-            .map(int)
-            .desc("state duration")
+            (ist("actor") | ist("class")).desc("class statement")
+            >> whitespace
+            >> (
+                (ist("inherits") | ist("extends") | ist("expands")).desc(
+                    "inheritance declaration"
+                )
+                >> whitespace
+                >> superclass
+            )
+            .desc("inherited class name")
+            .optional()
+            .tag("inheritance")
+            << wo,
+            ((ist("group") << whitespace).desc("group keyword") >> group_name)
             .optional()
-            .map(lambda x: x or 0)
-            .skip(wo),
-            modifier.many().desc("modifier").skip(wo).optional(),
-            state_action.optional(),
-        ).map(lambda l: [("normal", "TNT1"), "A", *l])
+            .map(lambda x: x or None)
+            .tag("group"),
+            (ist("{") >> wo >> class_body.many().optional() << wo << ist("}") << wo)
+            .optional()
+            .map(lambda x: x or [])
+            .tag("body"),
+        ).tag("anonymous class"),
     )
-    yield
+)
 
 
-@generate
-def state_action():
-    return (
+normal_state = (
+    seq(
+        sprite_name.desc("state name").skip(wo),
+        (regex(r"[A-Z_.\#]").many() | s('"#"') | s("#")).desc("state sprite").skip(wo),
+        regex(r"\-?\d+").map(int).desc("state duration").skip(wo),
+        modifier.many().desc("modifier").skip(wo).optional(),
+        state_action.optional(),
+    )
+    | seq(
+        ist("keepst").desc("'keepst' state").skip(whitespace)
+        >> regex(r"\-?\d+").map(int).desc("state duration").skip(wo),
+        modifier.many().desc("modifier").skip(wo).optional(),
+        state_action.optional(),
+    ).map(lambda l: [("normal", '"####"'), '"#"', *l])
+    | seq(
+        ist("invisi").desc("'invisi' state").skip(whitespace)
+        >> regex(r"\-?\d+")
+        .map(int)
+        .desc("state duration")
+        .optional()
+        .map(lambda x: x or 0)
+        .skip(wo),
+        modifier.many().desc("modifier").skip(wo).optional(),
+        state_action.optional(),
+    ).map(lambda l: [("normal", "TNT1"), "A", *l])
+)
+
+
+state_action.become(
+    (
         action_body_repeat.tag("repeated inline body")
         | state_call.tag("action")
         | action_body.tag("inline body")
     )
-    yield
+)
 
 
-@generate
-def action_body():
-    return (
+action_body.become(
+    (
         s("{")
         >> wo
         >> (state_action << s(";").optional() << wo).many().optional()
         << s("}")
     )
-    yield
+)
 
 
-@generate
-def replaceable_number():
-    return regex(r"\-?\d+") | variable_name
-    yield
+replaceable_number.become(regex(r"\-?\d+") | variable_name)
 
 
-@generate
-def action_body_repeat():
-    return seq(
+action_body_repeat.become(
+    seq(
         ist("x") >> wo >> replaceable_number.desc("amount of times to repeat"),
         (
             whitespace
@@ -1031,76 +1121,83 @@ def action_body_repeat():
         .map(lambda x: x or None),
         wo >> state_action,
     )
-    yield
-
-
-@generate
-def flow_control():
-    return (
-        ist("stop")
-        | ist("wait")
-        | ist("fail")
-        | ist("loop")
-        | ist("goto")
-        + whitespace.map(lambda _: " ")
-        + regex(r"[a-zA-Z0-9\_\-\:\.]+\s?(?:\+\d+)?")
-    )
-    yield
+)
 
 
-@generate
-def macro_call():
-    return seq(
-        (
-            ist("from")
-            .desc("'from' determiner")
-            .then(whitespace)
-            .then(regex(r"\@*[a-zA-Z_][a-zA-Z_0-9]*").desc("extern macro classname"))
-            .skip(whitespace)
-        )
-        .optional()
-        .map(lambda x: x or None),
-        ist("inject")
-        .desc("'inject' statement")
+flow_control = (
+    ist("stop")
+    | ist("wait")
+    | ist("fail")
+    | ist("loop")
+    | ist("goto")
+    + whitespace.map(lambda _: " ")
+    + regex(r"[a-zA-Z0-9\_\-\:\.]+\s?(?:\+\d+)?")
+)
+
+
+macro_call = seq(
+    (
+        ist("from")
+        .desc("'from' determiner")
         .then(whitespace)
-        .then(regex(r"\@*[a-zA-Z_][a-zA-Z_0-9]*").desc("injected macro name"))
-        .skip(wo),
-        (s("(") >> expr_argument_list.desc("macro arguments") << s(")"))
-        .optional()
-        .map(lambda x: x or []),
+        .then(regex(r"\@*[a-zA-Z_][a-zA-Z_0-9]*").desc("extern macro classname"))
+        .skip(whitespace)
     )
-    yield
-
-
-@generate
-def state():
-    return state_no_colon << s(";")
-    yield
-
-
-@generate
-def state_no_colon():
-    return (
-        return_statement.tag("return")
-        | break_statement.tag("break")
-        | continue_statement.tag("continue")
-        | if_statement.tag("if")
-        | ifjump_statement.tag("ifjump")
-        | whilejump_statement.tag("whilejump")
-        | for_statement.tag("for")
-        | sometimes_statement.tag("sometimes")
-        | while_statement.tag("while")
-        | actor_function_call.tag("call")
-        | apply_block.tag("apply")
-        | macro_call.tag("inject")
-        | flow_control.tag("flow")
-        | normal_state.tag("frames")
-        | repeat_statement.tag("repeat")
+    .optional()
+    .map(lambda x: x or None),
+    ist("inject")
+    .desc("'inject' statement")
+    .then(whitespace)
+    .then(regex(r"\@*[a-zA-Z_][a-zA-Z_0-9]*").desc("injected macro name"))
+    .skip(wo),
+    (s("(") >> expr_argument_list.desc("macro arguments") << s(")"))
+    .optional()
+    .map(lambda x: x or []),
+)
+
+
+state = packrat("state", state_no_colon << s(";"))
+
+
+state_no_colon.become(
+    packrat(
+        "state_no_colon",
+        (
+            return_statement.tag("return")
+            | break_statement.tag("break")
+            | continue_statement.tag("continue")
+            | if_statement.tag("if")
+            | ifjump_statement.tag("ifjump")
+            | whilejump_statement.tag("whilejump")
+            | for_statement.tag("for")
+            | sometimes_statement.tag("sometimes")
+            | while_statement.tag("while")
+            | actor_function_call.tag("call")
+            | apply_block.tag("apply")
+            | macro_call.tag("inject")
+            | flow_control.tag("flow")
+            | normal_state.tag("frames")
+            | repeat_statement.tag("repeat")
+        ),
     )
-    yield
+)
+
+
+def ast_factory(factory):
+    """Makes the functions returned by factory remember the call that made
+    them, so that ASTs holding them can be pickled (see zdcode.cache)."""
+
+    @functools.wraps(factory)
+    def make(arg):
+        func = factory(arg)
+        func.factory_call = (make, arg)
+        return func
+
+    return make
 
 
 # Modifier effect functions.
+@ast_factory
 def mod_flag(mod):
     def _eff(code, ctx, state):
         state = state.clone()
@@ -1114,6 +1211,7 @@ def mod_flag(mod):
     return _eff
 
 
+@ast_factory
 def mod_delflag(mod):
     def _eff(code, ctx, state):
         state = state.clone()
@@ -1130,6 +1228,7 @@ def mod_delflag(mod):
     return _eff
 
 
+@ast_factory
 def mod_prefix(pre):
     def _eff(code, ctx, state):
         yield from code._parse_state_expr(ctx, pre)
@@ -1138,6 +1237,7 @@ def mod_prefix(pre):
     return _eff
 
 
+@ast_factory
 def mod_suffix(pre):
     def _eff(code, ctx, state):
         yield state
@@ -1146,6 +1246,7 @@ def mod_suffix(pre):
     return _eff
 
 
+@ast_factory
 def mod_manipulate(pre):
     state_macro_name, state_body = pre
 
@@ -1160,34 +1261,28 @@ def mod_manipulate(pre):
     return _eff
 
 
-@generate
-def modifier_effect():
-    # A modifier effect.
-    return (
-        (ist("+flag").desc("+flag effect") >> whitespace >> state_modifier_name).map(
-            mod_flag
-        )
-        | (ist("-flag").desc("-flag effect") >> whitespace >> state_modifier_name).map(
-            mod_delflag
-        )
-        | (ist("prefix").desc("prefix effect") >> whitespace >> state_body).map(
-            mod_prefix
-        )
-        | (ist("suffix").desc("suffix effect") >> whitespace >> state_body).map(
-            mod_suffix
-        )
-        | (
-            ist("manipulate").desc("manipulate effect")
-            >> whitespace
-            >> seq(
-                regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("virtual macro name") << wo,
-                state_body.desc("manipulated state body template"),
-            )
-        ).map(mod_manipulate)
+# A modifier effect.
+modifier_effect = (
+    (ist("+flag").desc("+flag effect") >> whitespace >> state_modifier_name).map(
+        mod_flag
+    )
+    | (ist("-flag").desc("-flag effect") >> whitespace >> state_modifier_name).map(
+        mod_delflag
     )
-    yield
+    | (ist("prefix").desc("prefix effect") >> whitespace >> state_body).map(mod_prefix)
+    | (ist("suffix").desc("suffix effect") >> whitespace >> state_body).map(mod_suffix)
+    | (
+        ist("manipulate").desc("manipulate effect")
+        >> whitespace
+        >> seq(
+            regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("virtual macro name") << wo,
+            state_body.desc("manipulated state body template"),
+        )
+    ).map(mod_manipulate)
+)
 
 
+@ast_factory
 def selector_flag(name):
     def _sel(code, ctx, state):
         if not (hasattr(state, "keywords") and state.keywords):
@@ -1200,6 +1295,7 @@ def selector_flag(name):
     return _sel
 
 
+@ast_factory
 def selector_name(name):
     def _sel(code, ctx, state):
         return (
@@ -1210,6 +1306,7 @@ def selector_name(name):
     return _sel
 
 
+@ast_factory
 def selector_duration(duration):
     def _sel(code, ctx, state):
         return hasattr(state, "duration") and state.duration == duration
@@ -1217,112 +1314,129 @@ def selector_duration(duration):
     return _sel
 
 
-@generate
-def modifier_selector_basic():
-    # A basic state selector, the building blocks of a
-    # state selector in a modifier
+@ast_factory
+def selector_any(_):
+    def _sel(code, ctx, state):
+        return True
 
-    return (
-        (ist("flag") >> wo >> s("(") >> state_modifier_name << s(")")).map(
-            selector_flag
-        )
-        | (ist("sprite") >> wo >> s("(") >> sprite_name << s(")")).map(selector_name)
-        | (
-            ist("duration")
-            >> wo
-            >> s("(")
-            >> regex(r"\d+").optional().map(lambda x: int(x) if x else 0)
-            << s(")")
-        ).map(selector_duration)
-    )
-    yield
+    return _sel
 
 
-@generate
-def modifier_selector_expr():
-    # A selector is a sort of selection condition expression,
-    # where basic selectors are joined by boolean logic.
+@ast_factory
+def selector_not(sel):
+    def _sel(code, ctx, state):
+        return not sel(code, ctx, state)
 
-    return wo.then(
-        modifier_selector_basic
-        | ist("any").map(lambda _: (lambda _1, _2, _3: True)).desc("any selector")
-        | (ist("!").desc("not operator") >> wo >> modifier_selector_expr.skip(wo)).map(
-            lambda a: (lambda code, ctx, state: not a(code, ctx, state))
-        )
-        | (
-            s("(")
-            >> (
-                (
+    return _sel
+
+
+@ast_factory
+def selector_and(sels):
+    def _sel(code, ctx, state):
+        return sels[0](code, ctx, state) and sels[1](code, ctx, state)
+
+    return _sel
+
+
+@ast_factory
+def selector_or(sels):
+    def _sel(code, ctx, state):
+        return sels[0](code, ctx, state) or sels[1](code, ctx, state)
+
+    return _sel
+
+
+@ast_factory
+def selector_xor(sels):
+    def _sel(code, ctx, state):
+        return sels[0](code, ctx, state) != sels[1](code, ctx, state)
+
+    return _sel
+
+
+# A basic state selector, the building blocks of a
+# state selector in a modifier
+modifier_selector_basic = (
+    (ist("flag") >> wo >> s("(") >> state_modifier_name << s(")")).map(selector_flag)
+    | (ist("sprite") >> wo >> s("(") >> sprite_name << s(")")).map(selector_name)
+    | (
+        ist("duration")
+        >> wo
+        >> s("(")
+        >> regex(r"\d+").optional().map(lambda x: int(x) if x else 0)
+        << s(")")
+    ).map(selector_duration)
+)
+
+
+# A selector is a sort of selection condition expression,
+# where basic selectors are joined by boolean logic.
+modifier_selector_expr.become(
+    packrat(
+        "modifier_selector_expr",
+        wo.then(
+            modifier_selector_basic
+            | ist("any").map(selector_any).desc("any selector")
+            | (
+                ist("!").desc("not operator") >> wo >> modifier_selector_expr.skip(wo)
+            ).map(selector_not)
+            | (
+                s("(")
+                >> (
                     (
-                        seq(
-                            modifier_selector_expr.skip(
-                                wo >> ist("&&").desc("and operator")
-                            ),
-                            wo >> modifier_selector_expr.skip(wo),
-                        )
-                    ).map(
-                        lambda a: (
-                            lambda code, ctx, state: a[0](code, ctx, state)
-                            and a[1](code, ctx, state)
-                        )
-                    )
-                    | (
-                        seq(
-                            modifier_selector_expr.skip(
-                                wo >> ist("||").desc("or operator")
-                            ),
-                            wo >> modifier_selector_expr.skip(wo),
-                        )
-                    ).map(
-                        lambda a: (
-                            lambda code, ctx, state: a[0](code, ctx, state)
-                            or a[1](code, ctx, state)
-                        )
-                    )
-                    | (
-                        seq(
-                            modifier_selector_expr.skip(
-                                wo >> ist("^^").desc("xor operator")
-                            ),
-                            wo >> modifier_selector_expr.skip(wo),
-                        )
-                    ).map(
-                        lambda a: (
-                            lambda code, ctx, state: a[0](code, ctx, state)
-                            != a[1](code, ctx, state)
-                        )
+                        (
+                            seq(
+                                modifier_selector_expr.skip(
+                                    wo >> ist("&&").desc("and operator")
+                                ),
+                                wo >> modifier_selector_expr.skip(wo),
+                            )
+                        ).map(selector_and)
+                        | (
+                            seq(
+                                modifier_selector_expr.skip(
+                                    wo >> ist("||").desc("or operator")
+                                ),
+                                wo >> modifier_selector_expr.skip(wo),
+                            )
+                        ).map(selector_or)
+                        | (
+                            seq(
+                                modifier_selector_expr.skip(
+                                    wo >> ist("^^").desc("xor operator")
+                                ),
+                                wo >> modifier_selector_expr.skip(wo),
+                            )
+                        ).map(selector_xor)
                     )
+                    | modifier_selector_expr.skip(wo)
                 )
-                | modifier_selector_expr.skip(wo)
+                << s(")")
             )
-            << s(")")
-        )
+        ),
     )
-    yield
+)
 
 
-@generate
-def modifier_clause():
-    # One clause, a selector and its respective effects.
-    return seq(
-        wo >> modifier_selector_expr.skip(wo),
-        (
-            modifier_effect.map(lambda e: [e])
-            | (
-                s("{")
-                >> wo
-                >> (modifier_effect << wo << s(";").optional() << wo).at_least(1)
-                << s("}")
-            )
+# One clause, a selector and its respective effects.
+modifier_clause = seq(
+    wo >> modifier_selector_expr.skip(wo),
+    (
+        modifier_effect.map(lambda e: [e])
+        | (
+            s("{")
+            >> wo
+            >> (modifier_effect << wo << s(";").optional() << wo).at_least(1)
+            << s("}")
         )
-        << wo,
     )
-    yield
+    << wo,
+)
 
 
-@generate
-def mod_block_body():
-    return modifier_clause.map(lambda a: [a]) | (
+mod_block_body.become(
+    modifier_clause.map(lambda a: [a])
+    | (
         wo
         >> s("{")
         >> wo
@@ -1330,20 +1444,20 @@ def mod_block_body():
         << wo
         << s("}")
     )
-    yield
+)
 
 
-@generate
-def state_body():
-    return state_no_colon.map(lambda x: [x]) | (
-        wo >> string("{") >> wo >> (state).sep_by(wo) << wo << string("}")
+state_body.become(
+    packrat(
+        "state_body",
+        state_no_colon.map(lambda x: [x])
+        | (wo >> string("{") >> wo >> (state).sep_by(wo) << wo << string("}")),
     )
-    yield
+)
 
 
-@generate
-def sometimes_statement():
-    return seq(
+sometimes_statement.become(
+    seq(
         s("sometimes")
         >> whitespace
         >> (
@@ -1364,33 +1478,30 @@ def sometimes_statement():
         << wo,
         state_body.optional().map(lambda x: x if x is not None else []).tag("body"),
     )
-    yield
+)
 
 
-@generate
-def apply_block():
-    return seq(
+apply_block.become(
+    seq(
         ist("apply").desc("apply statement").then(whitespace).then(mod_name).skip(wo),
         state_body.desc("apply block body").skip(wo),
     )
-    yield
+)
 
 
-@generate
-def global_apply():
-    return (
+global_apply.become(
+    (
         ist("apply")
         .desc("class-scoped apply statement")
         .then(whitespace)
         .then(mod_block_body.tag("body") | mod_name.tag("name"))
         .skip(wo)
     )
-    yield
+)
 
 
-@generate
-def if_statement():
-    return seq(
+if_statement.become(
+    seq(
         ist("if")
         .desc("if statement")
         .then(wo)
@@ -1410,7 +1521,7 @@ def if_statement():
         .skip(wo)
         .optional(),
     )
-    yield
+)
 
 
 def for_template(bodytype):
@@ -1445,31 +1556,23 @@ def for_template(bodytype):
     )
 
 
-@generate
-def for_statement():
-    return for_template(state_body.optional().map(lambda x: x if x is not None else []))
-    yield
+for_statement.become(
+    for_template(state_body.optional().map(lambda x: x if x is not None else []))
+)
 
 
-@generate
-def static_for_loop():
-    return for_template(
-        nested_source_code.optional().map(lambda x: x if x is not None else [])
-    )
-    yield
+static_for_loop = for_template(
+    nested_source_code.optional().map(lambda x: x if x is not None else [])
+)
 
 
-@generate
-def class_for_loop():
-    return for_template(
-        nested_class_body.optional().map(lambda x: x if x is not None else [])
-    )
-    yield
+class_for_loop.become(
+    for_template(nested_class_body.optional().map(lambda x: x if x is not None else []))
+)
 
 
-@generate
-def ifjump_statement():
-    return seq(
+ifjump_statement.become(
+    seq(
         ist("ifjump")
         .desc("ifjump statement")
         .then(whitespace)
@@ -1485,12 +1588,11 @@ def ifjump_statement():
         .skip(wo)
         .optional(),
     )
-    yield
+)
 
 
-@generate
-def whilejump_statement():
-    return seq(
+whilejump_statement.become(
+    seq(
         ist("whilejump")
         .desc("whilejump statement")
         .then(whitespace)
@@ -1506,12 +1608,11 @@ def whilejump_statement():
         .skip(wo)
         .optional(),
     )
-    yield
+)
 
 
-@generate
-def while_statement():
-    return seq(
+while_statement.become(
+    seq(
         ist("while")
         .desc("while statement")
         .then(wo)
@@ -1531,12 +1632,11 @@ def while_statement():
         .skip(wo)
         .optional(),
     )
-    yield
+)
 
 
-@generate
-def repeat_statement():
-    return seq(
+repeat_statement.become(
+    seq(
         ist("x") >> wo >> replaceable_number.desc("amount of times to repeat"),
         (
             whitespace
@@ -1549,49 +1649,41 @@ def repeat_statement():
         .map(lambda x: x or None),
         wo >> state_body,
     )
-    yield
+)
 
 
-@generate
-def anonymous_macro():
-    return seq(
+anonymous_macro.become(
+    seq(
         ist("macro")
         >> (s("(") >> macro_argument_list << s(")") << wo)
         .optional()
         .map(lambda a: a or []),
         state_body,
     ).tag("anonymous macro")
-    yield
+)
 
 
-@generate
-def macro_def():
-    return (
-        seq(
-            ist("macro")
-            >> whitespace
-            >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("macro name").tag("name"),
-            (wo >> s("(") >> macro_argument_list << s(")") << wo)
-            .optional()
-            .map(lambda a: a or [])
-            .tag("args"),
-            state_body.tag("body"),
-        )
-        .map(dict)
-        .tag("macro")
+macro_def = (
+    seq(
+        ist("macro")
+        >> whitespace
+        >> regex(r"[a-zA-Z_][a-zA-Z_0-9]*").desc("macro name").tag("name"),
+        (wo >> s("(") >> macro_argument_list << s(")") << wo)
+        .optional()
+        .map(lambda a: a or [])
+        .tag("args"),
+        state_body.tag("body"),
     )
-    yield
+    .map(dict)
+    .tag("macro")
+)
 
 
-@generate
-def nested_source_code():
-    return ist("{") >> source_code << ist("}") << wo << ist(";")
-    yield
+nested_source_code.become(ist("{") >> source_code << ist("}") << wo << ist(";"))
 
 
-@generate
-def source_code():
-    return (
+source_code.become(
+    (
         wo.desc("ignored whitespace")
         >> (
             group_declaration.tag("group")
@@ -1603,97 +1695,1160 @@ def source_code():
         ).sep_by(wo)
         << wo.desc("ignored whitespace")
     )
-    yield
+)
 
 
-@generate
-def source_code_top():
-    return source_code
-    yield
+source_code_top = source_code
 
 
-def rpcont(i=0):
-    @generate
-    def recursive_paren_content():
-        return (
-            (
-                (regex(r"[^\(\)]") if i else regex(r"[^\(\)\,]"))
-                | (s("(") + rpcont(i + 1)) + s(")")
+# Contents of a parenthesized preprocessor alias argument. Commas only split
+# arguments at the outermost level.
+nested_paren_content = forward_declaration()
+nested_paren_content.become(
+    (regex(r"[^\(\)]") | (s("(") + nested_paren_content) + s(")")).many().concat()
+)
+paren_content = (
+    (regex(r"[^\(\)\,]") | (s("(") + nested_paren_content) + s(")")).many().concat()
+)
+macro_call_arguments = s("(") >> paren_content.sep_by(s(",") << wo) << s(")")
+
+call_argument_delimiter = re.compile(r"[(),]")
+call_argument_space = re.compile(r"\s*")
+
+
+def split_call_arguments(code):
+    """Same as macro_call_arguments.parse_partial(code), for code starting
+    with '(', but scanning for the parentheses and commas directly; calls
+    that do not close are left to the grammar, to report."""
+    args = []
+    start = 1
+    depth = 0
+
+    for m in call_argument_delimiter.finditer(code, 1):
+        delim = m.group()
+
+        if delim == "(":
+            depth += 1
+
+        elif delim == ")":
+            if depth == 0:
+                args.append(code[start : m.start()])
+                return args, code[m.end() :]
+
+            depth -= 1
+
+        elif depth == 0:
+            args.append(code[start : m.start()])
+            start = call_argument_space.match(code, m.end()).end()
+
+    return macro_call_arguments.parse_partial(code)
+
+
+defmacro_header = seq(
+    regex(r"[a-zA-Z_][a-zA-Z0-9_]*"),
+    (s("(") >> (regex(r"[a-zA-Z_][a-zA-Z0-9_]*").sep_by(s(","))) << s(")"))
+    .optional()
+    .map(lambda x: x or []),
+)
+
+
+class MacroExpander:
+    """Expands the parametrized preprocessor aliases (#defmacro) in lines
+    of code.
+
+    defines maps every alias to its (value, argument names); it is only
+    changed through define and undefine, so that the alternation regex of
+    all alias names, and the expansion of every (alias, arguments) call
+    seen so far, can be kept until it changes.
+
+    Expanding an alias call expands the aliases in the result too; calls
+    nested deeper than max_depth, or expanding to more than max_size
+    characters, are taken for runaway self-expansion, and raise a
+    PreprocessingError.
+    """
+
+    max_depth = 100
+    max_size = 1 << 20
+
+    def __init__(self, defines=()):
+        if not isinstance(defines, dict):
+            defines = dict(defines)
+
+        self.defines = defines
+        self.changed()
+
+    def changed(self):
+        self.frozen = None
+        self.any_call = None
+        self.calls = {}
+        self.expansions = {}
+
+    def copy(self):
+        """A MacroExpander of a copy of defines, which starts out with the
+        same cached patterns and expansions."""
+        other = MacroExpander(dict(self.defines))
+        other.frozen = self.frozen
+        other.any_call = self.any_call
+        other.calls = dict(self.calls)
+        other.expansions = dict(self.expansions)
+        return other
+
+    def define(self, key, value, args):
+        self.defines[key] = (value, args)
+        self.changed()
+
+    def undefine(self, key):
+        if key in self.defines:
+            self.defines.pop(key)
+            self.changed()
+
+    def aliases(self):
+        """A copy of defines, which is kept until they change."""
+        if self.frozen is None:
+            self.frozen = dict(self.defines)
+
+        return self.frozen
+
+    def call_pattern(self, key):
+        pattern = self.calls.get(key)
+
+        if pattern is None:
+            pattern = self.calls[key] = re.compile(
+                r"\b" + re.escape(key.upper()) + r"\("
             )
-            .many()
-            .concat()
-        )
-        yield
 
-    return recursive_paren_content
+        return pattern
+
+    def called(self, code):
+        """The (upper case) names of the aliases called in code."""
+        if self.any_call is None:
+            # '(' has to follow, so no name matches where a longer one would
+            self.any_call = re.compile(
+                r"\b({})\(".format(
+                    "|".join(re.escape(key.upper()) for key in self.defines)
+                )
+            )
+
+        return {m.group(1) for m in self.any_call.finditer(code.upper())}
+
+    def expand(self, code, this_fname=None, i=0, depth=0):
+        if not self.defines:
+            return code
+
+        called = self.called(code)
+
+        if not called:
+            return code
+
+        # Every alias is expanded all over the line before the next one,
+        # in the order they were defined.
+        l = code
+
+        for key, (val, d_args) in self.defines.items():
+            if key.upper() not in called:
+                continue
+
+            pattern = self.call_pattern(key)
+            nl = ""
+
+            while True:
+                j = pattern.search(l.upper())
+
+                if not j:
+                    nl += l
+                    break
+
+                j = j.start()
+                nl += l[:j]
+                l = l[j + len(key) :]
+
+                try:
+                    args, l = split_call_arguments(l)
+                    args = [x for x in args if x]
+
+                except parsy.ParseError as e:
+                    print("\n")
+                    traceback.print_exc()
+                    print()
+
+                    raise PreprocessingError(
+                        "Unexpected parse error using parametrized preprocessor alias '{}' ({})".format(
+                            key, e
+                        ),
+                        i,
+                        this_fname,
+                        code + "\n\n",
+                    )
+
+                if len(d_args) != len(args):
+                    raise PreprocessingError(
+                        "Bad number of arguments using parametrized preprocessor alias '{}': expected {}, got {}!".format(
+                            key, len(d_args), len(args)
+                        ),
+                        i,
+                        this_fname,
+                        code,
+                    )
+
+                nl += self.expand_call(key, val, d_args, args, this_fname, i, depth)
+
+            # The expansions may have made up other calls with the code
+            # around them.
+            l = nl
+            called = self.called(l)
+
+        return l
+
+    def expand_call(self, key, val, d_args, args, this_fname, i, depth):
+        res = self.expansions.get((key, tuple(args)))
+
+        if res is not None:
+            return res
+
+        if depth >= self.max_depth:
+            raise PreprocessingError(
+                "Parametrized preprocessor alias '{}' expands more than {} levels deep; does it expand into itself?".format(
+                    key, self.max_depth
+                ),
+                i,
+                this_fname,
+            )
+
+        v = val
+
+        for aname, aval in zip(d_args, args):
+            v = re.sub(r"\({}\)".format(re.escape(aname)), "({})".format(aval), v)
+
+        res = self.expand(v, this_fname, i, depth + 1)
+
+        if len(res) > self.max_size:
+            raise PreprocessingError(
+                "Parametrized preprocessor alias '{}' expands to more than {} characters!".format(
+                    key, self.max_size
+                ),
+                i,
+                this_fname,
+            )
+
+        self.expansions[(key, tuple(args))] = res
+        return res
 
 
 def preprocess_for_macros(code, defines=(), this_fname=None, i=0):
-    l = code
+    return MacroExpander(defines).expand(code, this_fname, i)
+
+
+class PostCode(collections.abc.Sequence):
+    """Preprocessed source code.
+
+    The processed lines are kept as one string, text, which is what gets
+    parsed, along with the offset each line starts at, and the file and
+    line number each came from (file names are interned). Indexing still
+    gives a (filename, line_no, source_line, processed_line, begin_char)
+    tuple for each line.
+
+    The source lines, which are only shown in error messages, are kept as
+    they were read; their aliases are only expanded when they are looked
+    up, with the aliases that were defined when the line was added.
+    """
+
+    def __init__(self):
+        self.filenames = []
+        self.file_ids = array("I")
+        self.line_numbers = array("I")
+        self.line_starts = array("I")
+        self.source_lines = []
+
+        # the aliases defined from each line on, by the first line they apply
+        self.alias_runs = array("I")
+        self.alias_sets = []
+
+        self._file_id_of = {}
+        self._parts = []
+        self._text = None
+        self._size = 0
+
+    def file_id(self, fname):
+        file_id = self._file_id_of.get(fname)
+
+        if file_id is None:
+            file_id = self._file_id_of[fname] = len(self.filenames)
+            self.filenames.append(fname)
+
+        return file_id
+
+    def append(self, fname, line_no, source_line, line, aliases=None):
+        if not self.alias_sets or self.alias_sets[-1] is not aliases:
+            self.alias_runs.append(len(self.line_starts))
+            self.alias_sets.append(aliases)
+
+        self.file_ids.append(self.file_id(fname))
+        self.line_numbers.append(line_no)
+        self.line_starts.append(self._size)
+        self.source_lines.append(source_line)
+
+        if self._text is not None:
+            self._parts = [self._text]
+            self._text = None
+
+        self._parts.append(line)
+        self._size += len(line) + 1
+
+    def extend_lines(self, fname, line_no, source_lines, text, starts, aliases=None):
+        """Appends consecutive lines of one file, from line_no on, at once;
+        text is the processed lines joined together, and starts the offset
+        each starts at in it."""
+        if not self.alias_sets or self.alias_sets[-1] is not aliases:
+            self.alias_runs.append(len(self.line_starts))
+            self.alias_sets.append(aliases)
+
+        count = len(source_lines)
+        size = self._size
+
+        self.file_ids.extend(array("I", [self.file_id(fname)]) * count)
+        self.line_numbers.extend(range(line_no, line_no + count))
+        self.line_starts.extend([size + start for start in starts])
+        self.source_lines.extend(source_lines)
+
+        if self._text is not None:
+            self._parts = [self._text]
+            self._text = None
+
+        self._parts.append(text)
+        self._size += len(text) + 1
+
+    def extend(self, other):
+        """Appends every line of another PostCode."""
+        if not len(other):
+            return
+
+        offset = len(self.line_starts)
+
+        for start, aliases in zip(other.alias_runs, other.alias_sets):
+            if not self.alias_sets or self.alias_sets[-1] is not aliases:
+                self.alias_runs.append(offset + start)
+                self.alias_sets.append(aliases)
+
+        file_ids = [self.file_id(fname) for fname in other.filenames]
+
+        self.file_ids.extend(file_ids[file_id] for file_id in other.file_ids)
+        self.line_numbers.extend(other.line_numbers)
+        self.line_starts.extend(self._size + start for start in other.line_starts)
+        self.source_lines.extend(other.source_lines)
+
+        if self._text is not None:
+            self._parts = [self._text]
+            self._text = None
+
+        text = other.text
+        self._parts.append(text)
+        self._size += len(text) + 1
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = "\n".join(self._parts)
+            self._parts = []
+
+        return self._text
+
+    def source_line(self, i):
+        """The source line i, with its aliases expanded."""
+        line = self.source_lines[i]
+        aliases = self.alias_sets[bisect.bisect_right(self.alias_runs, i) - 1]
+
+        if not aliases:
+            return line
+
+        try:
+            return MacroExpander(aliases).expand(
+                line, self.filenames[self.file_ids[i]], self.line_numbers[i]
+            )
+
+        except PreprocessingError:
+            return line
+
+    def line_at(self, index):
+        """The number of the line (from 0) that index of text falls in."""
+        return max(0, bisect.bisect_right(self.line_starts, index) - 1)
+
+    def __len__(self):
+        return len(self.line_starts)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+
+        if not 0 <= i < len(self):
+            raise IndexError("line index out of range")
+
+        start = self.line_starts[i]
+        end = self.line_starts[i + 1] - 1 if i + 1 < len(self) else len(self.text)
+
+        return (
+            self.filenames[self.file_ids[i]],
+            self.line_numbers[i],
+            self.source_line(i),
+            self.text[start:end],
+            start,
+        )
+
+
+# Comments and line continuations
+
+# What starts a comment or a string literal; an apostrophe right after a
+# word is not a string (as in isn't).
+comment_or_string = re.compile(r"//|/\*|\"|(?<!\w)'")
+
+# String literals end at their closing quote, or at the end of the line.
+string_literal_end = {
+    '"': re.compile(r'"(?:[^"\\\n]|\\[\s\S])*"?'),
+    "'": re.compile(r"'(?:[^'\\\n]|\\[\s\S])*'?"),
+}
+line_comment_end = re.compile(r"[\r\n]|$")
+
+
+def blank_out(text):
+    return "\n".join(" " * len(part) for part in text.split("\n"))
+
+
+def strip_comments(code):
+    """Blanks out the // and /* */ comments in code (except inside string
+    literals), and joins lines ending with a backslash to the line after.
+
+    Line and column numbers are kept: comments are replaced by spaces,
+    and lines that were joined to the one before are left in as empty
+    lines after it. Block comments that are never closed are left in.
+    """
+    parts = []
+    pos = 0
+
+    while True:
+        m = comment_or_string.search(code, pos)
+
+        if m is None:
+            break
+
+        start = m.start()
+        token = m.group()
+
+        if token == "//":
+            end = line_comment_end.search(code, start).start()
+            parts.append(code[pos:start])
+            parts.append(" " * (end - start))
+
+        elif token == "/*":
+            end = code.find("*/", start + 2)
+
+            if end == -1:
+                end = start + 2
+                parts.append(code[pos:end])
 
-    for key, (val, d_args) in defines.items():
-        nl = ""
+            else:
+                end += 2
+                parts.append(code[pos:start])
+                parts.append(blank_out(code[start:end]))
+
+        else:
+            end = string_literal_end[token].match(code, start).end()
+            parts.append(code[pos:end])
+
+        pos = end
+
+    parts.append(code[pos:])
+    code = "".join(parts)
+
+    if "\\\n" not in code:
+        return code
 
-        while True:
-            j = re.search(r"\b" + re.escape(key.upper()) + r"\(", l.upper())
+    lines = code.split("\n")
+    joined = []
+    continued = []
 
-            if not j:
-                nl += l
-                break
+    for line in lines[:-1]:
+        if line.endswith("\\"):
+            continued.append(line[:-1])
+            continue
+
+        continued.append(line)
+        joined.append("".join(continued))
+        joined.extend("" for _ in range(len(continued) - 1))
+        continued = []
+
+    continued.append(lines[-1])
+    joined.append("".join(continued))
+    joined.extend("" for _ in range(len(continued) - 1))
+
+    return "\n".join(joined)
 
-            j = j.start()
-            nl += l[:j]
-            l = l[j + len(key) :]
 
+# Preprocessor directives, by the first word of their line, in upper case.
+conditional_directives = {
+    "#IFDEF": "ifdef",
+    "#IFDEFINED": "ifdef",
+    **{
+        "#IF{}DEF{}".format(neg, suffix): "ifndef"
+        for neg in ("N", "UN", "NOT")
+        for suffix in ("", "INED")
+    },
+    "#IFEQ": "ifeq",
+    "#IFEQUAL": "ifeq",
+    "#IFEQUALS": "ifeq",
+    **{
+        "#IF{}EQ{}".format(neg, suffix): "ifneq"
+        for neg in ("N", "NOT")
+        for suffix in ("", "UAL", "UALS")
+    },
+}
+else_directives = {"#ELSE": "else", "#OTHERWISE": "else"}
+preprocessor_directives = {
+    **conditional_directives,
+    **else_directives,
+    "#ENDIF": "endif",
+    "#IMPORT": "include",
+    "#INCLUDE": "include",
+    "#DEF": "define",
+    "#DEFINE": "define",
+    **{
+        "#DEF{}M{}".format(ine, suffix): "defmacro"
+        for ine in ("", "INE")
+        for suffix in ("", "AC", "ACRO")
+    },
+    "#UNDEF": "undef",
+    "#UNDEFINE": "undef",
+}
+
+whitespace_run = re.compile(r"\s+")
+
+# Lines that start with '#', after any whitespace.
+directive_line = re.compile(r"^[^\S\n]*#", re.M)
+
+
+# Included files
+
+
+class Missing:
+    """Stands for a key that was not in a dict; pickled by name, so that
+    it stays the same object."""
+
+    def __reduce__(self):
+        return "MISSING"
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = Missing()
+
+
+def file_stamp(fname):
+    """What tells an unchanged file apart: its modification time and size."""
+    st = os.stat(fname)
+    return (st.st_mtime_ns, st.st_size)
+
+
+class TrackingDict(dict):
+    """A copy of a dict, which records the keys looked up in it before they
+    were set, and the keys that were set or removed."""
+
+    def __init__(self, data=()):
+        super().__init__(data)
+        self.read = {}
+        self.written = {}
+
+    def _read(self, key):
+        if key not in self.written and key not in self.read:
+            self.read[key] = dict.get(self, key, MISSING)
+
+    def __contains__(self, key):
+        self._read(key)
+        return dict.__contains__(self, key)
+
+    def __getitem__(self, key):
+        self._read(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self._read(key)
+        return dict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        self.written[key] = True
+        dict.__setitem__(self, key, value)
+
+    def pop(self, key, *default):
+        self.written[key] = True
+        return dict.pop(self, key, *default)
+
+    def changes(self):
+        return {key: dict.get(self, key, MISSING) for key in self.written}
+
+
+def peek(mapping, key, default=None):
+    """Looks a key up without a TrackingDict recording it as read."""
+    if isinstance(mapping, TrackingDict):
+        return dict.get(mapping, key, default)
+
+    return mapping.get(key, default)
+
+
+class IncludedFile:
+    """The outcome of preprocessing an included file, and everything it
+    depended on.
+
+    Preprocessing a file only depends on its contents (and those of the
+    files it includes in turn), on the definitions it tests, on the aliases
+    defined before it, on which files were already included, and on what
+    its #include patterns match. While all of those are the same, the
+    lines, definitions, aliases and imports it added can be replayed
+    instead.
+    """
+
+    def __init__(self, stamps, defs, imports, aliases, new_aliases, postcode, globs):
+        self.stamps = stamps
+        self.defs = defs
+        self.imports = imports
+        self.aliases = aliases
+        self.new_aliases = new_aliases
+        self.postcode = postcode
+        self.globs = globs
+
+    def matches(self, preprocessor, cache):
+        for fname, stamp in self.stamps.items():
             try:
-                args, l = (
-                    s("(") >> rpcont().sep_by(s(",") << wo) << s(")")
-                ).parse_partial(l)
-                args = [x for x in args if x]
-
-            except parsy.ParseError as e:
-                print("\n")
-                traceback.print_exc()
-                print()
-
-                raise PreprocessingError(
-                    "Unexpected parse error using parametrized preprocessor alias '{}' ({})".format(
-                        key, e
-                    ),
-                    i,
-                    this_fname,
-                    code + "\n\n",
+                if file_stamp(fname) != stamp:
+                    return False
+
+            except OSError:
+                return False
+
+        # Only checks them; replay records what the file tested, if it
+        # matches after all.
+        for key, value in self.defs.read.items():
+            if peek(preprocessor.defs, key, MISSING) != value:
+                return False
+
+        for key, value in self.imports.read.items():
+            if peek(preprocessor.imports, key, MISSING) != value:
+                return False
+
+        if preprocessor.macros.defines != self.aliases:
+            return False
+
+        return all(
+            cache.glob(pattern) == gname for pattern, gname in self.globs.items()
+        )
+
+    def replay(self, preprocessor):
+        # Looks up what the file tested in the includer's definitions and
+        # imports too, so that an includer which is itself being recorded
+        # depends on them as well.
+        for key in self.defs.read:
+            preprocessor.defs.get(key)
+
+        for key in self.imports.read:
+            preprocessor.imports.get(key)
+
+        for key, value in self.defs.changes().items():
+            if value is MISSING:
+                preprocessor.defs.pop(key, None)
+
+            else:
+                preprocessor.defs[key] = value
+
+        for key, value in self.imports.changes().items():
+            preprocessor.imports[key] = value
+
+        if self.new_aliases != self.aliases:
+            preprocessor.macros.defines.clear()
+            preprocessor.macros.defines.update(self.new_aliases)
+            preprocessor.macros.changed()
+
+        if preprocessor.include_globs is not None:
+            preprocessor.include_globs.update(self.globs)
+
+        preprocessor.postcode.extend(self.postcode)
+
+
+class IncludeCache:
+    """Keeps the preprocessed lines of included files in memory, so that
+    headers shared by many compilation units (or by the many targets of a
+    Zake build) are read and preprocessed once per set of definitions they
+    test, rather than once per unit.
+
+    Entries are keyed by the absolute path of the file, and the name it
+    was included by (which its lines are attributed to), and are only used
+    while the file, and those it includes, keep the same modification time
+    and size. The matches of #include patterns are kept as well, for as
+    long as the directory they list is unchanged.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.globs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def glob(self, pattern):
+        dirname = os.path.dirname(pattern) or "."
+
+        if glob.has_magic(dirname):
+            return glob.glob(pattern)
+
+        try:
+            stamp = os.stat(dirname).st_mtime_ns
+
+        except OSError:
+            return []
+
+        cached = self.globs.get(pattern)
+
+        if cached is None or cached[0] != stamp:
+            cached = self.globs[pattern] = (stamp, glob.glob(pattern))
+
+        return list(cached[1])
+
+    def include(self, preprocessor, fname):
+        """Preprocesses fname as included by preprocessor, adding its lines
+        to the same PostCode, or replays the last time it was."""
+        key = (os.path.abspath(fname), fname)
+        entries = self.entries.setdefault(key, [])
+
+        for entry in entries:
+            if entry.matches(preprocessor, self):
+                self.hits += 1
+                entry.replay(preprocessor)
+                return
+
+        self.misses += 1
+
+        stamp = file_stamp(fname)
+        defs = TrackingDict(preprocessor.defs)
+        imports = TrackingDict(preprocessor.imports)
+        aliases = dict(preprocessor.macros.defines)
+        macros = preprocessor.macros.copy()
+        postcode = PostCode()
+        include_globs = {}
+
+        with open(fname) as fp:
+            code = fp.read()
+
+        def outcome(stamps):
+            return IncludedFile(
+                stamps,
+                defs,
+                imports,
+                aliases,
+                dict(macros.defines),
+                postcode,
+                include_globs,
+            )
+
+        try:
+            Preprocessor(
+                imports,
+                defs,
+                macros,
+                fname,
+                os.path.dirname(fname),
+                postcode,
+                include_globs,
+                self,
+            ).run(code + "\n")
+
+        except PreprocessingError:
+            # leaves what was preprocessed before the error, as it would be
+            # without the cache
+            outcome({}).replay(preprocessor)
+            raise
+
+        stamps = {fname: stamp}
+
+        for nested in imports.written:
+            stamps[nested] = file_stamp(nested)
+
+        entry = outcome(stamps)
+        entries.append(entry)
+        entry.replay(preprocessor)
+
+
+# Shared by every preprocess_code call that is not given its own.
+default_include_cache = IncludeCache()
+
+
+class LineProgram:
+    """A source file, split up once into what preprocessing does with it,
+    whatever the definitions: runs of plain lines, and the directives
+    between them, with the branches each conditional skips to.
+
+    Preprocessing a file again, say with the definitions of another build
+    target, only goes through its directives, and adds the runs of plain
+    lines that they leave active as a whole (as long as they call no
+    alias). Operations are only decoded the first time they are reached,
+    so that inactive branches cost no more than skipping them. Programs are
+    kept for the last few hundred distinct sources (see line_program).
+    """
+
+    def __init__(self, code):
+        text = strip_comments(code)
+
+        self.source_lines = code.split("\n")
+        self.lines = lines = text.split("\n")
+
+        # the line each operation starts at, and the end of the runs of
+        # plain lines (None for directives)
+        self.op_lines = op_lines = []
+        self.op_ends = op_ends = []
+
+        # the branch skipped after each line, see skip
+        self.skips = {}
+
+        run_start = 0
+        i = 0
+        pos = 0
+
+        for m in directive_line.finditer(text):
+            start = m.start()
+            i += text.count("\n", pos, start)
+            pos = start
+
+            if run_start < i:
+                op_lines.append(run_start)
+                op_ends.append(i)
+
+            op_lines.append(i)
+            op_ends.append(None)
+            run_start = i + 1
+
+        if run_start < len(lines):
+            op_lines.append(run_start)
+            op_ends.append(len(lines))
+
+        # the decoded operations, see decode
+        self.ops = [None] * len(op_lines)
+
+    def decode(self, op):
+        """Operation op, as ("text", first line, end line, joined lines,
+        start offsets, or None for single lines) for runs of plain lines, (kind, line, line_case,
+        args) for directives, or ("dropped", line) for unknown ones."""
+        i = self.op_lines[op]
+        end = self.op_ends[op]
+
+        if end == i + 1:
+            decoded = ("text", i, end, self.lines[i], None)
+
+        elif end is not None:
+            lines = self.lines[i:end]
+
+            # each line starts after the ones before it, and their newlines
+            starts = array(
+                "I",
+                itertools.accumulate(map((1).__add__, map(len, lines[:-1])), initial=0),
+            )
+
+            decoded = ("text", i, end, "\n".join(lines), starts)
+
+        else:
+            line_case = whitespace_run.sub(" ", self.lines[i].lstrip())
+            args = line_case.split(" ")
+            kind = preprocessor_directives.get(args[0].upper())
+
+            if kind is None or (len(args) < 2 and kind not in ("else", "endif")):
+                decoded = ("dropped", i)
+
+            else:
+                decoded = (kind, i, line_case, args)
+
+        self.ops[op] = decoded
+        return decoded
+
+    def op_from(self, i):
+        """The index of the first operation from line i on."""
+        return bisect.bisect_left(self.op_lines, i)
+
+    def skip(self, i):
+        """Where the branch after line i ends: the line after the #else
+        after it (where the next branch starts) or the #endif that closes
+        its block, along with whether it was the #endif."""
+        skip = self.skips.get(i)
+
+        if skip is None:
+            skip = self.skips[i] = self.find_skip(i)
+
+        return skip
+
+    def find_skip(self, i):
+        lines = self.lines
+        nesting = 0
+
+        for j in range(i + 1, len(lines)):
+            stripped = lines[j].lstrip()
+
+            if not stripped.startswith("#"):
+                continue
+
+            word = stripped.split(None, 1)[0].upper()
+
+            if word in conditional_directives:
+                nesting += 1
+
+            elif word == "#ENDIF":
+                if nesting == 0:
+                    return (j + 1, True)
+
+                nesting -= 1
+
+            elif nesting == 0 and word in else_directives:
+                return (j + 1, False)
+
+        return (len(lines), False)
+
+
+line_program = functools.lru_cache(maxsize=256)(LineProgram)
+
+
+class Preprocessor:
+    """Preprocesses one source file, and the files it includes.
+
+    The lines of the source are classified once, into a LineProgram: runs
+    of lines that do not start with '#' are expanded and added to the
+    PostCode, and directive lines are dispatched on their first word, to
+    the method named in preprocessor_directives. The lines of an inactive
+    conditional branch are skipped over, up to its matching #else or
+    #endif, without being processed.
+    """
+
+    def __init__(
+        self,
+        imports,
+        defs,
+        macros,
+        this_fname,
+        rel_dir,
+        postcode,
+        include_globs,
+        include_cache=None,
+    ):
+        if include_cache is None:
+            include_cache = default_include_cache
+
+        self.imports = imports
+        self.defs = defs
+        self.macros = macros
+        self.this_fname = this_fname
+        self.rel_dir = rel_dir
+        self.postcode = postcode
+        self.include_globs = include_globs
+        self.include_cache = include_cache
+
+        self.program = None
+
+        # conditional blocks currently open
+        self.depth = 0
+
+    def run(self, code):
+        self.program = program = line_program(code)
+        ops = program.ops
+        num_ops = len(ops)
+        op = 0
+
+        while op < num_ops:
+            kind, i, *rest = ops[op] or program.decode(op)
+
+            if kind == "text":
+                self.add_run(i, *rest)
+                op += 1
+
+            elif kind == "dropped":
+                # unknown directives are dropped
+                op += 1
+
+            else:
+                op = program.op_from(getattr(self, "directive_" + kind)(i, *rest))
+
+        return self.postcode
+
+    def add_run(self, start, end, text, starts):
+        macros = self.macros
+        source_lines = self.program.source_lines
+
+        if macros.defines and macros.called(text):
+            lines = self.program.lines
+
+            for i in range(start, end):
+                line_no = i + 1
+                l = macros.expand(lines[i], self.this_fname, line_no)
+
+                self.postcode.append(
+                    self.this_fname, line_no, source_lines[i], l, macros.aliases()
                 )
 
-            if len(d_args) != len(args):
-                raise PreprocessingError(
-                    "Bad number of arguments using parametrized preprocessor alias '{}': expected {}, got {}!".format(
-                        key, len(d_args), len(args)
+        elif starts is None:
+            self.postcode.append(
+                self.this_fname, end, source_lines[start], text, macros.aliases()
+            )
+
+        else:
+            self.postcode.extend_lines(
+                self.this_fname,
+                start + 1,
+                source_lines[start:end],
+                text,
+                starts,
+                macros.aliases(),
+            )
+
+    def error(self, problem, i, line_case):
+        return PreprocessingError(problem, i + 1, self.this_fname, line_case)
+
+    # Conditional blocks; the directive methods get the index of their line,
+    # and return the index of the next line to process.
+
+    def open_block(self, i, active):
+        self.depth += 1
+
+        if active:
+            return i + 1
+
+        return self.skip_branch(i)
+
+    def skip_branch(self, i):
+        """Skips the branch after line i, up to the #else after it (where
+        the next branch starts) or the #endif that closes its block."""
+        j, closes = self.program.skip(i)
+
+        if closes:
+            self.depth -= 1
+
+        return j
+
+    def directive_ifdef(self, i, line_case, args):
+        return self.open_block(i, args[1] in self.defs)
+
+    def directive_ifndef(self, i, line_case, args):
+        return self.open_block(i, args[1] not in self.defs)
+
+    def directive_ifeq(self, i, line_case, args):
+        key, value = args[1], args[2:]
+        return self.open_block(i, key in self.defs and self.defs[key] == value)
+
+    def directive_ifneq(self, i, line_case, args):
+        key, value = args[1], args[2:]
+        return self.open_block(i, key in self.defs and self.defs[key] != value)
+
+    def directive_else(self, i, line_case, args):
+        if self.depth == 0:
+            raise self.error(
+                "Attempted to use 'else' on a conditional preprocessor block that didn't exist!",
+                i,
+                line_case,
+            )
+
+        # the branch before it was active
+        return self.skip_branch(i)
+
+    def directive_endif(self, i, line_case, args):
+        self.depth -= 1
+
+        if self.depth < 0:
+            raise self.error(
+                "Attempted to end a conditional preprocessor block that didn't exist!",
+                i,
+                line_case,
+            )
+
+        return i + 1
+
+    # Imports and definitions
+
+    def directive_include(self, i, line_case, args):
+        gfname = os.path.join(self.rel_dir, " ".join(args[1:]))
+        gname = self.include_cache.glob(gfname)
+
+        if self.include_globs is not None:
+            self.include_globs[gfname] = gname
+
+        if not gname:
+            raise self.error(
+                "No module matching '{}' was found".format(gfname), i, line_case
+            )
+
+        for fname in gname:
+            if not os.path.isfile(fname):
+                raise self.error(
+                    "The module '{}' was not found".format(fname), i, line_case
+                )
+
+            if self.imports.get(fname, object()) == self.this_fname:
+                raise self.error(
+                    "The module '{}' was found in an infinite import cycle!".format(
+                        fname
                     ),
                     i,
-                    this_fname,
-                    code,
+                    line_case,
                 )
 
-            v = val
+            elif fname not in self.imports:
+                self.imports[fname] = self.this_fname
+                self.include_cache.include(self, fname)
+
+        return i + 1
 
-            for aname, aval in zip(d_args, args):
-                # ov = v
-                v = re.sub(r"\({}\)".format(re.escape(aname)), "({})".format(aval), v)
+    def directive_define(self, i, line_case, args):
+        key = args[1]
+        value = " ".join(args[2:])
 
-            res = preprocess_for_macros(v, defines, this_fname, i)
-            nl += res
+        if value == "":
+            self.defs[key] = None
 
-        l = nl
+        else:
+            self.defs[key] = value
+
+        return i + 1
+
+    def directive_defmacro(self, i, line_case, args):
+        name = args[1]
+        value = " ".join(args[2:])
+
+        (key, margs), _ = defmacro_header.parse_partial(name)
+        margs = [x for x in margs if x]
+
+        if value == "":
+            raise self.error(
+                "Empty preprocessor macros ('{}') are not allowed!".format(key),
+                i,
+                line_case,
+            )
+
+        self.defs[key] = value
+        self.macros.define(key, value, margs)
+
+        return i + 1
 
-    return l
+    def directive_undef(self, i, line_case, args):
+        key = args[1]
+
+        if key in self.defs:
+            self.defs.pop(key)
+
+        self.macros.undefine(key)
+
+        return i + 1
 
 
 def preprocess_code(
-    code, imports=(), defs=(), defines=(), this_fname=None, rel_dir=".", begin_char=None
+    code,
+    imports=(),
+    defs=(),
+    defines=(),
+    this_fname=None,
+    rel_dir=".",
+    postcode=None,
+    include_globs=None,
+    include_cache=None,
 ):
-    if not begin_char:
-        begin_char = [0]
+    if postcode is None:
+        postcode = PostCode()
 
     if not isinstance(imports, dict):
         imports = dict(imports)
@@ -1701,244 +2856,228 @@ def preprocess_code(
     if not isinstance(defs, dict):
         defs = dict(defs)
 
-    if not isinstance(defines, dict):
-        defines = dict(defines)
+    return Preprocessor(
+        imports,
+        defs,
+        MacroExpander(defines),
+        this_fname,
+        rel_dir,
+        postcode,
+        include_globs,
+        include_cache,
+    ).run(code)
 
-    # conditional substitution
-    pcodelines = []
 
-    cond_active = True
-    depth = 0
-    check_depth = 0
+# Parser backends; "rd" is the hand-written parser in zdcode.rdparser, which
+# produces the same ASTs as the combinator grammar above. It is the default,
+# since it parses nested statements on an explicit stack; the combinator
+# grammar recurses several frames per nesting level, and so can exceed the
+# interpreter's recursion limit on deeply nested code.
+parser_backends = ("parsy", "rd")
+default_backend = "rd"
 
-    # comments
-    src_lines = code.split("\n")
 
-    code = re.sub(r"\/\/[^\r\n]+", lambda x: re.sub(r"[^\n]", " ", x.group(0)), code)
-    code = re.sub(
-        r"\/\*(\n|.)+?\*\/", lambda x: re.sub(r"[^\n]", " ", x.group(0)), code
-    )
-    code = re.sub(r"\\\n", "", code)
+# How many times the interpreter's recursion limit the combinator grammar
+# gets while it parses; it is restored right after. The rd backend does not
+# need this, but parsy recurses several frames per nesting level, and
+# cannot be made iterative.
+parsy_recursion_factor = 16
 
-    codelines = code.split("\n")
+# The limit is process-wide, so parses that overlap (in other threads, or
+# from within one another) share one raise of it.
+_parsy_recursion_lock = threading.Lock()
+_parsy_recursion = {"parses": 0, "limit": None}
 
-    for _i, l in enumerate(codelines):
-        i = _i + 1
-        src_l = src_lines[_i]
 
-        check_line_case = re.sub(r"\s+", " ", re.sub(r"^\s+", "", l))
-        check_line = check_line_case.upper()
+def _raise_parsy_recursion_limit():
+    with _parsy_recursion_lock:
+        if _parsy_recursion["parses"] == 0:
+            limit = sys.getrecursionlimit()
+            _parsy_recursion["limit"] = limit
+            sys.setrecursionlimit(limit * parsy_recursion_factor)
 
-        # conditional blocks
-        if check_line.startswith("#IFDEF ") or check_line.startswith("#IFDEFINED "):
-            check_depth += 1
+        _parsy_recursion["parses"] += 1
 
-            if cond_active:
-                key = check_line_case.split(" ")[1]
 
-                if key not in defs:
-                    cond_active = False
+def _restore_parsy_recursion_limit():
+    with _parsy_recursion_lock:
+        _parsy_recursion["parses"] -= 1
 
-            else:
-                depth += 1
+        if _parsy_recursion["parses"] == 0:
+            sys.setrecursionlimit(_parsy_recursion["limit"])
 
-        elif ifundef.match(check_line.split(" ")[0]):
-            check_depth += 1
 
-            if cond_active:
-                key = check_line_case.split(" ")[1]
+def parse_source(code, backend=None, memo=None):
+    if backend is None:
+        backend = default_backend
 
-                if key in defs:
-                    cond_active = False
+    if memo is not None and backend != "parsy":
+        raise ValueError(
+            "The packrat cache only works with the parsy parser backend, not {}!".format(
+                backend
+            )
+        )
 
-            else:
-                depth += 1
+    if backend == "parsy":
+        outer_memo = getattr(_packrat_state, "memo", None)
+        _raise_parsy_recursion_limit()
 
-        elif (
-            check_line.startswith("#IFEQ ")
-            or check_line.startswith("#IFEQUAL ")
-            or check_line.startswith("#IFEQUALS ")
-        ):
-            check_depth += 1
+        try:
+            if memo is not None:
+                memo.stream = code
+                _packrat_state.memo = memo
 
-            if cond_active:
-                key = check_line_case.split(" ")[1]
-                value = check_line_case.split(" ")[2:]
+            return source_code_top.parse(code)
 
-                if key not in defs or defs[key] != value:
-                    cond_active = False
+        finally:
+            _restore_parsy_recursion_limit()
 
-            else:
-                depth += 1
+            if memo is not None:
+                _packrat_state.memo = outer_memo
+                memo.stream = None
+                memo.results.clear()
 
-        elif ifneq.match(check_line.split(" ")[0]):
-            check_depth += 1
+    if backend == "rd":
+        from . import rdparser
 
-            if cond_active:
-                key = check_line_case.split(" ")[1]
-                value = check_line_case.split(" ")[2:]
+        return rdparser.parse(code)
 
-                if key not in defs or defs[key] == value:
-                    cond_active = False
+    raise ValueError("Unknown parser backend: {}".format(backend))
 
-            else:
-                depth += 1
 
-        elif check_line.startswith("#ELSE") or check_line.startswith("#OTHERWISE"):
-            if check_depth == 0:
-                raise PreprocessingError(
-                    "Attempted to use 'else' on a conditional preprocessor block that didn't exist!",
-                    i,
-                    this_fname,
-                    check_line_case,
-                )
+# Incremental parsing
 
-            cond_active = not cond_active
+# Strings are skipped whole, so that braces in them do not count. Like in
+# comment_or_string, an apostrophe right after a word is not a string (as
+# in isn't), and neither is one without a closing quote on its line.
+declaration_token = re.compile(
+    r'"(?:\\.|[^"\\])*"|(?<!\w)\'(?:\\.|[^\'\\\n])*\'|[{};]|[^\s{};"\']+|\S'
+)
 
-        elif check_line.startswith("#ENDIF"):
-            check_depth -= 1
 
-            if check_depth < 0:
-                raise PreprocessingError(
-                    "Attempted to end a conditional preprocessor block that didn't exist!",
-                    i,
-                    this_fname,
-                    check_line_case,
-                )
+def split_declarations(code):
+    """Splits preprocessed source code into (start, end) spans of whole
+    top-level declarations, by balancing braces.
 
-            if not cond_active:
-                if depth > 0:
-                    depth -= 1
-
-                else:
-                    cond_active = True
-
-        # imports and definitions
-        if cond_active:
-            if check_line.startswith("#IMPORT ") or check_line.startswith("#INCLUDE "):
-                gfname = os.path.join(rel_dir, " ".join(check_line_case.split(" ")[1:]))
-                gname = glob.glob(gfname)
-
-                if gname:
-                    for fname in gname:
-                        if not os.path.isfile(fname):
-                            raise PreprocessingError(
-                                "The module '{}' was not found".format(fname),
-                                i,
-                                this_fname,
-                                check_line_case,
-                            )
+    A span ends at a closing brace or semicolon at the top level, along
+    with any semicolons and 'else' clauses after it. Returns None if the
+    braces do not balance.
+    """
+    spans = []
+    start = end = None
+    depth = 0
+    closed = False
 
-                        if imports.get(fname, object()) == this_fname:
-                            raise PreprocessingError(
-                                "The module '{}' was found in an infinite import cycle!".format(
-                                    fname
-                                ),
-                                i,
-                                this_fname,
-                                check_line_case,
-                            )
+    for m in declaration_token.finditer(code):
+        tok = m.group()
 
-                        elif fname not in imports:
-                            imports[fname] = this_fname
-
-                            with open(fname) as fp:
-                                lines = preprocess_code(
-                                    fp.read() + "\n",
-                                    imports,
-                                    defs,
-                                    defines,
-                                    this_fname=fname,
-                                    rel_dir=os.path.dirname(fname),
-                                    begin_char=begin_char,
-                                )
+        if closed:
+            if tok == ";":
+                end = m.end()
+                continue
 
-                                for l in lines:
-                                    pcodelines.append(l)
+            if not tok.upper().startswith("ELSE"):
+                spans.append((start, end))
+                start = None
 
-                else:
-                    raise PreprocessingError(
-                        "No module matching '{}' was found".format(gfname),
-                        i,
-                        this_fname,
-                        check_line_case,
-                    )
+            closed = False
 
-            elif check_line.startswith("#DEF ") or check_line.startswith("#DEFINE "):
-                key = check_line_case.split(" ")[1]
-                value = " ".join(check_line_case.split(" ")[2:])
+        if start is None:
+            start = m.start()
 
-                if value == "":
-                    defs[key] = None
+        if tok == "{":
+            depth += 1
 
-                else:
-                    defs[key] = value
+        elif tok == "}":
+            depth -= 1
 
-            elif defmacro.match(check_line.split(" ")[0]):
-                name = check_line_case.split(" ")[1]
-                value = " ".join(check_line_case.split(" ")[2:])
+            if depth < 0:
+                return None
 
-                (key, args), _ = seq(
-                    regex(r"[a-zA-Z_][a-zA-Z0-9_]*"),
-                    (
-                        s("(")
-                        >> (regex(r"[a-zA-Z_][a-zA-Z0-9_]*").sep_by(s(",")))
-                        << s(")")
-                    )
-                    .optional()
-                    .map(lambda x: x or []),
-                ).parse_partial(name)
-                args = [x for x in args if x]
+            closed = depth == 0
+
+        elif tok == ";" and depth == 0:
+            closed = True
+
+        end = m.end()
+
+    if depth:
+        return None
+
+    if start is not None:
+        spans.append((start, end))
+
+    return spans
 
-                if value == "":
-                    raise PreprocessingError(
-                        "Empty preprocessor macros ('{}') are not allowed!".format(key),
-                        i,
-                        this_fname,
-                        check_line_case,
-                    )
 
-                defs[key] = value
-                defines[key] = (value, args)
+class DeclarationCache:
+    """Reuses the ASTs of top-level declarations whose text did not change
+    since they were last parsed.
 
-            elif check_line.startswith("#UNDEF ") or check_line.startswith(
-                "#UNDEFINE "
-            ):
-                key = check_line_case.split(" ")[1]
+    The source is split with split_declarations, and only the spans not
+    seen before are parsed, each on its own. If one of them does not
+    parse, the whole source is parsed instead, so that errors are found
+    and reported exactly like without the cache.
+    """
 
-                if key in defs:
-                    defs.pop(key)
+    def __init__(self):
+        self.fragments = {}
+        self.reused = 0
+        self.parsed = 0
 
-                if key in defines:
-                    defines.pop(key)
+    def parse(self, code, backend=None, memo=None):
+        spans = split_declarations(code)
 
-        if not check_line.startswith("#") and cond_active:
-            l = preprocess_for_macros(l, defines, this_fname, i)
-            src_l = preprocess_for_macros(src_l, defines, this_fname, i)
+        if spans is None:
+            return parse_source(code, backend, memo)
 
-            pcodelines.append((this_fname, i, src_l, l, begin_char[0]))
-            begin_char[0] += len(l) + 1
+        items = []
 
-    return pcodelines
+        for start, end in spans:
+            text = code[start:end]
+            fragment = self.fragments.get(text)
 
+            if fragment is not None:
+                self.reused += 1
+
+            else:
+                try:
+                    fragment = parse_source(text, backend, memo)
+
+                except parsy.ParseError:
+                    return parse_source(code, backend, memo)
+
+                self.parsed += 1
+                self.fragments[text] = fragment
+
+            # the compiler is free to change the AST it is given
+            items.extend(copy.deepcopy(fragment))
+
+        return items
+
+
+def parse_postcode(
+    postcode, error_handler=None, backend=None, memo=None, declarations=None
+):
+    parse = parse_source if declarations is None else declarations.parse
 
-def parse_postcode(postcode, error_handler=None):
     try:
-        lim = sys.getrecursionlimit()
-        sys.setrecursionlimit(lim * 16)
-        clazzes = source_code_top.parse("\n".join(l[3] for l in postcode))
-        sys.setrecursionlimit(lim)
+        return parse(postcode.text, backend, memo)
 
-        return clazzes
+    except RecursionError:
+        err = ZDNestingError(postcode[0][0] if postcode else None)
 
-    except parsy.ParseError as parse_err:
-        m = error_line.match(str(parse_err))
+        if error_handler is None:
+            raise err from None
 
-        if m is None:
+        error_handler(err)
+
+    except parsy.ParseError as parse_err:
+        if not postcode:
             raise
 
         else:
-            err = ZDParseError(parse_err, postcode[int(m[2])])
+            err = ZDParseError(parse_err, postcode[postcode.line_at(parse_err.index)])
 
             if error_handler is None:
                 raise err
@@ -1948,7 +3087,16 @@ def parse_postcode(postcode, error_handler=None):
 
 
 def parse_code(
-    code, filename=None, dirname=".", error_handler=None, preproc_defs=(), imports=()
+    code,
+    filename=None,
+    dirname=".",
+    error_handler=None,
+    preproc_defs=(),
+    imports=(),
+    backend=None,
+    memo=None,
+    include_globs=None,
+    declarations=None,
 ):
     try:
         return parse_postcode(
@@ -1958,8 +3106,12 @@ def parse_code(
                 this_fname=filename,
                 rel_dir=dirname,
                 imports=imports,
+                include_globs=include_globs,
             ),
             error_handler=error_handler,
+            backend=backend,
+            memo=memo,
+            declarations=declarations,
         )
 
     except PreprocessingError as pperr: